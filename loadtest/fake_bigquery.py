@@ -0,0 +1,225 @@
+"""
+Sustituto en memoria de BigQueryService para pruebas de carga.
+
+Implementa los métodos que usa la API con la misma firma y forma de respuesta, simulando
+la latencia de cada operación con una Distribution y registrándola en StageStats.
+"""
+
+import threading
+import time
+from datetime import date, datetime, timezone
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from fake_upstreams import Distribution, StageStats
+
+# Requiere src/ en sys.path (run_load_test.py lo agrega antes de importar este módulo)
+from bigquery_services import decode_pending_cursor, encode_pending_cursor
+
+
+class FakeBigQueryService:
+
+    def __init__(self, stats: StageStats, query_latency: Distribution, write_latency: Distribution,
+                 companies: int = 10000) -> None:
+        self.stats = stats
+        self.query_latency = query_latency
+        self.write_latency = write_latency
+        self.write_behind_enabled = False
+        self.__lock = threading.Lock()
+        self.__listeners = []
+        self.control: Dict[str, Dict] = {}
+        self.contacts: Dict[Tuple[str, str], Dict] = {}
+        # Reservas de empresas entre procesos: {biz_identifier: (dueño, vencimiento time.time())}
+        self.leases: Dict[str, Tuple[str, float]] = {}
+        for index in range(companies):
+            biz_identifier = f"FAKE{index:08d}"
+            self.control[biz_identifier] = {
+                'biz_identifier': biz_identifier,
+                'biz_name': f"EMPRESA DE PRUEBA {index:08d} SA DE CV",
+                'scrapping_d': None,
+                'contact_found_flg': None,
+                'no_contact_attempts': None,
+            }
+
+    def __simulate(self, operation: str, latency: Distribution) -> None:
+        start = time.time()
+        time.sleep(latency.sample())
+        self.stats.record(f"bigquery.{operation}", time.time() - start)
+
+    def __pending(self) -> List[Dict]:
+        with self.__lock:
+            rows = [row for row in self.control.values()
+                    if row['scrapping_d'] is None or row['contact_found_flg'] is None]
+        return sorted(rows, key=lambda row: (row['biz_name'], row['biz_identifier']))
+
+    def __leased_keys(self) -> set:
+        now = time.time()
+        with self.__lock:
+            return {key for key, (_, expires_at) in self.leases.items() if expires_at > now}
+
+    def claim_companies(self, companies: List[Dict], owner: str, ttl_seconds: float) -> List[Dict]:
+        self.__simulate('company_lease_claim', self.write_latency)
+        now = time.time()
+        claimed = []
+        with self.__lock:
+            for company in companies:
+                key = company.get('biz_identifier')
+                current = self.leases.get(key)
+                if current is None or current[1] <= now or current[0] == owner:
+                    self.leases[key] = (owner, now + ttl_seconds)
+                    claimed.append(company)
+        return claimed
+
+    def release_company_leases(self, companies: List[Dict], owner: str) -> None:
+        with self.__lock:
+            for company in companies:
+                if self.leases.get(company.get('biz_identifier'), (None,))[0] == owner:
+                    del self.leases[company['biz_identifier']]
+
+    def query_cache_stats(self) -> Optional[Dict]:
+        return None
+
+    def write_behind_stats(self) -> Optional[Dict]:
+        return None
+
+    def query_cost_stats(self) -> Optional[Dict]:
+        return None
+
+    def add_control_write_listener(self, listener) -> None:
+        self.__listeners.append(listener)
+
+    def iter_scraped_companies(self, since: Optional[datetime] = None, page_size: int = 50000) -> Iterator[Dict]:
+        self.__simulate('scan_scraped', self.query_latency)
+        with self.__lock:
+            rows = [row for row in self.control.values()
+                    if row['scrapping_d'] is not None and row['contact_found_flg'] is not None]
+        for row in rows:
+            scrapping_d = datetime.combine(row['scrapping_d'], datetime.min.time(), tzinfo=timezone.utc)
+            if since is None or scrapping_d >= since:
+                yield {'biz_identifier': row['biz_identifier'], 'biz_name': row['biz_name'], 'scrapping_d': scrapping_d}
+
+    def table_exists(self, table_id: str) -> bool:
+        return True
+
+    def crear_tabla_empresas_scrapeadas_linkedin_contacts(self):
+        pass
+
+    def crear_tablas_contactos_normalizadas(self):
+        pass
+
+    def crear_tabla_linkedin_contacts_info(self):
+        pass
+
+    def load_companies_from_bigquery_linkedin_contacts(self, limit: int = 1, exclude: Optional[List[str]] = None) -> List[Dict]:
+        self.__simulate('load_companies', self.query_latency)
+        excluded = set(exclude or []) | self.__leased_keys()
+        companies = []
+        for row in self.__pending():
+            if row['biz_identifier'] in excluded:
+                continue
+            companies.append({'biz_name': row['biz_name'], 'biz_identifier': row['biz_identifier']})
+            if len(companies) >= limit:
+                break
+        return companies
+
+    def rank_companies_for_scraping(self, limit: int, exclude: Optional[List[str]] = None,
+                                    refresh_days: float = 90, retry_base_days: float = 14,
+                                    retry_max_days: float = 180, max_no_contact_attempts: int = 5,
+                                    refresh_weight: float = 1.0, retry_weight: float = 0.5) -> List[Dict]:
+        self.__simulate('rank_companies', self.query_latency)
+        excluded = set(exclude or []) | self.__leased_keys()
+        now = datetime.now(timezone.utc)
+        never, ranked = [], []
+        with self.__lock:
+            rows = list(self.control.values())
+        for row in rows:
+            if row['biz_identifier'] in excluded:
+                continue
+            if row['scrapping_d'] is None or row['contact_found_flg'] is None:
+                never.append({'biz_name': row['biz_name'], 'biz_identifier': row['biz_identifier'],
+                              'reason': 'never', 'priority': None})
+                continue
+            scraped_at = datetime.combine(row['scrapping_d'], datetime.min.time(), tzinfo=timezone.utc)
+            age_days = (now - scraped_at).total_seconds() / 86400
+            attempts = max(row['no_contact_attempts'] or 0, 1)
+            if row['contact_found_flg']:
+                reason, wait_days, priority = 'refresh', refresh_days, refresh_weight * age_days / refresh_days
+            else:
+                wait_days = min(retry_base_days * 2 ** (attempts - 1), retry_max_days)
+                reason, priority = 'retry', retry_weight * age_days / wait_days / attempts
+                if attempts >= max_no_contact_attempts:
+                    continue
+            if age_days >= wait_days:
+                ranked.append({'biz_name': row['biz_name'], 'biz_identifier': row['biz_identifier'],
+                               'reason': reason, 'priority': priority})
+        never.sort(key=lambda company: (company['biz_name'], company['biz_identifier']))
+        ranked.sort(key=lambda company: (-company['priority'], company['biz_name'], company['biz_identifier']))
+        return (never + ranked)[:limit]
+
+    def get_pending_companies_count(self, table_name: str) -> int:
+        self.__simulate('pending_count', self.query_latency)
+        return len(self.__pending())
+
+    def get_pending_companies_page(self, table_name: str, page_size: int = 100, cursor: Optional[str] = None) -> Dict:
+        self.__simulate('pending_page', self.query_latency)
+        pending = self.__pending()
+        after = decode_pending_cursor(cursor) if cursor else None
+        rows = [row for row in pending if after is None or (row['biz_name'], row['biz_identifier']) > after]
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_pending_cursor(rows[-1]['biz_name'], rows[-1]['biz_identifier'])
+        return {
+            'pending_companies': [{'rfc': row['biz_identifier'], 'company_name': row['biz_name']} for row in rows],
+            'total_pending': len(pending),
+            'next_cursor': next_cursor,
+        }
+
+    def iter_pending_companies(self, table_name: str, cursor: Optional[str] = None, page_size: int = 1000) -> Tuple[int, Iterator[Dict]]:
+        self.__simulate('pending_stream', self.query_latency)
+        pending = self.__pending()
+        after = decode_pending_cursor(cursor) if cursor else None
+        rows = (
+            {'rfc': row['biz_identifier'], 'company_name': row['biz_name'],
+             'cursor': encode_pending_cursor(row['biz_name'], row['biz_identifier'])}
+            for row in pending if after is None or (row['biz_name'], row['biz_identifier']) > after
+        )
+        return len(pending), rows
+
+    def verificar_empresa_scrapeada(self, biz_identifier: str, company_name: str, table_name: str) -> dict:
+        self.__simulate('verify_company', self.query_latency)
+        with self.__lock:
+            row = self.control.get(biz_identifier)
+        if row is None or row['biz_name'] != company_name:
+            return {'exists': False, 'needs_scraping': True, 'scraping_date': None, 'linkedin_found': None}
+        return {
+            'exists': False,
+            'needs_scraping': row['scrapping_d'] is None or row['contact_found_flg'] is None,
+            'scraping_date': row['scrapping_d'].isoformat() if row['scrapping_d'] else None,
+            'linkedin_found': row['contact_found_flg'],
+        }
+
+    def marcar_empresas_contacts_como_scrapeadas(self, contacts_results: List[Dict], companies_data: List[Dict],
+                                                 timeout: Optional[float] = None):
+        self.__simulate('merge_control', self.write_latency)
+        found = {contact['biz_identifier'] for contact in contacts_results}
+        with self.__lock:
+            for company in companies_data:
+                previous = self.control.get(company['biz_identifier']) or {}
+                contact_found = company['biz_identifier'] in found
+                self.control[company['biz_identifier']] = {
+                    'biz_identifier': company['biz_identifier'],
+                    'biz_name': company['biz_name'],
+                    'scrapping_d': date.today(),
+                    'contact_found_flg': contact_found,
+                    'no_contact_attempts': 0 if contact_found else (previous.get('no_contact_attempts') or 0) + 1,
+                }
+        for listener in self.__listeners:
+            listener([self.control[company['biz_identifier']] for company in companies_data])
+        return {'success': True, 'rows': len(companies_data)}
+
+    def save_contacts_to_bigquery(self, contacts_results, timeout: Optional[float] = None):
+        self.__simulate('merge_contacts', self.write_latency)
+        with self.__lock:
+            for contact in contacts_results:
+                self.contacts[(contact['biz_identifier'], contact['web_linkedin_url'])] = contact
+        return {'success': True, 'inserted': len(contacts_results), 'updated': 0}
@@ -0,0 +1,325 @@
+"""
+Servidores HTTP locales que imitan al Google Search Service y a la API de Apify
+(actor dev_fusion/linkedin-profile-scraper y datasets) para pruebas de carga sin costo.
+"""
+
+import gzip
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs, urlparse
+
+
+class Distribution:
+    """
+    Distribución configurable desde texto:
+        fixed:0.2            siempre 0.2
+        uniform:0.1:0.5      uniforme entre 0.1 y 0.5
+        normal:1.0:0.3       normal (media, desviación), recortada en 0
+        lognormal:0.0:0.5    lognormal (mu, sigma)
+    """
+
+    def __init__(self, spec: str) -> None:
+        self.spec = spec
+        kind, *params = spec.split(':')
+        self.__kind = kind
+        self.__params = [float(param) for param in params]
+        if kind not in ('fixed', 'uniform', 'normal', 'lognormal'):
+            raise ValueError(f"Distribución desconocida: {spec}")
+
+    def sample(self) -> float:
+        if self.__kind == 'fixed':
+            return self.__params[0]
+        if self.__kind == 'uniform':
+            return random.uniform(*self.__params)
+        if self.__kind == 'normal':
+            return max(0.0, random.gauss(*self.__params))
+        return random.lognormvariate(*self.__params)
+
+    def sample_int(self) -> int:
+        return max(0, int(round(self.sample())))
+
+
+class StageStats:
+    """Latencias y errores por etapa, compartidos entre los fakes y el driver de carga"""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__samples: Dict[str, List] = {}
+
+    def record(self, stage: str, seconds: float, ok: bool = True) -> None:
+        with self.__lock:
+            self.__samples.setdefault(stage, []).append((seconds, ok))
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__samples = {}
+
+    def snapshot(self) -> Dict[str, List]:
+        with self.__lock:
+            return {stage: list(samples) for stage, samples in self.__samples.items()}
+
+
+def _profile_item(url: str, company: Dict, padding_bytes: int) -> Dict:
+    slug = url.rstrip('/').rsplit('/', 1)[-1]
+    return {
+        'linkedinUrl': url,
+        'fullName': f"Persona {slug}",
+        'firstName': 'Persona',
+        'lastName': slug,
+        'email': f"{slug}@example.com",
+        'mobileNumber': '',
+        'headline': 'Director de Finanzas',
+        'jobTitle': 'CFO',
+        'companyName': company.get('biz_name', ''),
+        'companyIndustry': 'Financial Services',
+        'companyWebsite': 'example.com',
+        'companyLinkedin': 'linkedin.com/company/example',
+        'companyFoundedIn': '2010',
+        'companySize': '51-200',
+        'currentJobDuration': '3 yrs',
+        'currentJobDurationInYrs': '3',
+        'topSkillsByEndorsements': 'Finance',
+        'addressCountryOnly': 'Mexico',
+        'addressWithCountry': 'Ciudad de México, Mexico',
+        'about': 'x' * padding_bytes,
+    }
+
+
+class _FakeServer:
+    """Base: servidor HTTP en un hilo, en un puerto libre de 127.0.0.1"""
+
+    def __init__(self, handler_class) -> None:
+        fake = self
+
+        class Handler(handler_class):
+            server_fake = fake
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return json.loads(body or b'null')
+
+    def send_json(self, status: int, body, headers: Optional[Dict] = None) -> None:
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, str(value))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+class FakeSearchService(_FakeServer):
+    """Imita POST /search del Google Search Service: retorna perfiles evaluados por empresa"""
+
+    def __init__(self, stats: StageStats, latency: Distribution, profiles_per_company: Distribution,
+                 error_rate: float = 0.0) -> None:
+        self.stats = stats
+        self.latency = latency
+        self.profiles_per_company = profiles_per_company
+        self.error_rate = error_rate
+        super().__init__(_SearchHandler)
+
+    @property
+    def url(self) -> str:
+        return f"{self.base_url}/search"
+
+
+class _SearchHandler(_JsonHandler):
+    def do_POST(self):
+        fake = self.server_fake
+        start = time.time()
+        body = self.read_json() or {}
+        time.sleep(fake.latency.sample())
+
+        if random.random() < fake.error_rate:
+            fake.stats.record('search', time.time() - start, ok=False)
+            return self.send_json(500, {'error': 'fake search error'})
+
+        profiles = []
+        for company in body.get('companies', []):
+            for index in range(fake.profiles_per_company.sample_int()):
+                profiles.append({
+                    'biz_identifier': company.get('biz_identifier'),
+                    'biz_name': company.get('biz_name'),
+                    'web_linkedin_url': f"https://mx.linkedin.com/in/{company.get('biz_identifier', 'x').lower()}-{index}",
+                    'full_name': f"Persona {index}",
+                    'role': 'CFO',
+                    'ai_score_value': random.randint(1, 10),
+                    'ai_score_cat': 'alto',
+                    'ai_explanation': 'perfil financiero',
+                    'ai_current_biz_flg': True,
+                    'ai_role_finance_flg': True,
+                })
+        fake.stats.record('search', time.time() - start)
+        self.send_json(200, {'profiles': profiles})
+
+
+class FakeApify(_FakeServer):
+    """
+    Imita los endpoints de la API v2 de Apify que usa apify-client:
+        POST /v2/acts/{actor}/runs (o /v2/actors/...), GET /v2/actor-runs/{id},
+        POST /v2/actor-runs/{id}/abort,
+        GET /v2/datasets/{id}[/items]
+    """
+
+    def __init__(self, stats: StageStats, run_latency: Distribution, page_latency: Distribution,
+                 item_padding_bytes: Distribution, error_rate: float = 0.0) -> None:
+        self.stats = stats
+        self.run_latency = run_latency
+        self.page_latency = page_latency
+        self.item_padding_bytes = item_padding_bytes
+        self.error_rate = error_rate
+        self.lock = threading.Lock()
+        self.runs: Dict[str, Dict] = {}
+        self.datasets: Dict[str, List[Dict]] = {}
+        self.dataset_runs: Dict[str, Dict] = {}
+        super().__init__(_ApifyHandler)
+
+    def create_run(self, run_input: Dict) -> Dict:
+        run_id = uuid.uuid4().hex[:17]
+        dataset_id = uuid.uuid4().hex[:17]
+        failed = random.random() < self.error_rate
+        items = [] if failed else [
+            _profile_item(url, {}, self.item_padding_bytes.sample_int())
+            for url in run_input.get('profileUrls', [])
+        ]
+        run = {
+            'id': run_id,
+            'defaultDatasetId': dataset_id,
+            'status': 'RUNNING',
+            'final_status': 'FAILED' if failed else 'SUCCEEDED',
+            'started': time.time(),
+            'finishes_at': time.time() + self.run_latency.sample(),
+        }
+        with self.lock:
+            self.runs[run_id] = run
+            self.datasets[dataset_id] = items
+            self.dataset_runs[dataset_id] = run
+        return run
+
+    def visible_items(self, dataset_id: str) -> List[Dict]:
+        """Mientras el run corre, el dataset crece proporcionalmente al tiempo transcurrido"""
+        items = self.datasets[dataset_id]
+        run = self.dataset_runs.get(dataset_id)
+        if run is None or run['status'] == 'SUCCEEDED' or time.time() >= run['finishes_at']:
+            return items
+        progress = (time.time() - run['started']) / max(run['finishes_at'] - run['started'], 1e-6)
+        if run['status'] == 'ABORTED':
+            progress = (run.get('aborted_at', time.time()) - run['started']) / max(run['finishes_at'] - run['started'], 1e-6)
+        return items[:int(len(items) * min(1.0, progress))]
+
+    def run_view(self, run: Dict) -> Dict:
+        finished = time.time() >= run['finishes_at']
+        if finished and run['status'] == 'RUNNING':
+            run['status'] = run['final_status']
+            self.stats.record('apify_run', run['finishes_at'] - run['started'], ok=run['status'] == 'SUCCEEDED')
+        return {
+            'id': run['id'],
+            'actId': 'fake-actor',
+            'status': run['status'],
+            'defaultDatasetId': run['defaultDatasetId'],
+        }
+
+
+class _ApifyHandler(_JsonHandler):
+    def do_POST(self):
+        fake = self.server_fake
+        path = urlparse(self.path).path
+        if (path.startswith('/v2/acts/') or path.startswith('/v2/actors/')) and path.endswith('/runs'):
+            run = fake.create_run(self.read_json() or {})
+            return self.send_json(201, {'data': fake.run_view(run)})
+        parts = [part for part in path.split('/') if part]
+        if len(parts) == 4 and parts[:2] == ['v2', 'actor-runs'] and parts[3] == 'abort':
+            run = fake.runs.get(parts[2])
+            if run is None:
+                return self.send_json(404, {'error': {'type': 'record-not-found', 'message': parts[2]}})
+            if run['status'] == 'RUNNING':
+                run['status'] = 'ABORTED'
+                run['aborted_at'] = time.time()
+                fake.stats.record('apify_run', time.time() - run['started'], ok=False)
+            return self.send_json(200, {'data': fake.run_view(run)})
+        self.send_json(404, {'error': {'type': 'record-not-found', 'message': path}})
+
+    def do_GET(self):
+        fake = self.server_fake
+        parsed = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(parsed.query).items()}
+        parts = [part for part in parsed.path.split('/') if part]
+
+        if len(parts) == 3 and parts[:2] in (['v2', 'acts'], ['v2', 'actors']):
+            return self.send_json(200, {'data': {'id': parts[2], 'name': 'linkedin-profile-scraper'}})
+
+        if len(parts) == 4 and parts[:2] == ['v2', 'actor-runs'] and parts[3] == 'log':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if len(parts) == 3 and parts[:2] == ['v2', 'actor-runs']:
+            run = fake.runs.get(parts[2])
+            if run is None:
+                return self.send_json(404, {'error': {'type': 'record-not-found', 'message': parts[2]}})
+            wait_until = time.time() + float(query.get('waitForFinish', 0))
+            while run['status'] == 'RUNNING' and time.time() < min(wait_until, run['finishes_at']):
+                time.sleep(min(0.05, max(0.0, run['finishes_at'] - time.time())))
+            return self.send_json(200, {'data': fake.run_view(run)})
+
+        if len(parts) >= 3 and parts[:2] == ['v2', 'datasets']:
+            if parts[2] not in fake.datasets:
+                return self.send_json(404, {'error': {'type': 'record-not-found', 'message': parts[2]}})
+            items = fake.visible_items(parts[2])
+            if len(parts) == 3:
+                return self.send_json(200, {'data': {'id': parts[2], 'itemCount': len(items)}})
+
+            start = time.time()
+            time.sleep(fake.page_latency.sample())
+            offset = int(query.get('offset', 0))
+            limit = int(query.get('limit') or len(items) or 1)
+            page = items[offset:offset + limit]
+            fields = query.get('fields')
+            if fields:
+                wanted = fields.split(',')
+                page = [{field: item.get(field) for field in wanted if field in item} for item in page]
+            fake.stats.record('apify_dataset_page', time.time() - start)
+            return self.send_json(200, page, headers={
+                'X-Apify-Pagination-Total': len(items),
+                'X-Apify-Pagination-Offset': offset,
+                'X-Apify-Pagination-Limit': limit,
+                'X-Apify-Pagination-Count': len(page),
+                'X-Apify-Pagination-Desc': 'false',
+            })
+
+        self.send_json(404, {'error': {'type': 'record-not-found', 'message': parsed.path}})
@@ -0,0 +1,162 @@
+"""
+Prueba de carga end-to-end de /scrape y /validate contra stand-ins locales.
+
+Levanta un fake del Google Search Service, un fake de la API de Apify y un BigQueryService en
+memoria, arranca la API Flask en un puerto local apuntando a ellos y la ejercita con distintos
+niveles de concurrencia. Reporta throughput, latencias p50/p95/p99 y tasa de error por
+endpoint y por etapa (búsqueda, run del actor, páginas del dataset, operaciones de BigQuery).
+
+Uso (desde la raíz del repositorio, con requirements.txt instalado):
+    python loadtest/run_load_test.py --concurrency 1,4,16 --requests 200 --mix scrape=0.8,validate=0.2
+
+Con --cassette la búsqueda y Apify se reproducen desde un cassette grabado en producción
+(UPSTREAM_CASSETTE_MODE=record) en lugar de los fakes; --cassette-speed 0 las sirve sin esperas.
+Con --record-cassette se graba lo que responden los fakes.
+"""
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), 'src'))
+sys.path.insert(0, HERE)
+
+import requests  # noqa: E402
+
+from fake_upstreams import Distribution, FakeApify, FakeSearchService, StageStats  # noqa: E402
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,4,16', help='Niveles de concurrencia separados por coma')
+    parser.add_argument('--requests', type=int, default=100, help='Requests por nivel de concurrencia')
+    parser.add_argument('--mix', default='scrape=0.8,validate=0.2', help='Proporción de requests por endpoint')
+    parser.add_argument('--batch-size', type=int, default=2, help='batch_size enviado a /scrape')
+    parser.add_argument('--companies', type=int, default=100000, help='Empresas pendientes en el BigQuery falso')
+    parser.add_argument('--search-latency', default='lognormal:0.0:0.4', help='Latencia del search service (s)')
+    parser.add_argument('--search-error-rate', type=float, default=0.0)
+    parser.add_argument('--profiles-per-company', default='uniform:1:6', help='Perfiles devueltos por empresa')
+    parser.add_argument('--apify-run-latency', default='lognormal:1.5:0.4', help='Duración de un run del actor (s)')
+    parser.add_argument('--apify-page-latency', default='uniform:0.05:0.2', help='Latencia por página del dataset (s)')
+    parser.add_argument('--apify-error-rate', type=float, default=0.0, help='Fracción de runs que terminan FAILED')
+    parser.add_argument('--item-padding-bytes', default='uniform:500:4000', help='Bytes extra por item del dataset')
+    parser.add_argument('--bq-query-latency', default='uniform:0.5:1.5', help='Latencia de queries de BigQuery (s)')
+    parser.add_argument('--bq-write-latency', default='uniform:1.0:3.0', help='Latencia de cargas y MERGE (s)')
+    parser.add_argument('--cassette', help='Reproducir búsqueda y Apify desde este cassette (.jsonl.gz)')
+    parser.add_argument('--cassette-speed', type=float, default=1.0, help='1 = tiempos grabados, 0 = sin esperas')
+    parser.add_argument('--record-cassette', help='Grabar las respuestas de los fakes en este cassette')
+    return parser.parse_args()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def summarize(samples: Dict[str, List], elapsed: float) -> List[Dict]:
+    rows = []
+    for stage, values in sorted(samples.items()):
+        latencies = [seconds for seconds, _ in values]
+        errors = sum(1 for _, ok in values if not ok)
+        rows.append({
+            'stage': stage,
+            'count': len(values),
+            'throughput': len(values) / elapsed if elapsed else 0.0,
+            'p50': percentile(latencies, 50),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'error_rate': errors / len(values) if values else 0.0,
+        })
+    return rows
+
+
+def print_report(concurrency: int, elapsed: float, rows: List[Dict]) -> None:
+    print(f"\n=== Concurrencia {concurrency} — {elapsed:.1f}s ===")
+    print(f"{'etapa':<28}{'n':>7}{'req/s':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'error%':>9}")
+    for row in rows:
+        print(f"{row['stage']:<28}{row['count']:>7}{row['throughput']:>9.2f}"
+              f"{row['p50']:>9.3f}{row['p95']:>9.3f}{row['p99']:>9.3f}{row['error_rate'] * 100:>8.1f}%")
+
+
+def main():
+    args = parse_args()
+    stats = StageStats()
+
+    search = FakeSearchService(stats, Distribution(args.search_latency), Distribution(args.profiles_per_company),
+                               error_rate=args.search_error_rate).start()
+    apify = FakeApify(stats, Distribution(args.apify_run_latency), Distribution(args.apify_page_latency),
+                      Distribution(args.item_padding_bytes), error_rate=args.apify_error_rate).start()
+
+    # La configuración se lee al importar config.py, así que debe quedar lista antes de importar la API
+    os.environ['GOOGLE_SEARCH_SERVICE_URL'] = search.url
+    os.environ['APIFY_API_URL'] = apify.base_url
+    os.environ.setdefault('SERPER_API_KEY', 'fake-serper-key')
+    os.environ.setdefault('APIFY_TOKEN', 'fake-apify-token')
+    os.environ['WRITE_BEHIND_ENABLED'] = 'False'
+    os.environ.setdefault('PROFILE_SCORING_BACKEND', 'stub')
+    if args.cassette:
+        os.environ['UPSTREAM_CASSETTE_MODE'] = 'replay'
+        os.environ['UPSTREAM_CASSETTE_PATH'] = args.cassette
+        os.environ['UPSTREAM_CASSETTE_SPEED'] = str(args.cassette_speed)
+    elif args.record_cassette:
+        os.environ['UPSTREAM_CASSETTE_MODE'] = 'record'
+        os.environ['UPSTREAM_CASSETTE_PATH'] = args.record_cassette
+
+    from werkzeug.serving import make_server
+    from fake_bigquery import FakeBigQueryService
+    import main as api
+
+    api.bigquery_service = FakeBigQueryService(stats, Distribution(args.bq_query_latency),
+                                               Distribution(args.bq_write_latency), companies=args.companies)
+    server = make_server('127.0.0.1', 0, api.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = f"http://127.0.0.1:{server.server_port}"
+
+    mix = {}
+    for item in args.mix.split(','):
+        endpoint, weight = item.split('=')
+        mix[endpoint.strip()] = float(weight)
+    endpoints, weights = list(mix), list(mix.values())
+
+    def call(endpoint: str) -> None:
+        start = time.time()
+        ok = False
+        try:
+            if endpoint == 'scrape':
+                response = requests.post(f"{base_url}/scrape", json={'batch_size': args.batch_size}, timeout=600)
+            else:
+                response = requests.post(f"{base_url}/validate?page_size=100", timeout=600)
+            ok = response.status_code < 500 and 'error' not in response.text[:200]
+            if response.status_code == 503:
+                # Rechazada por control de admisión o circuito abierto (Retry-After)
+                stats.record(f"rejected./{endpoint}", time.time() - start, ok=False)
+        except Exception:
+            ok = False
+        stats.record(f"endpoint./{endpoint}", time.time() - start, ok=ok)
+
+    for level in [int(level) for level in args.concurrency.split(',')]:
+        stats.reset()
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            for _ in range(args.requests):
+                executor.submit(call, random.choices(endpoints, weights)[0])
+        elapsed = time.time() - start
+        print_report(level, elapsed, summarize(stats.snapshot(), elapsed))
+
+    server.shutdown()
+    api.shutdown_services()
+    search.stop()
+    apify.stop()
+
+
+if __name__ == '__main__':
+    main()
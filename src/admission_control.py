@@ -0,0 +1,79 @@
+import logging
+import threading
+import time
+from typing import Dict
+
+logger = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """El servicio está saturado; el cliente debe reintentar después de retry_after segundos"""
+
+    def __init__(self, reason: str, retry_after: float) -> None:
+        super().__init__(reason)
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    """
+    Control de admisión para un endpoint costoso.
+
+    Deja correr a la vez hasta max_in_flight requests; las siguientes esperan un lugar en una
+    cola de hasta max_queued requests, como máximo queue_timeout segundos. Si la cola está
+    llena o la espera se agota, la request se rechaza con AdmissionRejected en lugar de
+    acumular hilos esperando dependencias lentas.
+    """
+
+    def __init__(self, max_in_flight: int, max_queued: int = 0, queue_timeout: float = 0,
+                 retry_after: float = 5) -> None:
+        self.__max_in_flight = max(1, max_in_flight)
+        self.__max_queued = max(0, max_queued)
+        self.__queue_timeout = queue_timeout
+        self.__retry_after = retry_after
+        self.__condition = threading.Condition()
+        self.__in_flight = 0
+        self.__queued = 0
+        self.__stats = {'admitted': 0, 'rejected_queue_full': 0, 'rejected_timeout': 0, 'max_in_flight_seen': 0}
+
+    def acquire(self) -> None:
+        """Ocupa un lugar (esperando en la cola si hace falta) o lanza AdmissionRejected"""
+        with self.__condition:
+            if self.__in_flight >= self.__max_in_flight:
+                if self.__queued >= self.__max_queued:
+                    self.__stats['rejected_queue_full'] += 1
+                    raise AdmissionRejected(
+                        f"Servicio saturado: {self.__in_flight} requests en curso y {self.__queued} en cola",
+                        self.__retry_after
+                    )
+                self.__queued += 1
+                deadline = time.monotonic() + self.__queue_timeout
+                try:
+                    while self.__in_flight >= self.__max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.__stats['rejected_timeout'] += 1
+                            raise AdmissionRejected(
+                                f"Servicio saturado: sin lugar tras esperar {self.__queue_timeout:.0f}s",
+                                self.__retry_after
+                            )
+                        self.__condition.wait(remaining)
+                finally:
+                    self.__queued -= 1
+            self.__in_flight += 1
+            self.__stats['admitted'] += 1
+            self.__stats['max_in_flight_seen'] = max(self.__stats['max_in_flight_seen'], self.__in_flight)
+
+    def release(self) -> None:
+        with self.__condition:
+            self.__in_flight = max(0, self.__in_flight - 1)
+            self.__condition.notify()
+
+    def stats(self) -> Dict:
+        with self.__condition:
+            return {
+                **self.__stats,
+                'in_flight': self.__in_flight,
+                'queued': self.__queued,
+                'max_in_flight': self.__max_in_flight,
+                'max_queued': self.__max_queued,
+            }
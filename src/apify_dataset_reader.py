@@ -0,0 +1,96 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Dict, Iterator, List, Optional, Sequence
+
+from deadline import Deadline
+from tracing import current_trace_context, set_span_attributes, start_span
+
+logger = logging.getLogger(__name__)
+
+# Campos del item de dev_fusion/linkedin-profile-scraper que usa clean_scraped_data
+SCRAPED_PROFILE_FIELDS = (
+    'linkedinUrl', 'fullName', 'firstName', 'lastName', 'email', 'mobileNumber', 'headline', 'jobTitle',
+    'companyName', 'companyIndustry', 'companyWebsite', 'companyLinkedin', 'companyFoundedIn', 'companySize',
+    'currentJobDuration', 'currentJobDurationInYrs', 'topSkillsByEndorsements', 'addressCountryOnly',
+    'addressWithCountry',
+)
+
+
+class ParallelDatasetReader:
+    """
+    Lee un dataset de Apify por páginas en paralelo.
+
+    Primero consulta itemCount y después pide las páginas (offset/limit) con hasta max_workers
+    requests en vuelo, proyectando solo fields. Los items se entregan en el orden del dataset a
+    medida que llegan sus páginas, sin esperar a que termine la descarga completa.
+    """
+
+    def __init__(self, apify_client, page_size: int = 1000, max_workers: int = 4,
+                 fields: Optional[Sequence[str]] = SCRAPED_PROFILE_FIELDS) -> None:
+        self.__apify_client = apify_client
+        self.__page_size = max(1, page_size)
+        self.__max_workers = max(1, max_workers)
+        self.__fields = list(fields) if fields else None
+
+    def iter_items(self, dataset_id: str, deadline: Optional[Deadline] = None) -> Iterator[Dict]:
+        """
+        Genera los items del dataset en orden. Con deadline deja de esperar páginas cuando se
+        agota el tiempo (lo marca en el deadline) y termina con lo que ya se había entregado.
+        """
+        dataset = self.__apify_client.dataset(dataset_id)
+        info = dataset.get() or {}
+        item_count = info.get('itemCount')
+        if item_count is None:
+            # Sin conteo no se pueden repartir las páginas; se lee secuencialmente
+            logger.warning(f"⚠️ Dataset {dataset_id} sin itemCount, se lee secuencialmente")
+            yield from dataset.iterate_items(fields=self.__fields)
+            return
+
+        offsets = list(range(0, item_count, self.__page_size))
+        if not offsets:
+            return
+        start = time.time()
+        workers = min(self.__max_workers, len(offsets))
+
+        # Sin "with": al cortar por deadline no se espera a que terminen las páginas en vuelo
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="apify-dataset")
+        # Los hilos del pool no heredan el contexto: los spans de cada página cuelgan del actual
+        trace_parent = current_trace_context()
+        pending = deque()
+        next_page = 0
+        try:
+            while next_page < len(offsets) or pending:
+                # Ventana acotada: a lo más workers páginas pedidas y sin entregar
+                while next_page < len(offsets) and len(pending) < workers:
+                    pending.append(executor.submit(self.__fetch_page, dataset, offsets[next_page], trace_parent))
+                    next_page += 1
+                try:
+                    items = pending[0].result(timeout=self.__page_timeout(deadline))
+                except FutureTimeoutError:
+                    deadline.mark_exceeded()
+                    logger.warning(f"⏰ Tiempo agotado esperando páginas del dataset {dataset_id}")
+                    return
+                pending.popleft()
+                yield from items
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+        logger.info(f"📥 Dataset {dataset_id}: {item_count} items en {len(offsets)} páginas "
+                    f"({workers} en paralelo) en {time.time() - start:.2f}s")
+
+    @staticmethod
+    def __page_timeout(deadline: Optional[Deadline]) -> Optional[float]:
+        if deadline is None:
+            return None
+        # Si el run se cortó por el deadline, lo que alcanzó a guardar se lee a cuenta de la
+        # reserva de escritura, sin gastar más de la mitad de lo que queda de ella
+        return deadline.remaining() or deadline.remaining(include_reserve=True) / 2
+
+    def __fetch_page(self, dataset, offset: int, trace_parent=None) -> List[Dict]:
+        with start_span('apify.dataset_page', {'page.offset': offset, 'page.limit': self.__page_size},
+                        parent=trace_parent) as span:
+            items = dataset.list_items(offset=offset, limit=self.__page_size, fields=self.__fields).items
+            set_span_attributes(span, **{'items.count': len(items)})
+            return items
@@ -0,0 +1,402 @@
+"""
+Procesa desde la línea de comandos las empresas pendientes de la tabla de control, sin los
+límites de tiempo de una request HTTP.
+
+Toma las empresas con el mismo criterio que /scrape (nuevas primero y, con RESCRAPE_ENABLED,
+refrescos y reintentos), las procesa en lotes de --batch-size con --concurrency lotes a la vez
+y muestra el avance (empresas, contactos, empresas por minuto). Cada lote pasa por el mismo
+pipeline que /scrape: búsqueda, evaluación, selección, scraping y escritura en BigQuery. Los
+lotes no tienen tiempo límite salvo que se indique --timeout.
+
+Uso (desde src/):
+    python batch_runner.py --batch-size 5 --concurrency 3
+    python batch_runner.py --max-companies 1000 --state-file /tmp/backlog.json
+
+Ctrl+C (o SIGTERM) deja de tomar lotes nuevos y espera a que terminen los que están en curso;
+un segundo Ctrl+C sale sin esperar (sus empresas siguen pendientes). Los totales acumulados y
+las empresas que fallaron --max-attempts veces quedan en --state-file: al volver a ejecutar el
+comando se continúa donde quedó (las empresas terminadas ya no están pendientes) y las que
+fallaron se omiten hasta usar --retry-failed.
+
+Con COMPANY_LEASE_ENABLED las empresas se reservan en BigQuery antes de procesarlas, así que
+puede correr a la vez que /scrape (o que otro batch_runner) sin procesar una empresa dos veces.
+"""
+
+import argparse
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+from typing import Dict, List, Optional
+
+from config import Config
+from bigquery_services import BigQueryService
+from circuit_breaker import CircuitOpenError
+from company_prefetcher import PendingCompaniesPrefetcher, lease_owner
+from deadline import Deadline
+from linkedin_contacts_scrapper import LinkedInContactsSelectiveScraper
+from profile_scoring import ProfileScorer
+from profile_selection import TIE_BREAKERS
+from rescrape_scheduler import RescrapeScheduler
+from scrape_pipeline import iter_scrape_companies
+from upstream_cassette import close_upstream_cassette
+
+logger = logging.getLogger(__name__)
+
+TOTAL_FIELDS = ('batches', 'companies_done', 'companies_requeued', 'companies_failed', 'profiles_found',
+                'profiles_selected', 'profiles_scraped', 'contacts', 'apify_cost_usd', 'bigquery_bytes_billed',
+                'bigquery_cost_usd', 'elapsed_seconds')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-size', type=int, default=5, help='Empresas por lote')
+    parser.add_argument('--concurrency', type=int, default=2, help='Lotes procesándose a la vez')
+    parser.add_argument('--max-companies', type=int, default=0, help='Detenerse tras tomar N empresas (0 = todas)')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='Segundos máximos por lote (por defecto sin límite)')
+    parser.add_argument('--max-attempts', type=int, default=2,
+                        help='Intentos de una empresa (error o sin terminar) antes de omitirla')
+    parser.add_argument('--min-score', type=float, default=Config.SELECTION_MIN_SCORE)
+    parser.add_argument('--max-per-company', type=int, default=Config.SELECTION_MAX_PER_COMPANY)
+    parser.add_argument('--tie-breaker', choices=sorted(TIE_BREAKERS), default=Config.SELECTION_TIE_BREAKER)
+    parser.add_argument('--state-file', default='/tmp/linkedin_contacts_batch_state.json',
+                        help='Archivo con los totales acumulados y las empresas con error')
+    parser.add_argument('--reset', action='store_true', help='Ignorar el estado guardado y empezar de cero')
+    parser.add_argument('--retry-failed', action='store_true', help='Volver a intentar las empresas con error')
+    parser.add_argument('--progress-interval', type=float, default=15, help='Segundos entre líneas de avance')
+    parser.add_argument('--verbose', action='store_true', help='Logs INFO del pipeline')
+    return parser.parse_args()
+
+
+class BatchRunState:
+    """Totales acumulados entre ejecuciones y empresas omitidas por error, guardados en un archivo JSON"""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.runs = 0
+        self.started_at = datetime.now().isoformat()
+        self.totals: Dict[str, float] = {field: 0 for field in TOTAL_FIELDS}
+        self.failed: Dict[str, Dict] = {}
+        self.attempts: Dict[str, int] = {}
+
+    @classmethod
+    def load(cls, path: str, reset: bool = False) -> "BatchRunState":
+        state = cls(path)
+        if reset or not os.path.exists(path):
+            return state
+        with open(path, encoding='utf-8') as f:
+            saved = json.load(f)
+        state.runs = saved.get('runs', 0)
+        state.started_at = saved.get('started_at', state.started_at)
+        state.totals.update(saved.get('totals', {}))
+        state.failed = saved.get('failed', {})
+        return state
+
+    def save(self) -> None:
+        with self.lock:
+            data = {'runs': self.runs, 'started_at': self.started_at, 'updated_at': datetime.now().isoformat(),
+                    'totals': dict(self.totals), 'failed': dict(self.failed)}
+        # Escritura atómica: un corte a mitad no deja el archivo inválido
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(tmp_path, self.path)
+
+    def add(self, **amounts) -> None:
+        with self.lock:
+            for field, amount in amounts.items():
+                self.totals[field] += amount
+
+    def record_attempt(self, company: Dict, error: str, max_attempts: int) -> bool:
+        """Cuenta un intento fallido; retorna True si la empresa se omite a partir de ahora"""
+        key = PendingCompaniesPrefetcher.company_key(company)
+        with self.lock:
+            self.attempts[key] = self.attempts.get(key, 0) + 1
+            if self.attempts[key] < max_attempts:
+                return False
+            self.failed[key] = {'biz_name': company.get('biz_name'), 'error': error, 'attempts': self.attempts[key],
+                                'failed_at': datetime.now().isoformat()}
+            self.totals['companies_failed'] += 1
+            return True
+
+    def failed_keys(self) -> List[str]:
+        with self.lock:
+            return list(self.failed)
+
+
+class BatchRunner:
+    """Procesa lotes de empresas pendientes con varios hilos hasta vaciar la cola o recibir stop()"""
+
+    def __init__(self, bigquery_service: BigQueryService, state: BatchRunState, batch_size: int = 5,
+                 concurrency: int = 2, max_companies: int = 0, batch_timeout: Optional[float] = None,
+                 max_attempts: int = 2, selection: Optional[Dict] = None, scorer: Optional[ProfileScorer] = None) -> None:
+        self.__bigquery_service = bigquery_service
+        self.__state = state
+        self.__batch_size = max(1, batch_size)
+        self.__concurrency = max(1, concurrency)
+        self.__max_companies = max_companies
+        self.__batch_timeout = batch_timeout
+        self.__max_attempts = max(1, max_attempts)
+        self.__selection = selection
+        self.__scorer = scorer
+        self.__stop = threading.Event()
+        self.__lock = threading.Lock()
+        self.__acquired = 0
+        self.__in_flight = 0
+        self.__run = {field: 0 for field in TOTAL_FIELDS}
+        self.__started = time.time()
+
+        if Config.RESCRAPE_ENABLED:
+            pending_loader = RescrapeScheduler.from_config(bigquery_service).next_batch
+        else:
+            pending_loader = lambda limit, exclude: bigquery_service.load_companies_from_bigquery_linkedin_contacts(limit, exclude=exclude)
+        claimer = unclaimer = None
+        if Config.COMPANY_LEASE_ENABLED:
+            # Reservas compartidas con la API y otros runners: nadie toma las empresas de este proceso
+            owner = lease_owner()
+            claimer = lambda companies: bigquery_service.claim_companies(companies, owner, Config.COMPANY_LEASE_TTL)
+            unclaimer = lambda companies: bigquery_service.release_company_leases(companies, owner)
+        self.__prefetcher = PendingCompaniesPrefetcher(
+            # Las empresas con error no se vuelven a tomar en esta ejecución ni en las siguientes
+            loader=lambda limit, exclude: pending_loader(limit, list(exclude) + state.failed_keys()),
+            block_size=Config.PREFETCH_BLOCK_SIZE,
+            low_water_mark=max(Config.PREFETCH_LOW_WATER_MARK, self.__batch_size * self.__concurrency),
+            max_queue_size=Config.PREFETCH_MAX_QUEUE_SIZE,
+            completed_ttl=Config.PREFETCH_COMPLETED_TTL,
+            empty_backoff=Config.PREFETCH_EMPTY_BACKOFF,
+            claimer=claimer,
+            unclaimer=unclaimer,
+            lease_ttl=Config.COMPANY_LEASE_TTL,
+            # Sin --timeout un lote no tiene límite: BATCH_TIMEOUT estima cuánto reserva necesita
+            lease_margin=batch_timeout or Config.BATCH_TIMEOUT,
+            requeue_backoff=Config.PREFETCH_REQUEUE_BACKOFF,
+            # --max-attempts decide cuándo se omite una empresa; la cola no debe soltarla antes
+            max_requeues=max(Config.PREFETCH_MAX_REQUEUES, self.__max_attempts)
+        )
+
+    def stop(self) -> None:
+        self.__stop.set()
+
+    @property
+    def stopping(self) -> bool:
+        return self.__stop.is_set()
+
+    def run(self, progress_interval: float = 15, total_pending: Optional[int] = None) -> Dict:
+        """Procesa hasta vaciar la cola, llegar a max_companies o recibir stop(); retorna los totales de la ejecución"""
+        self.__prefetcher.start()
+        executor = ThreadPoolExecutor(max_workers=self.__concurrency, thread_name_prefix="batch-runner")
+        futures = [executor.submit(self.__worker) for _ in range(self.__concurrency)]
+        try:
+            while True:
+                done, pending = wait(futures, timeout=progress_interval)
+                self.print_progress(total_pending)
+                if not pending:
+                    break
+            for future in futures:
+                future.result()
+        finally:
+            executor.shutdown(wait=True)
+            self.__prefetcher.stop()
+        return self.run_totals()
+
+    def run_totals(self) -> Dict:
+        with self.__lock:
+            totals = dict(self.__run)
+        totals['elapsed_seconds'] = round(time.time() - self.__started, 1)
+        return totals
+
+    def print_progress(self, total_pending: Optional[int] = None) -> None:
+        totals = self.run_totals()
+        minutes = max(totals['elapsed_seconds'], 1) / 60
+        rate = totals['companies_done'] / minutes
+        line = (f"📊 {totals['companies_done']} empresas terminadas"
+                f"{f' de ~{total_pending} pendientes' if total_pending else ''}, "
+                f"{totals['contacts']} contactos, {self.__in_flight} lotes en curso, "
+                f"{rate:.1f} empresas/min, {totals['contacts'] / minutes:.1f} contactos/min")
+        if total_pending and rate > 0:
+            line += f", ETA {max(0, total_pending - totals['companies_done']) / rate:.0f} min"
+        print(line, flush=True)
+
+    def __take(self) -> List[Dict]:
+        with self.__lock:
+            count = self.__batch_size
+            if self.__max_companies:
+                count = min(count, self.__max_companies - self.__acquired)
+            if count <= 0:
+                return []
+        companies = self.__prefetcher.acquire(count, timeout=60)
+        with self.__lock:
+            self.__acquired += len(companies)
+            if companies:
+                self.__in_flight += 1
+        return companies
+
+    def __worker(self) -> None:
+        while not self.__stop.is_set():
+            companies = self.__take()
+            if not companies:
+                return
+            try:
+                self.__process(companies)
+            finally:
+                with self.__lock:
+                    self.__in_flight -= 1
+                self.__state.save()
+
+    def __process(self, companies: List[Dict]) -> None:
+        deadline = None
+        if self.__batch_timeout:
+            deadline = Deadline(self.__batch_timeout, write_reserve=Config.DEADLINE_WRITE_RESERVE)
+        scraper = LinkedInContactsSelectiveScraper(Config.SERPER_API_KEY, Config.APIFY_TOKEN)
+        batch_start = time.time()
+        try:
+            summary = {}
+            for kind, payload in iter_scrape_companies(self.__bigquery_service, scraper, companies,
+                                                       scorer=self.__scorer, selection=self.__selection,
+                                                       deadline=deadline):
+                if kind == 'summary':
+                    summary = payload
+        except CircuitOpenError as error:
+            # Dependencia degradada: el lote vuelve a la cola y el hilo espera a que el circuito se cierre
+            logger.warning(f"🔌 Lote interrumpido: {error}")
+            self.__prefetcher.release(companies, requeue=True)
+            self.__count(companies_requeued=len(companies))
+            self.__stop.wait(error.retry_after)
+            return
+        except Exception as error:
+            logger.error(f"❌ Error procesando lote: {error}")
+            self.__retry_or_skip(companies, f"{error}")
+            return
+
+        unfinished = set(summary['unfinished_companies'])
+        finished = [company for company in companies if company['biz_identifier'] not in unfinished]
+        self.__prefetcher.release(finished)
+        self.__retry_or_skip([company for company in companies if company['biz_identifier'] in unfinished],
+                             "Sin terminar (tiempo agotado o búsqueda fallida)")
+
+        usage = summary['bigquery_usage']
+        self.__count(batches=1, companies_done=len(finished), profiles_found=summary['profiles_found'],
+                     profiles_selected=summary['profiles_selected'], profiles_scraped=summary['profiles_scraped'],
+                     contacts=summary['contacts_count'], apify_cost_usd=scraper.test_metrics['cost_estimate'],
+                     bigquery_bytes_billed=usage['bytes_billed'], bigquery_cost_usd=usage['estimated_cost_usd'])
+        print(f"✅ Lote de {len(companies)} empresas en {time.time() - batch_start:.1f}s: "
+              f"{summary['contacts_count']} contactos, {len(unfinished)} sin terminar", flush=True)
+
+    def __retry_or_skip(self, companies: List[Dict], error: str) -> None:
+        if not companies:
+            return
+        retry = [company for company in companies if not self.__state.record_attempt(company, error, self.__max_attempts)]
+        skipped = [company for company in companies if company not in retry]
+        self.__prefetcher.release(retry, requeue=True)
+        self.__prefetcher.release(skipped)
+        self.__count(companies_requeued=len(retry), companies_failed=len(skipped))
+        if skipped:
+            logger.warning(f"⏭️ {len(skipped)} empresas omitidas tras {self.__max_attempts} intentos: "
+                           f"{[company['biz_identifier'] for company in skipped]}")
+
+    def __count(self, **amounts) -> None:
+        with self.__lock:
+            for field, amount in amounts.items():
+                self.__run[field] += amount
+        # companies_failed ya lo suma record_attempt en el estado acumulado
+        self.__state.add(**{field: amount for field, amount in amounts.items() if field != 'companies_failed'})
+
+
+def print_summary(run: Dict, state: BatchRunState) -> None:
+    minutes = max(run['elapsed_seconds'], 1) / 60
+    print("\n=== Resumen de la ejecución ===")
+    print(f"Lotes: {run['batches']} en {run['elapsed_seconds']:.0f}s ({run['companies_done'] / minutes:.1f} empresas/min)")
+    print(f"Empresas: {run['companies_done']} terminadas, {run['companies_requeued']} reintentadas, "
+          f"{run['companies_failed']} omitidas por error")
+    print(f"Perfiles: {run['profiles_found']} encontrados, {run['profiles_selected']} seleccionados, "
+          f"{run['profiles_scraped']} scrapeados")
+    print(f"Contactos: {run['contacts']}")
+    print(f"Costo estimado: Apify ${run['apify_cost_usd']:.2f}, BigQuery ${run['bigquery_cost_usd']:.4f} "
+          f"({run['bigquery_bytes_billed'] / 1024 ** 3:.2f} GiB facturados)")
+    totals = state.totals
+    print(f"\nAcumulado desde {state.started_at} ({state.runs} ejecuciones): {totals['companies_done']:.0f} empresas, "
+          f"{totals['contacts']:.0f} contactos, costo ${totals['apify_cost_usd'] + totals['bigquery_cost_usd']:.2f}, "
+          f"{len(state.failed)} empresas omitidas (ver {state.path})")
+
+
+def main() -> int:
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+
+    state = BatchRunState.load(args.state_file, reset=args.reset)
+    if args.retry_failed:
+        state.failed = {}
+    state.runs += 1
+
+    bigquery_service = BigQueryService(
+        project=Config.GOOGLE_CLOUD_PROJECT_ID,
+        dataset=Config.BIGQUERY_DATASET,
+        table_control_name=Config.CONTROL_TABLE_NAME,
+        table_info_name=Config.LINKEDIN_INFO_TABLE_NAME
+    )
+    if not bigquery_service.table_exists(Config.CONTROL_TABLE_NAME):
+        bigquery_service.crear_tabla_empresas_scrapeadas_linkedin_contacts()
+    if Config.CONTACTS_NORMALIZED:
+        bigquery_service.crear_tablas_contactos_normalizadas()
+    elif not bigquery_service.table_exists(Config.LINKEDIN_INFO_TABLE_NAME):
+        bigquery_service.crear_tabla_linkedin_contacts_info()
+    if Config.WRITE_BEHIND_ENABLED:
+        bigquery_service.enable_write_behind(max_rows=Config.WRITE_BEHIND_MAX_ROWS,
+                                             max_age_seconds=Config.WRITE_BEHIND_MAX_AGE,
+                                             max_retries=Config.WRITE_BEHIND_MAX_RETRIES,
+                                             retry_backoff=Config.WRITE_BEHIND_RETRY_BACKOFF)
+
+    total_pending = bigquery_service.get_pending_companies_count(Config.CONTROL_TABLE_NAME)
+    if args.max_companies:
+        total_pending = min(total_pending, args.max_companies) if total_pending else args.max_companies
+    print(f"🚀 Procesando ~{total_pending} empresas pendientes en lotes de {args.batch_size} "
+          f"({args.concurrency} a la vez); estado en {args.state_file}", flush=True)
+
+    runner = BatchRunner(
+        bigquery_service, state,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        max_companies=args.max_companies,
+        batch_timeout=args.timeout,
+        max_attempts=args.max_attempts,
+        selection={'min_score': args.min_score, 'max_per_company': args.max_per_company,
+                   'tie_breaker': args.tie_breaker},
+        scorer=ProfileScorer.from_config(quota_store=bigquery_service) if Config.PROFILE_SCORING_ENABLED else None
+    )
+
+    def handle_stop(signum, frame):
+        if runner.stopping:
+            print("\n⛔ Saliendo sin esperar los lotes en curso (sus empresas siguen pendientes)", flush=True)
+            state.add(elapsed_seconds=runner.run_totals()['elapsed_seconds'])
+            state.save()
+            # os._exit no pasa por los finally: el cassette en grabación se cierra aquí
+            close_upstream_cassette()
+            os._exit(130)
+        print("\n🛑 Deteniendo: se terminan los lotes en curso (Ctrl+C otra vez para salir ya)", flush=True)
+        runner.stop()
+
+    signal.signal(signal.SIGINT, handle_stop)
+    signal.signal(signal.SIGTERM, handle_stop)
+
+    try:
+        run = runner.run(progress_interval=args.progress_interval, total_pending=total_pending)
+    finally:
+        if bigquery_service.write_behind_enabled:
+            bigquery_service.close()
+        close_upstream_cassette()
+    state.add(elapsed_seconds=run['elapsed_seconds'])
+    state.save()
+    print_summary(run, state)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
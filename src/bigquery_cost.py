@@ -0,0 +1,147 @@
+"""
+Consumo y límites de las queries a BigQuery.
+
+QueryCostTracker acumula por operación (nombre lógico de la query: 'merge_contacts',
+'pending_page', ...) los jobs ejecutados, bytes procesados y facturados, slot-ms y aciertos de
+cache, y decide el tope de bytes facturados de cada job (maximum_bytes_billed). Con dry run
+previo, las queries cuya estimación supera el tope se rechazan con QueryCostExceeded sin
+ejecutarse.
+
+track_query_usage() suma además los jobs de un bloque (por ejemplo, las escrituras de una
+request de /scrape) para reportarlos en la respuesta.
+"""
+
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional
+
+from config import Config
+
+TIB = 1024 ** 4
+
+
+class QueryCostExceeded(Exception):
+    """La estimación (dry run) de una query supera el tope de bytes facturados de su operación"""
+
+    def __init__(self, operation: str, estimated_bytes: int, max_bytes: int) -> None:
+        super().__init__(f"La query {operation} procesaría {estimated_bytes} bytes (tope {max_bytes})")
+        self.operation = operation
+        self.estimated_bytes = estimated_bytes
+        self.max_bytes = max_bytes
+
+
+def parse_byte_caps(value: str) -> Dict[str, int]:
+    """Parsea 'operacion=bytes,operacion=bytes' (BIGQUERY_MAX_BYTES_BILLED_BY_OPERATION)"""
+    caps = {}
+    for part in (value or '').split(','):
+        if not part.strip():
+            continue
+        operation, _, max_bytes = part.partition('=')
+        try:
+            caps[operation.strip()] = int(max_bytes)
+        except ValueError:
+            raise ValueError(f"Tope de bytes inválido para '{operation.strip()}': {max_bytes!r}")
+    return caps
+
+
+def is_bytes_billed_limit_error(error: Exception) -> bool:
+    """True si BigQuery rechazó el job por superar maximum_bytes_billed"""
+    return any(detail.get('reason') == 'bytesBilledLimitExceeded' for detail in getattr(error, 'errors', None) or [])
+
+
+class QueryUsage:
+    """Totales de consumo de un conjunto de jobs"""
+
+    def __init__(self) -> None:
+        self.jobs = 0
+        self.bytes_processed = 0
+        self.bytes_billed = 0
+        self.slot_millis = 0
+        self.cache_hits = 0
+
+    def add(self, query_job) -> None:
+        self.jobs += 1
+        self.bytes_processed += query_job.total_bytes_processed or 0
+        self.bytes_billed += query_job.total_bytes_billed or 0
+        self.slot_millis += query_job.slot_millis or 0
+        self.cache_hits += 1 if query_job.cache_hit else 0
+
+    def stats(self) -> Dict:
+        return {
+            'jobs': self.jobs,
+            'bytes_processed': self.bytes_processed,
+            'bytes_billed': self.bytes_billed,
+            'slot_millis': self.slot_millis,
+            'cache_hits': self.cache_hits,
+            'estimated_cost_usd': round(self.bytes_billed / TIB * Config.BIGQUERY_PRICE_PER_TIB, 6),
+        }
+
+
+_current_usage: ContextVar[Optional[QueryUsage]] = ContextVar('bigquery_query_usage', default=None)
+
+
+@contextmanager
+def track_query_usage(usage: Optional[QueryUsage] = None) -> Iterator[QueryUsage]:
+    """Suma a usage los jobs ejecutados en este hilo mientras dura el bloque"""
+    usage = usage if usage is not None else QueryUsage()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+class QueryCostTracker:
+    """Consumo por operación y topes de bytes facturados (ver el docstring del módulo)"""
+
+    def __init__(self, max_bytes_billed: int = 0, caps_by_operation: Optional[Dict[str, int]] = None,
+                 dry_run_first: bool = False) -> None:
+        self.__max_bytes_billed = max_bytes_billed
+        self.__caps_by_operation = dict(caps_by_operation or {})
+        self.dry_run_first = dry_run_first
+        self.__lock = threading.Lock()
+        self.__usage: Dict[str, QueryUsage] = {}
+        self.__rejected: Dict[str, int] = {}
+        self.__dry_runs = 0
+
+    def max_bytes_for(self, operation: str) -> Optional[int]:
+        """Tope de bytes facturados de una operación (None = sin tope)"""
+        max_bytes = self.__caps_by_operation.get(operation, self.__max_bytes_billed)
+        return max_bytes if max_bytes and max_bytes > 0 else None
+
+    def record(self, operation: str, query_job) -> None:
+        with self.__lock:
+            self.__usage.setdefault(operation, QueryUsage()).add(query_job)
+        usage = _current_usage.get()
+        if usage is not None:
+            usage.add(query_job)
+
+    def record_dry_run(self) -> None:
+        with self.__lock:
+            self.__dry_runs += 1
+
+    def record_rejected(self, operation: str) -> None:
+        with self.__lock:
+            self.__rejected[operation] = self.__rejected.get(operation, 0) + 1
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            operations = {operation: usage.stats() for operation, usage in self.__usage.items()}
+            rejected = dict(self.__rejected)
+            dry_runs = self.__dry_runs
+        total = QueryUsage()
+        for usage in operations.values():
+            total.jobs += usage['jobs']
+            total.bytes_processed += usage['bytes_processed']
+            total.bytes_billed += usage['bytes_billed']
+            total.slot_millis += usage['slot_millis']
+            total.cache_hits += usage['cache_hits']
+        return {
+            'total': total.stats(),
+            'operations': operations,
+            'rejected': rejected,
+            'dry_runs': dry_runs,
+            'max_bytes_billed': self.__max_bytes_billed or None,
+            'max_bytes_billed_by_operation': dict(self.__caps_by_operation),
+        }
@@ -1,15 +1,98 @@
 from datetime import datetime, date
+from concurrent.futures import Future
+import base64
+import json
+import uuid
 import pandas as pd
-from typing import List, Dict
+from typing import Callable, List, Dict, Iterator, Optional, Tuple
 from logging import Logger
 import logging
 from google.cloud import bigquery
-from google.api_core.exceptions import NotFound
+from google.api_core.exceptions import ClientError, NotFound, TooManyRequests
 from pandas_gbq import to_gbq
 from config import Config
+from write_behind_buffer import WriteBehindBuffer
+from query_cache import QueryResultCache
+from circuit_breaker import CircuitOpenError, get_circuit_breaker
+from tracing import set_span_attributes, start_span
+from bigquery_cost import QueryCostExceeded, QueryCostTracker, is_bytes_billed_limit_error, parse_byte_caps
 
 logger: Logger = logging.getLogger(__name__)
 
+# Columnas de la empresa que trae cada contacto; en el modelo normalizado se guardan una vez por empresa
+COMPANY_COLUMNS = ['biz_name', 'biz_industry', 'biz_web_url', 'biz_web_linkedin_url', 'biz_founded_year', 'biz_size']
+# Columnas de la persona, en el orden de la tabla plana (biz_identifier y web_linkedin_url identifican el contacto)
+PERSON_COLUMNS = ['full_name', 'role', 'ai_score_value', 'web_linkedin_url', 'first_name', 'last_name', 'email',
+                  'phone_number', 'headline', 'current_job_duration', 'cntry_value', 'cntry_city_value',
+                  'src_scraped_dt', 'ai_explanation']
+# Tipos de la tabla plana original, que se conservan en el modelo normalizado (el resto son STRING)
+CONTACT_COLUMN_TYPES = {'ai_score_value': 'NUMERIC', 'src_scraped_dt': 'TIMESTAMP', 'updated_dt': 'TIMESTAMP'}
+
+
+def _column_type(column: str) -> str:
+    return CONTACT_COLUMN_TYPES.get(column, 'STRING')
+
+
+def _temp_schema(columns: List[str]) -> List[Dict]:
+    """
+    Schema explícito de la tabla temporal (evita que una columna toda nula se suba sin tipo).
+    Las columnas NUMERIC se suben como FLOAT desde pandas y el MERGE las convierte.
+    """
+    return [{'name': column, 'type': 'FLOAT' if _column_type(column) == 'NUMERIC' else _column_type(column)}
+            for column in columns]
+
+
+def _source_value(column: str) -> str:
+    """Columna de la tabla temporal en un MERGE, convertida al tipo de la tabla destino"""
+    if _column_type(column) == 'NUMERIC':
+        return f"CAST(source.{column} AS NUMERIC)"
+    return f"source.{column}"
+
+
+def _as_string(value) -> Optional[str]:
+    if pd.isna(value):
+        return None
+    # Un año leído junto a nulos llega como float (1999.0)
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def _normalize_columns(df: pd.DataFrame, columns: List[str]) -> pd.DataFrame:
+    """DataFrame con exactamente columns, con los valores convertidos al tipo de su columna"""
+    df = df.reindex(columns=columns)
+    for column in columns:
+        column_type = _column_type(column)
+        if column_type == 'STRING':
+            df[column] = df[column].map(_as_string)
+        elif column_type == 'NUMERIC':
+            df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+def encode_pending_cursor(biz_name: str, biz_identifier: str) -> str:
+    """Codifica la llave (biz_name, biz_identifier) de la última fila de una página como cursor opaco"""
+    raw = json.dumps([biz_name, biz_identifier], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_pending_cursor(cursor: str) -> Tuple[str, str]:
+    """
+    Decodifica un cursor generado por encode_pending_cursor
+
+    Raises:
+        ValueError: Si el cursor no es válido
+    """
+    try:
+        padding = "=" * (-len(cursor) % 4)
+        biz_name, biz_identifier = json.loads(base64.urlsafe_b64decode(cursor + padding).decode("utf-8"))
+    except Exception as e:
+        raise ValueError(f"Cursor inválido: {cursor}") from e
+    if not isinstance(biz_name, str) or not isinstance(biz_identifier, str):
+        raise ValueError(f"Cursor inválido: {cursor}")
+    return biz_name, biz_identifier
+
+
 class BigQueryService:
 
     def __init__(self, project:str, dataset:str, table_control_name:str, table_info_name:str) -> None:
@@ -18,7 +101,149 @@ class BigQueryService:
         self.__table_control_name = table_control_name
         self.__table_info_name = table_info_name
         self.__bq_client = bigquery.Client(project=self.__project_id) 
-            
+        self.__write_buffer: Optional[WriteBehindBuffer] = None
+        self.__query_cache: Optional[QueryResultCache] = None
+        self.__control_schema_checked = False
+        self.__idempotency_table_checked = False
+        self.__model_quota_table_checked = False
+        self.__company_lease_table_checked = False
+        self.__contacts_model_checked = False
+        self.__control_write_listeners: List[Callable[[Optional[List[Dict]]], None]] = []
+        self.__query_costs = QueryCostTracker(
+            max_bytes_billed=Config.BIGQUERY_MAX_BYTES_BILLED,
+            caps_by_operation=parse_byte_caps(Config.BIGQUERY_MAX_BYTES_BILLED_BY_OPERATION),
+            dry_run_first=Config.BIGQUERY_DRY_RUN_FIRST
+        )
+        if Config.QUERY_CACHE_ENABLED:
+            self.__query_cache = QueryResultCache(
+                max_entries=Config.QUERY_CACHE_MAX_ENTRIES,
+                ttl_seconds=Config.QUERY_CACHE_TTL
+            )
+
+    def _query_rows(self, query: str, query_parameters: Optional[List] = None, cached: bool = False,
+                    operation: str = 'query') -> List:
+        """
+        Ejecuta una query y retorna sus filas.
+        Con cached=True el resultado se guarda por SQL + parámetros hasta que expira o hasta que
+        este proceso escribe en la tabla de control.
+        """
+        def _run() -> List:
+            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters or [])
+            _, result = self._run_query_job(query, job_config, operation=operation)
+            return list(result)
+
+        if not cached or self.__query_cache is None:
+            return _run()
+        key = (query, tuple(json.dumps(param.to_api_repr(), sort_keys=True, default=str)
+                            for param in query_parameters or []))
+        return self.__query_cache.get_or_load(key, _run)
+
+    def _run_query_job(self, query: str, job_config: Optional[bigquery.QueryJobConfig] = None,
+                       operation: str = 'query', span_attributes: Optional[Dict] = None,
+                       page_size: Optional[int] = None):
+        """
+        Ejecuta un job de query dentro del circuit breaker de BigQuery y espera su resultado.
+        Retorna (job, resultado). Los errores del cliente (SQL inválido, tabla inexistente) no
+        cuentan como falla del servicio; sí los 5xx, las cuotas (429) y los timeouts.
+
+        Todas las queries del servicio pasan por aquí: el job lleva el maximum_bytes_billed de
+        su operación (BIGQUERY_MAX_BYTES_BILLED*), sus bytes, slot-ms y aciertos de cache se
+        acumulan por operación (query_cost_stats) y queda en un span bigquery.<operation>.
+        Con BIGQUERY_DRY_RUN_FIRST se estima antes y, si supera el tope, lanza QueryCostExceeded
+        sin ejecutarla.
+        """
+        job_config = job_config or bigquery.QueryJobConfig()
+        max_bytes = self.__query_costs.max_bytes_for(operation)
+        if max_bytes is not None and job_config.maximum_bytes_billed is None:
+            job_config.maximum_bytes_billed = max_bytes
+
+        breaker = get_circuit_breaker('bigquery')
+        breaker.before_call()
+        with start_span(f'bigquery.{operation}', {'db.system': 'bigquery', **(span_attributes or {})}) as span:
+            try:
+                if self.__query_costs.dry_run_first and max_bytes is not None:
+                    self._dry_run_query(query, job_config, operation, max_bytes)
+                query_job = self.__bq_client.query(query, job_config=job_config)
+                result = query_job.result(page_size=page_size)
+            except QueryCostExceeded:
+                breaker.record_success()
+                raise
+            except ClientError as e:
+                if is_bytes_billed_limit_error(e):
+                    self.__query_costs.record_rejected(operation)
+                    logger.error(f"💸 Query {operation} rechazada: supera el tope de {max_bytes} bytes facturados")
+                if isinstance(e, TooManyRequests):
+                    breaker.record_failure()
+                else:
+                    breaker.record_success()
+                raise
+            except Exception:
+                breaker.record_failure()
+                raise
+            breaker.record_success()
+            self.__query_costs.record(operation, query_job)
+            set_span_attributes(span, **{
+                'bigquery.job_id': query_job.job_id,
+                'bigquery.statement_type': query_job.statement_type,
+                'bigquery.bytes_processed': query_job.total_bytes_processed,
+                'bigquery.bytes_billed': query_job.total_bytes_billed,
+                'bigquery.slot_millis': query_job.slot_millis,
+                'bigquery.cache_hit': query_job.cache_hit,
+                'bigquery.dml_affected_rows': query_job.num_dml_affected_rows,
+            })
+        return query_job, result
+
+    def _dry_run_query(self, query: str, job_config: bigquery.QueryJobConfig, operation: str, max_bytes: int) -> None:
+        """Estima los bytes de una query sin ejecutarla; lanza QueryCostExceeded si superan max_bytes"""
+        dry_run_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False,
+                                                 query_parameters=job_config.query_parameters)
+        estimated_bytes = self.__bq_client.query(query, job_config=dry_run_config).total_bytes_processed or 0
+        self.__query_costs.record_dry_run()
+        if estimated_bytes > max_bytes:
+            self.__query_costs.record_rejected(operation)
+            logger.error(f"💸 Query {operation} no ejecutada: procesaría {estimated_bytes} bytes (tope {max_bytes})")
+            raise QueryCostExceeded(operation, estimated_bytes, max_bytes)
+
+    def query_cost_stats(self) -> Dict:
+        """Consumo acumulado de BigQuery por operación desde que inició el proceso"""
+        return self.__query_costs.stats()
+
+    def _load_temp_table(self, df: pd.DataFrame, destination: str, location: str, table_schema=None) -> None:
+        """Sube un DataFrame a una tabla temporal (reemplazándola) para un MERGE"""
+        with start_span('bigquery.load_temp_table', {'db.system': 'bigquery', 'bigquery.table': destination,
+                                                      'rows.count': len(df)}):
+            df.to_gbq(
+                destination_table=destination,
+                project_id=self.__project_id,
+                if_exists='replace',
+                table_schema=table_schema,
+                location=location,
+                progress_bar=False
+            )
+
+    def add_control_write_listener(self, listener: Callable[[Optional[List[Dict]]], None]) -> None:
+        """
+        Registra una función que se llama tras cada escritura de este proceso en la tabla de
+        control, con las filas escritas o None si el cambio no es fila a fila (tabla recreada
+        o deduplicada)
+        """
+        self.__control_write_listeners.append(listener)
+
+    def _on_control_table_written(self, rows: Optional[List[Dict]] = None) -> None:
+        """Descarta los resultados en cache y avisa a los listeners: la tabla de control cambió"""
+        if self.__query_cache is not None:
+            self.__query_cache.invalidate()
+        for listener in self.__control_write_listeners:
+            try:
+                listener(rows)
+            except Exception as e:
+                logger.warning(f"⚠️ Error notificando escritura en tabla de control: {e}")
+
+    def query_cache_stats(self) -> Optional[Dict]:
+        if self.__query_cache is None:
+            return None
+        return self.__query_cache.stats()
+
 
     def table_exists(self, table_id:str) -> bool:
         """Verifica si la tabla existe"""
@@ -43,7 +268,9 @@ class BigQueryService:
             bigquery.SchemaField("biz_identifier", "STRING", mode="REQUIRED"),
             bigquery.SchemaField("biz_name", "STRING", mode="REQUIRED"),
             bigquery.SchemaField("scrapping_d", "TIMESTAMP", mode="REQUIRED"),
-            bigquery.SchemaField("contact_found_flg", "BOOLEAN", mode="REQUIRED")
+            bigquery.SchemaField("contact_found_flg", "BOOLEAN", mode="REQUIRED"),
+            # Veces consecutivas que la empresa se scrapeó sin encontrar contactos
+            bigquery.SchemaField("no_contact_attempts", "INT64", mode="NULLABLE")
         ]
 
         # Crear referencia a la tabla
@@ -64,6 +291,19 @@ class BigQueryService:
             logger.info(f"✅ Tabla de control {dataset_id}.{table_id} creada exitosamente con schema correcto")
         except Exception as e:
             logger.error(f"❌ Error creando tabla: {e}")
+        finally:
+            self._on_control_table_written()
+
+    def _ensure_control_columns(self) -> None:
+        """Agrega a una tabla de control existente las columnas que se sumaron después de crearla"""
+        if self.__control_schema_checked:
+            return
+        table = f'{self.__project_id}.{self.__dataset}.{Config.CONTROL_TABLE_NAME}'
+        self._run_query_job(
+            f"ALTER TABLE `{table}` ADD COLUMN IF NOT EXISTS no_contact_attempts INT64",
+            operation='alter_control'
+        )
+        self.__control_schema_checked = True
 
     def crear_tabla_linkedin_contacts_info(self):
         """Crea la tabla linkedin_contacts_info si no existe"""
@@ -110,6 +350,119 @@ class BigQueryService:
             table = client.create_table(table)
             logger.info(f"✅ Tabla de datos {dataset_id}.{table_id} creada exitosamente")
 
+    def crear_tablas_contactos_normalizadas(self) -> None:
+        """
+        Crea (una vez por proceso) las tablas del modelo normalizado: personas por contacto y empresas
+        por biz_identifier. La vista con la forma plana toma el nombre de la tabla plana
+        (LINKEDIN_INFO_TABLE_NAME) si está libre; si la tabla plana existe todavía, la reemplaza
+        migrar_contactos_a_modelo_normalizado.
+        """
+        if self.__contacts_model_checked:
+            return
+        persons = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_PERSONS_TABLE_NAME}'
+        companies = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_COMPANIES_TABLE_NAME}'
+        view = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_INFO_TABLE_NAME}'
+
+        def column_definitions(columns: List[str]) -> str:
+            return ',\n                '.join(f"{column} {_column_type(column)}" for column in columns)
+
+        # Agrupadas por biz_identifier: los MERGE y los filtros por empresa leen solo los bloques de esas empresas
+        self._run_query_job(f"""
+            CREATE TABLE IF NOT EXISTS `{persons}` (
+                biz_identifier STRING,
+                {column_definitions(PERSON_COLUMNS)}
+            )
+            CLUSTER BY biz_identifier
+        """, operation='contacts_model')
+        self._run_query_job(f"""
+            CREATE TABLE IF NOT EXISTS `{companies}` (
+                biz_identifier STRING NOT NULL,
+                {column_definitions(COMPANY_COLUMNS + ['updated_dt'])}
+            )
+            CLUSTER BY biz_identifier
+        """, operation='contacts_model')
+        self._run_query_job(f"""
+            CREATE VIEW IF NOT EXISTS `{view}` AS
+            {self._contacts_view_query()}
+        """, operation='contacts_model')
+        if self.__bq_client.get_table(view).table_type != 'VIEW':
+            logger.warning(f"⚠️ {view} sigue siendo la tabla plana y no recibe los contactos nuevos: "
+                           f"ejecutar migrar_contactos_a_modelo_normalizado")
+        self.__contacts_model_checked = True
+        logger.info(f"✅ Modelo normalizado de contactos listo ({persons}, {companies})")
+
+    def _contacts_view_query(self) -> str:
+        """SELECT con la forma (columnas y tipos) de la tabla plana sobre el modelo normalizado"""
+        persons = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_PERSONS_TABLE_NAME}'
+        companies = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_COMPANIES_TABLE_NAME}'
+        flat_columns = ', '.join(['persons.biz_identifier'] + [f'companies.{column}' for column in COMPANY_COLUMNS]
+                                 + [f'persons.{column}' for column in PERSON_COLUMNS])
+        return f"""SELECT {flat_columns}
+            FROM `{persons}` AS persons
+            LEFT JOIN `{companies}` AS companies ON companies.biz_identifier = persons.biz_identifier"""
+
+    def migrar_contactos_a_modelo_normalizado(self) -> Dict:
+        """
+        Copia la tabla plana LINKEDIN_INFO_TABLE_NAME al modelo normalizado (de cada empresa, los
+        datos de su contacto más reciente), la renombra a LINKEDIN_INFO_BACKUP_TABLE_NAME y crea en
+        su lugar la vista con la forma plana, así las consultas existentes siguen viendo todos los
+        contactos. Solo inserta lo que falta; si la tabla plana ya es la vista no hace nada.
+        """
+        self.crear_tablas_contactos_normalizadas()
+        legacy = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_INFO_TABLE_NAME}'
+        persons = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_PERSONS_TABLE_NAME}'
+        companies = f'{self.__project_id}.{self.__dataset}.{Config.LINKEDIN_COMPANIES_TABLE_NAME}'
+
+        if self.__bq_client.get_table(legacy).table_type == 'VIEW':
+            logger.info(f"✅ {legacy} ya es la vista del modelo normalizado, no hay nada que migrar")
+            return {'companies': 0, 'persons': 0}
+
+        def casted(columns: List[str]) -> str:
+            return ', '.join(f"CAST({column} AS {_column_type(column)}) AS {column}" for column in columns)
+
+        company_columns = ['biz_identifier'] + COMPANY_COLUMNS + ['updated_dt']
+        companies_job, _ = self._run_query_job(f"""
+            MERGE `{companies}` AS target
+            USING (
+                SELECT biz_identifier, {casted(COMPANY_COLUMNS)}, src_scraped_dt AS updated_dt
+                FROM `{legacy}`
+                WHERE biz_identifier IS NOT NULL
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY biz_identifier ORDER BY src_scraped_dt DESC) = 1
+            ) AS source
+            ON target.biz_identifier = source.biz_identifier
+            WHEN NOT MATCHED THEN
+                INSERT ({', '.join(company_columns)})
+                VALUES ({', '.join(f'source.{column}' for column in company_columns)})
+        """, operation='migrate_companies')
+
+        person_columns = ['biz_identifier'] + PERSON_COLUMNS
+        persons_job, _ = self._run_query_job(f"""
+            MERGE `{persons}` AS target
+            USING (
+                SELECT biz_identifier, {casted(PERSON_COLUMNS)}
+                FROM `{legacy}`
+                QUALIFY ROW_NUMBER() OVER (PARTITION BY biz_identifier, web_linkedin_url ORDER BY src_scraped_dt DESC) = 1
+            ) AS source
+            ON target.biz_identifier = source.biz_identifier
+            AND target.web_linkedin_url = source.web_linkedin_url
+            WHEN NOT MATCHED THEN
+                INSERT ({', '.join(person_columns)})
+                VALUES ({', '.join(f'source.{column}' for column in person_columns)})
+        """, operation='migrate_persons')
+
+        # La tabla plana queda como respaldo y su nombre pasa a la vista
+        self._run_query_job(f"ALTER TABLE `{legacy}` RENAME TO `{Config.LINKEDIN_INFO_BACKUP_TABLE_NAME}`",
+                            operation='migrate_rename')
+        self._run_query_job(f"""
+            CREATE OR REPLACE VIEW `{legacy}` AS
+            {self._contacts_view_query()}
+        """, operation='migrate_view')
+
+        result = {'companies': companies_job.num_dml_affected_rows, 'persons': persons_job.num_dml_affected_rows}
+        logger.info(f"✅ Contactos migrados al modelo normalizado: {result}; tabla plana respaldada en "
+                    f"{Config.LINKEDIN_INFO_BACKUP_TABLE_NAME} y reemplazada por la vista {legacy}")
+        return result
+
     def verificar_empresa_scrapeada(self, biz_identifier: str, company_name: str, table_name: str) -> dict:
         """
         Verifica si una empresa ya fue scrapeada en la tabla de control
@@ -132,15 +485,10 @@ class BigQueryService:
             LIMIT 1
             """
             
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("biz_identifier", "STRING", biz_identifier),
-                    bigquery.ScalarQueryParameter("company_name", "STRING", company_name),
-                ]
-            )
-            
-            query_job = self.__bq_client.query(query, job_config=job_config)
-            results = list(query_job.result())
+            results = self._query_rows(query, [
+                bigquery.ScalarQueryParameter("biz_identifier", "STRING", biz_identifier),
+                bigquery.ScalarQueryParameter("company_name", "STRING", company_name),
+            ], cached=True, operation='company_status')
             
             if results:
                 # El registro existe
@@ -178,113 +526,302 @@ class BigQueryService:
 
 
 # esta muy acoplado a scraper
-    def marcar_empresas_contacts_como_scrapeadas(self, contacts_results: List[Dict], companies_data: List[Dict]):
-        """Marca las empresas como scrapeadas en la tabla empresas_scrapeadas_linkedin_contacts"""
-
-        table_id = Config.CONTROL_TABLE_NAME
-        location = Config.BIGQUERY_LOCATION
-        # Preparar datos para insertar
-        datos_insertar = []
-        logger.info(f"Contacts results en empresas scrapeadas: {contacts_results}")
-
+    def build_control_rows(self, contacts_results: List[Dict], companies_data: List[Dict]) -> List[Dict]:
+        """Arma las filas de la tabla de control para un lote de empresas scrapeadas"""
         biz_names = map(lambda x: x['biz_identifier'], contacts_results)
         biz_names = set(biz_names)
-        
-        datos_insertar = []
-        date_actual = date.today()
 
-        for company in companies_data:
-            datos_insertar.append({
-                **company,
+        date_actual = date.today()
+        return [
+            {
+                'biz_identifier': company['biz_identifier'],
+                'biz_name': company['biz_name'],
                 'scrapping_d': date_actual,
                 'contact_found_flg': company['biz_identifier'] in biz_names
-            })
+            }
+            for company in companies_data
+        ]
 
-        # Convertir a DataFrame
-        if datos_insertar != []:
-            df_datos_insertar = pd.DataFrame(datos_insertar)
-            df_datos_insertar.to_gbq(
-                    destination_table=f'{self.__project_id}.{self.__dataset}.{table_id}',
-                    project_id=self.__project_id,
-                    if_exists='append',
-                    table_schema=None,
-                    location=location,
-                )
+    def marcar_empresas_contacts_como_scrapeadas(self, contacts_results: List[Dict], companies_data: List[Dict],
+                                                 timeout: Optional[float] = None):
+        """
+        Marca las empresas como scrapeadas en la tabla empresas_scrapeadas_linkedin_contacts.
+        timeout: segundos máximos del MERGE; BigQuery cancela el job si se pasa
+        """
 
-            # Limpia duplicados de la tabla de control
-            result_clean_duplicates = self.clean_duplicates_from_control_table(Config.CONTROL_TABLE_NAME)
-            logger.info(f"✅ Limpieza de duplicados en la tabla de control: {result_clean_duplicates}")
+        logger.info(f"Contacts results en empresas scrapeadas: {contacts_results}")
+
+        datos_insertar = self.build_control_rows(contacts_results, companies_data)
 
-            return result_clean_duplicates
+        if datos_insertar != []:
+            return self._merge_control_rows(datos_insertar, timeout=timeout)
         else:
             logger.warning("⚠️ No hay datos para marcar como scrapeadas")
             return None
 
+    def _temp_table_name(self, table_name: str) -> str:
+        return f"temp_{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}"
+
+    @staticmethod
+    def _job_config(timeout: Optional[float] = None, **kwargs) -> bigquery.QueryJobConfig:
+        """QueryJobConfig con job_timeout_ms si se indica un timeout (BigQuery cancela el job al vencer)"""
+        if timeout is not None:
+            kwargs['job_timeout_ms'] = max(1000, int(timeout * 1000))
+        return bigquery.QueryJobConfig(**kwargs)
+
+    def _merge_control_rows(self, rows: List[Dict], timeout: Optional[float] = None) -> Dict:
+        """
+        Escribe filas en la tabla de control con un solo MERGE por biz_identifier.
+        Si una empresa aparece más de una vez en el lote se conserva la última fila.
+        """
+        table_id = Config.CONTROL_TABLE_NAME
+        location = Config.BIGQUERY_LOCATION
+        destination_table = f'{self.__project_id}.{self.__dataset}.{table_id}'
+        temp_destination = f'{self.__project_id}.{self.__dataset}.{self._temp_table_name(table_id)}'
+
+        latest_rows = {row['biz_identifier']: row for row in rows}
+        df_rows = pd.DataFrame(list(latest_rows.values()))
+        df_rows['scrapping_d'] = pd.to_datetime(df_rows['scrapping_d']).dt.tz_localize('UTC')
+
+        # Sin subir la tabla temporal si BigQuery está degradado
+        get_circuit_breaker('bigquery').check()
+        self._ensure_control_columns()
+        try:
+            self._load_temp_table(df_rows, temp_destination, location, table_schema=[
+                {'name': 'biz_identifier', 'type': 'STRING'},
+                {'name': 'biz_name', 'type': 'STRING'},
+                {'name': 'scrapping_d', 'type': 'TIMESTAMP'},
+                {'name': 'contact_found_flg', 'type': 'BOOLEAN'},
+            ])
+
+            merge_query = f"""
+                MERGE `{destination_table}` AS target
+                USING `{temp_destination}` AS source
+                ON target.biz_identifier = source.biz_identifier
+                WHEN MATCHED THEN
+                    UPDATE SET
+                        biz_name = source.biz_name,
+                        scrapping_d = source.scrapping_d,
+                        contact_found_flg = source.contact_found_flg,
+                        no_contact_attempts = IF(source.contact_found_flg, 0, COALESCE(target.no_contact_attempts, 0) + 1)
+                WHEN NOT MATCHED THEN
+                    INSERT (biz_identifier, biz_name, scrapping_d, contact_found_flg, no_contact_attempts)
+                    VALUES (source.biz_identifier, source.biz_name, source.scrapping_d, source.contact_found_flg,
+                            IF(source.contact_found_flg, 0, 1))
+            """
+            query_job, _ = self._run_query_job(merge_query, self._job_config(timeout), operation='merge_control',
+                                               span_attributes={'companies.count': len(df_rows)})
+            affected = query_job.num_dml_affected_rows
+            self._on_control_table_written(list(latest_rows.values()))
+
+            logger.info(f"✅ {len(df_rows)} empresas marcadas en la tabla de control ({affected} filas afectadas)")
+            return {
+                "success": True,
+                "rows": len(df_rows),
+                "affected": affected,
+                "destination_table": destination_table
+            }
+        finally:
+            try:
+                self.__bq_client.delete_table(temp_destination, not_found_ok=True)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo eliminar tabla temporal {temp_destination}: {e}")
+
+    def _prepare_contacts_dataframe(self, contacts_results: List[Dict]) -> pd.DataFrame:
+        """Convierte contactos a DataFrame limpio para BigQuery, sin repetir (biz_identifier, web_linkedin_url)"""
+        df_contacts = pd.DataFrame(contacts_results)
+        # Acoplado a scraper
+        if df_contacts.empty:
+            return df_contacts
+
+        # Limpiar datos para BigQuery
+        logger.info("🔧 Aplicando limpieza para BigQuery...")
+
+        #   Limpiar campos de texto
+        text_fields = ['biz_identifier', 'biz_name', 'full_name', 'role',
+                    'web_linkedin_url', 'src_scraped_data']
+
+        for field in text_fields:
+            if field in df_contacts.columns:
+                df_contacts[field] = df_contacts[field].fillna('').astype(str)
+                df_contacts[field] = df_contacts[field].str.replace('\x00', '', regex=False)
+
+        if 'src_scraped_dt' in df_contacts.columns:
+            df_contacts['src_scraped_dt'] = pd.to_datetime(df_contacts['src_scraped_dt']).dt.tz_localize('UTC')
+
+        # El MERGE falla si dos filas de origen coinciden con la misma fila destino
+        return df_contacts.drop_duplicates(subset=['biz_identifier', 'web_linkedin_url'], keep='last')
+
+    def _write_contacts(self, contacts_results: List[Dict], timeout: Optional[float] = None):
+        """Escribe contactos con upsert; a diferencia de save_contacts_to_bigquery propaga los errores"""
+        df_contacts = self._prepare_contacts_dataframe(contacts_results)
+        if df_contacts.empty:
+            logger.warning("⚠️ No hay contactos para subir a BigQuery")
+            return None
+        if not Config.CONTACTS_NORMALIZED:
+            return self._process_contacts_chunk_with_upsert(df_contacts, Config.LINKEDIN_INFO_TABLE_NAME,
+                                                            Config.BIGQUERY_LOCATION, timeout=timeout)
+
+        # Los datos de la empresa se escriben una vez por empresa y los contactos llevan solo la persona
+        self.crear_tablas_contactos_normalizadas()
+        self._merge_company_rows(df_contacts, timeout=timeout)
+        person_columns = ['biz_identifier'] + PERSON_COLUMNS
+        return self._process_contacts_chunk_with_upsert(_normalize_columns(df_contacts, person_columns),
+                                                        Config.LINKEDIN_PERSONS_TABLE_NAME, Config.BIGQUERY_LOCATION,
+                                                        timeout=timeout, columns=PERSON_COLUMNS,
+                                                        table_schema=_temp_schema(person_columns))
+
+    def _merge_company_rows(self, df_contacts: pd.DataFrame, timeout: Optional[float] = None) -> Dict:
+        """
+        Upsert de la tabla de empresas con una fila por biz_identifier (por columna, el último valor
+        no nulo de sus contactos). Solo se reescriben las empresas cuyos datos cambiaron y un valor
+        nulo no borra el guardado.
+        """
+        table_id = Config.LINKEDIN_COMPANIES_TABLE_NAME
+        destination_table = f'{self.__project_id}.{self.__dataset}.{table_id}'
+        temp_destination = f'{self.__project_id}.{self.__dataset}.{self._temp_table_name(table_id)}'
+
+        company_columns = [column for column in COMPANY_COLUMNS if column in df_contacts.columns]
+        df_companies = df_contacts.groupby('biz_identifier', sort=False)[company_columns].last().reset_index()
+        df_companies['updated_dt'] = pd.Timestamp.now(tz='UTC')
+        columns = ['biz_identifier'] + COMPANY_COLUMNS + ['updated_dt']
+        df_companies = _normalize_columns(df_companies, columns)
+
+        get_circuit_breaker('bigquery').check()
+        try:
+            self._load_temp_table(df_companies, temp_destination, Config.BIGQUERY_LOCATION,
+                                  table_schema=_temp_schema(columns))
+            changed = ' OR '.join(f"target.{column} IS DISTINCT FROM COALESCE(source.{column}, target.{column})"
+                                  for column in COMPANY_COLUMNS)
+            updates = ',\n                        '.join(f"{column} = COALESCE(source.{column}, target.{column})"
+                                                   for column in COMPANY_COLUMNS)
+            merge_query = f"""
+                MERGE `{destination_table}` AS target
+                USING `{temp_destination}` AS source
+                ON target.biz_identifier = source.biz_identifier
+                WHEN MATCHED AND ({changed}) THEN
+                    UPDATE SET
+                        {updates},
+                        updated_dt = source.updated_dt
+                WHEN NOT MATCHED THEN
+                    INSERT ({', '.join(columns)})
+                    VALUES ({', '.join(f'source.{column}' for column in columns)})
+            """
+            query_job, _ = self._run_query_job(merge_query, self._job_config(timeout), operation='merge_companies',
+                                               span_attributes={'companies.count': len(df_companies)})
+            affected = query_job.num_dml_affected_rows
+            logger.info(f"✅ {len(df_companies)} empresas en la tabla de empresas ({affected} filas escritas)")
+            return {"success": True, "rows": len(df_companies), "affected": affected}
+        finally:
+            try:
+                self.__bq_client.delete_table(temp_destination, not_found_ok=True)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo eliminar tabla temporal {temp_destination}: {e}")
 
-    def save_contacts_to_bigquery(self,contacts_results):
-        """Guardar contactos en la tabla linkedin_contacts_info"""
+    def save_contacts_to_bigquery(self,contacts_results, timeout: Optional[float] = None):
+        """Guardar contactos en la tabla linkedin_contacts_info (timeout: segundos máximos del MERGE)"""
         if not contacts_results:
             logger.warning(f"⚠️ No hay contactos para guardar")
             return None
-        location = Config.BIGQUERY_LOCATION
-       
+
         # Subir a BigQuery
         try:
-            df_contacts = pd.DataFrame(contacts_results)
-        # Acoplado a scraper
-            if not df_contacts.empty:
-                # Limpiar datos para BigQuery
-                logger.info("🔧 Aplicando limpieza para BigQuery...")
-
-                #   Limpiar campos de texto
-                text_fields = ['biz_identifier', 'biz_name', 'full_name', 'role',
-                            'web_linkedin_url', 'src_scraped_data']
-
-                for field in text_fields:
-                    if field in df_contacts.columns:
-                        df_contacts[field] = df_contacts[field].fillna('').astype(str)
-                        df_contacts[field] = df_contacts[field].str.replace('\x00', '', regex=False)
-
-                if 'src_scraped_dt' in df_contacts.columns:
-                    df_contacts['src_scraped_dt'] = pd.to_datetime(df_contacts['src_scraped_dt']).dt.tz_localize('UTC')
-#
-                table_id = Config.LINKEDIN_INFO_TABLE_NAME
-                
-
-                return self._process_contacts_chunk_with_upsert(df_contacts, table_id, location)
-            else:
-                logger.warning("⚠️ No hay contactos para subir a BigQuery")
-                return None
+            return self._write_contacts(contacts_results, timeout=timeout)
         except Exception as e:
             logger.error(f"❌ Error subiendo contactos a BigQuery: {e}")
             return None
 
+    def enable_write_behind(self, max_rows: int, max_age_seconds: float, max_retries: int = 3,
+                            retry_backoff: float = 2) -> None:
+        """
+        Activa el buffer de escritura diferida: las filas de control y de contactos de todas las
+        requests se acumulan y se escriben con un MERGE por tabla (un MERGE fallido se reintenta
+        max_retries veces antes de descartar sus filas)
+        """
+        if self.__write_buffer is None:
+            self.__write_buffer = WriteBehindBuffer(
+                flushers={
+                    'control': self._merge_control_rows,
+                    'contacts': self._write_contacts,
+                },
+                max_rows=max_rows,
+                max_age_seconds=max_age_seconds,
+                max_retries=max_retries,
+                retry_backoff=retry_backoff
+            )
+            logger.info(f"✅ Buffer de escritura diferida activo (max_rows={max_rows}, max_age={max_age_seconds}s)")
+
+    @property
+    def write_behind_enabled(self) -> bool:
+        return self.__write_buffer is not None
 
-    def load_companies_from_bigquery_linkedin_contacts(self , limit: int = 1) -> List[Dict]:
-        """Ejecuta query en BigQuery y extrae nombres de empresa y biz_identifier - CON CONTROL DE DUPLICADOS PARA CONTACTS"""
+    def enqueue_companies_as_scraped(self, contacts_results: List[Dict], companies_data: List[Dict],
+                                     wait: bool = False) -> Future:
+        """
+        Encola el marcado de empresas scrapeadas; el Future se resuelve cuando queda escrito
+        (wait: se va a esperar el Future, el MERGE se hace en cuanto se pueda)
+        """
+        return self.__write_buffer.enqueue('control', self.build_control_rows(contacts_results, companies_data),
+                                           urgent=wait)
 
+    def enqueue_contacts(self, contacts_results: List[Dict], wait: bool = False) -> Future:
+        """Encola contactos para el próximo MERGE; el Future se resuelve cuando quedan escritos"""
+        return self.__write_buffer.enqueue('contacts', contacts_results, urgent=wait)
 
-        query = f"""
-        SELECT biz_name, biz_identifier FROM `{self.__project_id}.{self.__dataset}.{Config.CONTROL_TABLE_NAME}`
-        WHERE (contact_found_flg = FALSE or contact_found_flg is null) AND scrapping_d is null limit {limit}
+    def flush_writes(self) -> None:
+        """Escribe de inmediato todas las filas pendientes del buffer de escritura diferida"""
+        if self.__write_buffer is not None:
+            self.__write_buffer.flush()
+
+    def close(self) -> None:
+        """Vacía y detiene el buffer de escritura diferida (usar al apagar el servicio)"""
+        if self.__write_buffer is not None:
+            self.__write_buffer.close()
+            self.__write_buffer = None
+
+    def write_behind_stats(self) -> Optional[Dict]:
+        if self.__write_buffer is None:
+            return None
+        return self.__write_buffer.stats()
+
+    def load_companies_from_bigquery_linkedin_contacts(self , limit: int = 1, exclude: Optional[List[str]] = None) -> List[Dict]:
+        """
+        Ejecuta query en BigQuery y extrae nombres de empresa y biz_identifier - CON CONTROL DE DUPLICADOS PARA CONTACTS
+
+        Args:
+            limit: Número máximo de empresas a retornar
+            exclude: biz_identifier que no deben retornarse (por ejemplo, empresas ya en proceso)
         """
-        logger.info(f"🔍 Query: {query}")
+
+        exclude_filter = ""
+        query_parameters = [bigquery.ScalarQueryParameter("limit", "INT64", limit)]
+        if exclude:
+            exclude_filter = "AND biz_identifier NOT IN UNNEST(@exclude)"
+            query_parameters.append(bigquery.ArrayQueryParameter("exclude", "STRING", list(exclude)))
+
         try:
-            client = self.__bq_client
-            results = client.query(query).to_dataframe()
-        
-            # Extraer nombres y biz_identifier, limpiar valores nulos
-            companies = []
-            for _, row in results.iterrows():
-                if pd.notna(row['biz_name']) and str(row['biz_name']).strip():
-                    companies.append({
-                        'biz_name': str(row['biz_name']).strip(),
-                        'biz_identifier': str(row['biz_identifier']).strip() if pd.notna(row['biz_identifier']) else None
-                    })
+            query = f"""
+            SELECT biz_name, biz_identifier FROM `{self.__project_id}.{self.__dataset}.{Config.CONTROL_TABLE_NAME}`
+            WHERE (contact_found_flg = FALSE or contact_found_flg is null) AND scrapping_d is null
+            AND biz_name IS NOT NULL AND TRIM(biz_name) != ''
+            {exclude_filter}
+            {self._company_lease_filter()}
+            limit @limit
+            """
+            logger.info(f"🔍 Query: {query}")
+            job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+            _, results = self._run_query_job(query, job_config, operation='load_companies')
 
-            total_filtradas = len(companies)
+            # Extraer nombres y biz_identifier directamente de las filas, sin pasar por un DataFrame
+            companies = [
+                {
+                    'biz_name': row.biz_name.strip(),
+                    'biz_identifier': row.biz_identifier.strip() if row.biz_identifier is not None else None
+                }
+                for row in results
+            ]
 
-            # Limpia duplicados de la tabla de contro
+            total_filtradas = len(companies)
 
             logger.info(f"✅ Query ejecutada exitosamente")
             logger.info(f"📊 Empresas SIN scrappear contactos en LinkedIn: {total_filtradas}")
@@ -296,35 +833,135 @@ class BigQueryService:
             logger.error("💡 Verifica que las tablas existan y tengas permisos")
             return []
 
-    def _process_contacts_chunk_with_upsert(self, df_chunk,  table_name, location):
+    def rank_companies_for_scraping(self, limit: int, exclude: Optional[List[str]] = None,
+                                    refresh_days: float = 90, retry_base_days: float = 14,
+                                    retry_max_days: float = 180, max_no_contact_attempts: int = 5,
+                                    refresh_weight: float = 1.0, retry_weight: float = 0.5) -> List[Dict]:
+        """
+        Retorna las empresas que más conviene scrapear, en orden de prioridad:
+
+        - never: nunca scrapeadas; van siempre primero, por biz_name
+        - refresh: con contactos y scrapeadas hace más de refresh_days
+        - retry: sin contactos; se reintentan tras retry_base_days * 2^(intentos - 1) días
+          (tope retry_max_days) y se descartan tras max_no_contact_attempts intentos
+
+        Entre refresh y retry la prioridad es el peso por el atraso relativo (antigüedad / espera),
+        dividido por el número de intentos fallidos en el caso de retry.
+
+        Returns:
+            Lista de {'biz_name', 'biz_identifier', 'reason', 'priority'}
+        """
+        exclude_filter = ""
+        query_parameters = [
+            bigquery.ScalarQueryParameter("limit", "INT64", limit),
+            bigquery.ScalarQueryParameter("refresh_days", "FLOAT64", refresh_days),
+            bigquery.ScalarQueryParameter("retry_base_days", "FLOAT64", retry_base_days),
+            bigquery.ScalarQueryParameter("retry_max_days", "FLOAT64", retry_max_days),
+            bigquery.ScalarQueryParameter("max_attempts", "INT64", max_no_contact_attempts),
+            bigquery.ScalarQueryParameter("refresh_weight", "FLOAT64", refresh_weight),
+            bigquery.ScalarQueryParameter("retry_weight", "FLOAT64", retry_weight),
+        ]
+        if exclude:
+            exclude_filter = "AND biz_identifier NOT IN UNNEST(@exclude)"
+            query_parameters.append(bigquery.ArrayQueryParameter("exclude", "STRING", list(exclude)))
+
+        try:
+            lease_filter = self._company_lease_filter()
+        except Exception as e:
+            logger.error(f"❌ Error priorizando empresas para scraping: {e}")
+            return []
+
+        query = f"""
+        WITH candidates AS (
+            SELECT
+                biz_name,
+                biz_identifier,
+                CASE
+                    WHEN scrapping_d IS NULL OR contact_found_flg IS NULL THEN 'never'
+                    WHEN contact_found_flg THEN 'refresh'
+                    ELSE 'retry'
+                END AS reason,
+                TIMESTAMP_DIFF(CURRENT_TIMESTAMP(), scrapping_d, HOUR) / 24 AS age_days,
+                GREATEST(COALESCE(no_contact_attempts, 0), 1) AS attempts
+            FROM `{self.__project_id}.{self.__dataset}.{Config.CONTROL_TABLE_NAME}`
+            WHERE biz_name IS NOT NULL AND TRIM(biz_name) != ''
+            {exclude_filter}
+            {lease_filter}
+        ),
+        scheduled AS (
+            SELECT
+                *,
+                CASE reason
+                    WHEN 'refresh' THEN @refresh_days
+                    WHEN 'retry' THEN LEAST(@retry_base_days * POW(2, attempts - 1), @retry_max_days)
+                END AS wait_days
+            FROM candidates
+        )
+        SELECT
+            biz_name,
+            biz_identifier,
+            reason,
+            CASE reason
+                WHEN 'never' THEN NULL
+                WHEN 'refresh' THEN @refresh_weight * age_days / @refresh_days
+                ELSE @retry_weight * age_days / wait_days / attempts
+            END AS priority
+        FROM scheduled
+        WHERE reason = 'never'
+           OR (reason = 'refresh' AND age_days >= wait_days)
+           OR (reason = 'retry' AND age_days >= wait_days AND attempts < @max_attempts)
+        ORDER BY reason != 'never', priority DESC, biz_name, biz_identifier
+        LIMIT @limit
+        """
+        try:
+            self._ensure_control_columns()
+            results = self._query_rows(query, query_parameters, operation='rank_companies')
+        except Exception as e:
+            logger.error(f"❌ Error priorizando empresas para scraping: {e}")
+            return []
+
+        companies = [
+            {
+                'biz_name': row.biz_name.strip(),
+                'biz_identifier': row.biz_identifier.strip() if row.biz_identifier is not None else None,
+                'reason': row.reason,
+                'priority': row.priority,
+            }
+            for row in results
+        ]
+        logger.info(f"📊 Empresas priorizadas para scraping: {len(companies)}")
+        return companies
+
+    def _process_contacts_chunk_with_upsert(self, df_chunk,  table_name, location, timeout: Optional[float] = None,
+                                            columns: Optional[List[str]] = None, table_schema=None):
         """
         Procesa un chunk de datos implementando lógica de upsert.
         Retorna (insertados, actualizados)
         #Location : US
 
+        columns: columnas que escribe el MERGE además de biz_identifier (por defecto las de la tabla plana)
         """
+        columns = columns or COMPANY_COLUMNS + PERSON_COLUMNS
 
         destination_table = f'{self.__project_id}.{self.__dataset}.{table_name}'
         success = False
         inserted = 0
         updated = 0
-        
+
+        # Sin subir la tabla temporal si BigQuery está degradado
+        get_circuit_breaker('bigquery').check()
         try:
             # Crear tabla temporal para el merge
-            temp_table_name = f"temp_{table_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            temp_table_name = self._temp_table_name(table_name)
             temp_destination = f'{self.__project_id}.{self.__dataset}.{temp_table_name}'
             
             # Insertar datos en tabla temporal
-            df_chunk.to_gbq(
-                destination_table=temp_destination,
-                project_id=self.__project_id,
-                if_exists='replace',
-                table_schema=None,
-                location=location,
-                progress_bar=False
-            )
+            self._load_temp_table(df_chunk, temp_destination, location, table_schema=table_schema)
             
             # Query de MERGE para upsert
+            insert_columns = ['biz_identifier'] + columns
+            updates = ',\n                        '.join(f"{column} = {_source_value(column)}"
+                                                   for column in columns if column != 'web_linkedin_url')
             merge_query = f"""
                 MERGE `{destination_table}` AS target
                 USING `{temp_destination}` AS source
@@ -332,76 +969,15 @@ class BigQueryService:
                 AND target.web_linkedin_url = source.web_linkedin_url
                 WHEN MATCHED THEN
                     UPDATE SET
-                        biz_name = source.biz_name,
-                        biz_industry = source.biz_industry,
-                        biz_web_url = source.biz_web_url,
-                        biz_web_linkedin_url = source.biz_web_linkedin_url,
-                        biz_founded_year = source.biz_founded_year,
-                        biz_size = source.biz_size,
-                        full_name = source.full_name,
-                        role = source.role,
-                        ai_score_value = source.ai_score_value,
-                        first_name = source.first_name,
-                        last_name = source.last_name,
-                        email = source.email,
-                        phone_number = source.phone_number,
-                        headline = source.headline,
-                        current_job_duration = source.current_job_duration,
-                        cntry_value = source.cntry_value,
-                        cntry_city_value = source.cntry_city_value,
-                        src_scraped_dt = source.src_scraped_dt,
-                        ai_explanation = source.ai_explanation
+                        {updates}
                 WHEN NOT MATCHED THEN
-                    INSERT (
-                        biz_identifier,
-                        biz_name,
-                        biz_industry,
-                        biz_web_url,
-                        biz_web_linkedin_url,
-                        biz_founded_year,
-                        biz_size,
-                        full_name,
-                        role,
-                        ai_score_value,
-                        web_linkedin_url,
-                        first_name,
-                        last_name,
-                        email,
-                        phone_number,
-                        headline,
-                        current_job_duration,
-                        cntry_value,
-                        cntry_city_value,
-                        src_scraped_dt,
-                        ai_explanation
-                    )
-                    VALUES (
-                        source.biz_identifier,
-                        source.biz_name,
-                        source.biz_industry,
-                        source.biz_web_url,
-                        source.biz_web_linkedin_url,
-                        source.biz_founded_year,
-                        source.biz_size,
-                        source.full_name,
-                        source.role,
-                        source.ai_score_value,
-                        source.web_linkedin_url,
-                        source.first_name,
-                        source.last_name,
-                        source.email,
-                        source.phone_number,
-                        source.headline,
-                        source.current_job_duration,
-                        source.cntry_value,
-                        source.cntry_city_value,
-                        source.src_scraped_dt,
-                        source.ai_explanation
-                    );
-            """            
+                    INSERT ({', '.join(insert_columns)})
+                    VALUES ({', '.join(_source_value(column) for column in insert_columns)});
+            """
             # Ejecutar merge
-            query_job = self.__bq_client.query(merge_query)
-            result = query_job.result()
+            query_job, result = self._run_query_job(merge_query, self._job_config(timeout), operation='merge_contacts',
+                                                    span_attributes={'contacts.count': len(df_chunk),
+                                                                     'companies.count': df_chunk['biz_identifier'].nunique()})
             # Obtener estadísticas del merge
             if hasattr(result, 'num_dml_affected_rows'):
                 # Para versiones más recientes de BigQuery
@@ -409,8 +985,8 @@ class BigQueryService:
             else:
                 # Fallback: contar registros en tabla temporal
                 count_query = f"SELECT COUNT(*) as count FROM `{temp_destination}`"
-                count_job = self.__bq_client.query(count_query)
-                count_result = list(count_job.result())
+                _, count_result = self._run_query_job(count_query, operation='count_temp_contacts')
+                count_result = list(count_result)
                 total_records = count_result[0].count if count_result else 0
                 
                 # Asumir que la mayoría son actualizaciones si la tabla ya tiene datos
@@ -425,7 +1001,14 @@ class BigQueryService:
                 logger.warning(f"⚠️ No se pudo eliminar tabla temporal {temp_destination}: {e}")
             
             return {"success": success, "inserted": inserted, "updated": updated}
-            
+
+        except CircuitOpenError:
+            # BigQuery degradado: el fallback con append también fallaría
+            try:
+                self.__bq_client.delete_table(temp_destination, not_found_ok=True)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo eliminar tabla temporal {temp_destination}: {e}")
+            raise
         except Exception as e:
             logger.error(f"❌ Error en upsert: {e}")
             try:
@@ -476,14 +1059,9 @@ class BigQueryService:
             LIMIT @limit
             """
             
-            job_config = bigquery.QueryJobConfig(
-                query_parameters=[
-                    bigquery.ScalarQueryParameter("limit", "INT64", limit),
-                ]
-            )
-            
-            query_job = self.__bq_client.query(query, job_config=job_config)
-            results = list(query_job.result())
+            results = self._query_rows(query, [
+                bigquery.ScalarQueryParameter("limit", "INT64", limit),
+            ], cached=True, operation='pending_companies')
             
             # Convertir resultados a lista de diccionarios
             pending_companies = []
@@ -521,8 +1099,7 @@ class BigQueryService:
             WHERE scrapping_d IS NULL OR contact_found_flg IS NULL
             """
             
-            query_job = self.__bq_client.query(query)
-            results = list(query_job.result())
+            results = self._query_rows(query, cached=True, operation='pending_count')
             
             if results:
                 return results[0].pending_count
@@ -533,6 +1110,375 @@ class BigQueryService:
             logger.error(f"❌ Error contando empresas pendientes: {e}")
             return 0
 
+    def _pending_companies_query(self, table_name: str, after: Optional[Tuple[str, str]], with_limit: bool) -> Tuple[str, List]:
+        """
+        Construye la query keyset de empresas pendientes ordenadas por (biz_name, biz_identifier).
+        El total de pendientes se calcula en la misma query para no hacer un segundo escaneo.
+        """
+        keyset_filter = ""
+        query_parameters = []
+        if after is not None:
+            keyset_filter = """
+                WHERE biz_name > @after_name
+                   OR (biz_name = @after_name AND biz_identifier > @after_identifier)
+            """
+            query_parameters += [
+                bigquery.ScalarQueryParameter("after_name", "STRING", after[0]),
+                bigquery.ScalarQueryParameter("after_identifier", "STRING", after[1]),
+            ]
+
+        limit_clause = ""
+        if with_limit:
+            limit_clause = "LIMIT @limit"
+
+        query = f"""
+        WITH pending AS (
+            SELECT biz_identifier, biz_name
+            FROM `{self.__project_id}.{self.__dataset}.{table_name}`
+            WHERE scrapping_d IS NULL OR contact_found_flg IS NULL
+        ),
+        page AS (
+            SELECT biz_identifier, biz_name
+            FROM pending
+            {keyset_filter}
+            ORDER BY biz_name, biz_identifier
+            {limit_clause}
+        )
+        SELECT total.total_pending, page.biz_identifier, page.biz_name
+        FROM (SELECT COUNT(*) AS total_pending FROM pending) AS total
+        LEFT JOIN page ON TRUE
+        ORDER BY page.biz_name, page.biz_identifier
+        """
+        return query, query_parameters
+
+    def get_pending_companies_page(self, table_name: str, page_size: int = 100, cursor: Optional[str] = None) -> Dict:
+        """
+        Obtiene una página de empresas pendientes de scraping y el total de pendientes en una sola query
+
+        Args:
+            table_name: Nombre de la tabla de control
+            page_size: Número de empresas por página
+            cursor: Cursor devuelto por la página anterior (None para la primera página)
+
+        Returns:
+            {
+                'pending_companies': [{'rfc': str, 'company_name': str}],
+                'total_pending': int,
+                'next_cursor': str or None
+            }
+
+        Raises:
+            ValueError: Si el cursor no es válido
+        """
+        after = decode_pending_cursor(cursor) if cursor else None
+        query, query_parameters = self._pending_companies_query(table_name, after, with_limit=True)
+        # Se pide una fila extra para saber si existe una página siguiente
+        query_parameters.append(bigquery.ScalarQueryParameter("limit", "INT64", page_size + 1))
+
+        try:
+            results = self._query_rows(query, query_parameters, cached=True, operation='pending_page')
+        except Exception as e:
+            logger.error(f"❌ Error obteniendo página de empresas pendientes: {e}")
+            return {'pending_companies': [], 'total_pending': 0, 'next_cursor': None}
+
+        total_pending = results[0].total_pending if results else 0
+        rows = [row for row in results if row.biz_identifier is not None]
+
+        next_cursor = None
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            next_cursor = encode_pending_cursor(rows[-1].biz_name, rows[-1].biz_identifier)
+
+        pending_companies = [
+            {'rfc': row.biz_identifier, 'company_name': row.biz_name}
+            for row in rows
+        ]
+        logger.info(f"✅ Página con {len(pending_companies)} empresas pendientes de {total_pending} en total")
+        return {
+            'pending_companies': pending_companies,
+            'total_pending': total_pending,
+            'next_cursor': next_cursor
+        }
+
+    def iter_pending_companies(self, table_name: str, cursor: Optional[str] = None, page_size: int = 1000) -> Tuple[int, Iterator[Dict]]:
+        """
+        Recorre todas las empresas pendientes a partir de un cursor sin cargarlas completas en memoria.
+        Los resultados se descargan de BigQuery por páginas de page_size filas.
+
+        Args:
+            table_name: Nombre de la tabla de control
+            cursor: Cursor desde el cual continuar (None para empezar desde el inicio)
+            page_size: Filas por página descargada de BigQuery
+
+        Returns:
+            (total_pending, iterador de {'rfc', 'company_name', 'cursor'})
+
+        Raises:
+            ValueError: Si el cursor no es válido
+        """
+        after = decode_pending_cursor(cursor) if cursor else None
+        query, query_parameters = self._pending_companies_query(table_name, after, with_limit=False)
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+
+        _, rows = self._run_query_job(query, job_config, operation='pending_scan', page_size=page_size)
+        row_iterator = iter(rows)
+        first_row = next(row_iterator, None)
+        total_pending = first_row.total_pending if first_row else 0
+
+        def _rows() -> Iterator[Dict]:
+            row = first_row
+            while row is not None:
+                if row.biz_identifier is not None:
+                    yield {
+                        'rfc': row.biz_identifier,
+                        'company_name': row.biz_name,
+                        'cursor': encode_pending_cursor(row.biz_name, row.biz_identifier)
+                    }
+                row = next(row_iterator, None)
+
+        return total_pending, _rows()
+
+    def iter_scraped_companies(self, since: Optional[datetime] = None, page_size: int = 50000) -> Iterator[Dict]:
+        """
+        Recorre las empresas ya scrapeadas de la tabla de control (scrapping_d y contact_found_flg
+        no nulos), solo con las columnas necesarias para ScrapedCompaniesIndex.
+
+        Args:
+            since: Si se indica, solo filas con scrapping_d >= since (refresco incremental)
+            page_size: Filas por página descargada de BigQuery
+
+        Returns:
+            Iterador de {'biz_identifier', 'biz_name', 'scrapping_d'}
+        """
+        since_filter = ""
+        query_parameters = []
+        if since is not None:
+            since_filter = "AND scrapping_d >= @since"
+            query_parameters.append(bigquery.ScalarQueryParameter("since", "TIMESTAMP", since))
+
+        query = f"""
+        SELECT biz_identifier, biz_name, scrapping_d
+        FROM `{self.__project_id}.{self.__dataset}.{Config.CONTROL_TABLE_NAME}`
+        WHERE scrapping_d IS NOT NULL AND contact_found_flg IS NOT NULL
+        {since_filter}
+        """
+        job_config = bigquery.QueryJobConfig(query_parameters=query_parameters)
+        _, rows = self._run_query_job(query, job_config, operation='scraped_scan', page_size=page_size)
+        for row in rows:
+            yield {'biz_identifier': row.biz_identifier, 'biz_name': row.biz_name, 'scrapping_d': row.scrapping_d}
+
+    def _ensure_idempotency_table(self) -> str:
+        """Crea (una vez por proceso) la tabla del registro compartido de Idempotency-Key"""
+        table = f'{self.__project_id}.{self.__dataset}.{Config.IDEMPOTENCY_TABLE_NAME}'
+        if not self.__idempotency_table_checked:
+            self._run_query_job(f"""
+                CREATE TABLE IF NOT EXISTS `{table}` (
+                    idempotency_key STRING NOT NULL,
+                    fingerprint STRING,
+                    state STRING,
+                    status_code INT64,
+                    mimetype STRING,
+                    body STRING,
+                    created_at TIMESTAMP,
+                    expires_at TIMESTAMP
+                )
+            """, operation='idempotency_table')
+            self.__idempotency_table_checked = True
+        return table
+
+    def claim_idempotency_key(self, key: str, fingerprint: str, ttl_seconds: float) -> Tuple[bool, Optional[Dict]]:
+        """
+        Reserva una Idempotency-Key en la tabla compartida (MERGE atómico: solo se inserta si no
+        existe o si expiró).
+
+        Returns:
+            (True, None) si la llave quedó reservada para este proceso,
+            (False, {'fingerprint', 'state', 'status_code', 'mimetype', 'body'}) si ya la tenía otro
+        """
+        table = self._ensure_idempotency_table()
+        params = [
+            bigquery.ScalarQueryParameter("key", "STRING", key),
+            bigquery.ScalarQueryParameter("fingerprint", "STRING", fingerprint),
+            bigquery.ScalarQueryParameter("ttl", "INT64", int(ttl_seconds)),
+        ]
+        query_job, _ = self._run_query_job(f"""
+            MERGE `{table}` AS target
+            USING (SELECT @key AS idempotency_key) AS source
+            ON target.idempotency_key = source.idempotency_key
+            WHEN MATCHED AND target.expires_at < CURRENT_TIMESTAMP() THEN
+                UPDATE SET fingerprint = @fingerprint, state = 'in_progress', status_code = NULL, mimetype = NULL,
+                           body = NULL, created_at = CURRENT_TIMESTAMP(),
+                           expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @ttl SECOND)
+            WHEN NOT MATCHED THEN
+                INSERT (idempotency_key, fingerprint, state, created_at, expires_at)
+                VALUES (@key, @fingerprint, 'in_progress', CURRENT_TIMESTAMP(),
+                        TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @ttl SECOND))
+        """, bigquery.QueryJobConfig(query_parameters=params), operation='idempotency_claim')
+        if query_job.num_dml_affected_rows:
+            return True, None
+
+        _, rows = self._run_query_job(f"""
+            SELECT fingerprint, state, status_code, mimetype, body
+            FROM `{table}`
+            WHERE idempotency_key = @key
+        """, bigquery.QueryJobConfig(query_parameters=params[:1]), operation='idempotency_lookup')
+        rows = list(rows)
+        if not rows:
+            # Se liberó entre el MERGE y la lectura
+            return self.claim_idempotency_key(key, fingerprint, ttl_seconds)
+        row = rows[0]
+        return False, {'fingerprint': row.fingerprint, 'state': row.state, 'status_code': row.status_code,
+                       'mimetype': row.mimetype, 'body': row.body}
+
+    def save_idempotency_response(self, key: str, status_code: int, body: str, mimetype: str, ttl_seconds: float) -> None:
+        """Guarda la respuesta de una Idempotency-Key reservada por este proceso"""
+        table = self._ensure_idempotency_table()
+        self._run_query_job(f"""
+            UPDATE `{table}`
+            SET state = 'completed', status_code = @status_code, mimetype = @mimetype, body = @body,
+                expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @ttl SECOND)
+            WHERE idempotency_key = @key
+        """, bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("key", "STRING", key),
+            bigquery.ScalarQueryParameter("status_code", "INT64", status_code),
+            bigquery.ScalarQueryParameter("mimetype", "STRING", mimetype),
+            bigquery.ScalarQueryParameter("body", "STRING", body),
+            bigquery.ScalarQueryParameter("ttl", "INT64", int(ttl_seconds)),
+        ]), operation='idempotency_save')
+
+    def release_idempotency_key(self, key: str) -> None:
+        """Elimina una Idempotency-Key en curso (la request falló y un reintento debe ejecutarse)"""
+        table = self._ensure_idempotency_table()
+        self._run_query_job(f"""
+            DELETE FROM `{table}` WHERE idempotency_key = @key AND state = 'in_progress'
+        """, bigquery.QueryJobConfig(query_parameters=[bigquery.ScalarQueryParameter("key", "STRING", key)]),
+                            operation='idempotency_release')
+
+    def _ensure_model_quota_table(self) -> str:
+        """Crea (una vez por proceso) la tabla con los requests usados por modelo y día"""
+        table = f'{self.__project_id}.{self.__dataset}.{Config.MODEL_QUOTA_TABLE_NAME}'
+        if not self.__model_quota_table_checked:
+            self._run_query_job(f"""
+                CREATE TABLE IF NOT EXISTS `{table}` (
+                    model STRING NOT NULL,
+                    day DATE NOT NULL,
+                    used INT64,
+                    updated_at TIMESTAMP
+                )
+            """, operation='model_quota_table')
+            self.__model_quota_table_checked = True
+        return table
+
+    def reserve_model_requests(self, model: str, day: date, requests: int, max_requests: int) -> int:
+        """
+        Reserva requests del cupo diario de un modelo (MERGE atómico: solo suma si no pasa de
+        max_requests). Retorna los requests reservados: requests, o 0 si el cupo no alcanza.
+        """
+        table = self._ensure_model_quota_table()
+        query_job, _ = self._run_query_job(f"""
+            MERGE `{table}` AS target
+            USING (SELECT @model AS model, @day AS day) AS source
+            ON target.model = source.model AND target.day = source.day
+            WHEN MATCHED AND target.used + @requests <= @max_requests THEN
+                UPDATE SET used = target.used + @requests, updated_at = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED AND @requests <= @max_requests THEN
+                INSERT (model, day, used, updated_at) VALUES (@model, @day, @requests, CURRENT_TIMESTAMP())
+        """, bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("model", "STRING", model),
+            bigquery.ScalarQueryParameter("day", "DATE", day),
+            bigquery.ScalarQueryParameter("requests", "INT64", requests),
+            bigquery.ScalarQueryParameter("max_requests", "INT64", max_requests),
+        ]), operation='model_quota_reserve')
+        return requests if query_job.num_dml_affected_rows else 0
+
+    def exhaust_model_quota(self, model: str, day: date, max_requests: int) -> None:
+        """Marca el cupo del día de un modelo como agotado para todos los procesos"""
+        table = self._ensure_model_quota_table()
+        self._run_query_job(f"""
+            MERGE `{table}` AS target
+            USING (SELECT @model AS model, @day AS day) AS source
+            ON target.model = source.model AND target.day = source.day
+            WHEN MATCHED THEN
+                UPDATE SET used = GREATEST(target.used, @max_requests), updated_at = CURRENT_TIMESTAMP()
+            WHEN NOT MATCHED THEN
+                INSERT (model, day, used, updated_at) VALUES (@model, @day, @max_requests, CURRENT_TIMESTAMP())
+        """, bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ScalarQueryParameter("model", "STRING", model),
+            bigquery.ScalarQueryParameter("day", "DATE", day),
+            bigquery.ScalarQueryParameter("max_requests", "INT64", max_requests),
+        ]), operation='model_quota_exhaust')
+
+    def _ensure_company_lease_table(self) -> str:
+        """Crea (una vez por proceso) la tabla de empresas reservadas por algún proceso para scrapear"""
+        table = f'{self.__project_id}.{self.__dataset}.{Config.COMPANY_LEASE_TABLE_NAME}'
+        if not self.__company_lease_table_checked:
+            self._run_query_job(f"""
+                CREATE TABLE IF NOT EXISTS `{table}` (
+                    biz_identifier STRING NOT NULL,
+                    owner STRING,
+                    claimed_at TIMESTAMP,
+                    expires_at TIMESTAMP
+                )
+            """, operation='company_lease_table')
+            self.__company_lease_table_checked = True
+        return table
+
+    def _company_lease_filter(self) -> str:
+        """Condición que excluye las empresas reservadas por otro proceso (vacía si no se usan reservas)"""
+        if not Config.COMPANY_LEASE_ENABLED:
+            return ""
+        table = self._ensure_company_lease_table()
+        return (f"AND biz_identifier NOT IN (SELECT biz_identifier FROM `{table}` "
+                f"WHERE expires_at > CURRENT_TIMESTAMP())")
+
+    def claim_companies(self, companies: List[Dict], owner: str, ttl_seconds: float) -> List[Dict]:
+        """
+        Reserva empresas para un proceso durante ttl_seconds (MERGE atómico: solo toma las que no
+        tienen reserva vigente de otro dueño). Retorna las empresas que quedaron reservadas para owner.
+        """
+        keys = [company['biz_identifier'] for company in companies if company.get('biz_identifier')]
+        if not keys:
+            return []
+        table = self._ensure_company_lease_table()
+        params = [
+            bigquery.ArrayQueryParameter("keys", "STRING", keys),
+            bigquery.ScalarQueryParameter("owner", "STRING", owner),
+        ]
+        self._run_query_job(f"""
+            MERGE `{table}` AS target
+            USING (SELECT DISTINCT biz_identifier FROM UNNEST(@keys) AS biz_identifier) AS source
+            ON target.biz_identifier = source.biz_identifier
+            WHEN MATCHED AND (target.expires_at <= CURRENT_TIMESTAMP() OR target.owner = @owner) THEN
+                UPDATE SET owner = @owner, claimed_at = CURRENT_TIMESTAMP(),
+                           expires_at = TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @ttl SECOND)
+            WHEN NOT MATCHED THEN
+                INSERT (biz_identifier, owner, claimed_at, expires_at)
+                VALUES (source.biz_identifier, @owner, CURRENT_TIMESTAMP(),
+                        TIMESTAMP_ADD(CURRENT_TIMESTAMP(), INTERVAL @ttl SECOND))
+        """, bigquery.QueryJobConfig(query_parameters=params + [
+            bigquery.ScalarQueryParameter("ttl", "INT64", int(ttl_seconds)),
+        ]), operation='company_lease_claim')
+
+        _, rows = self._run_query_job(f"""
+            SELECT biz_identifier FROM `{table}`
+            WHERE owner = @owner AND biz_identifier IN UNNEST(@keys) AND expires_at > CURRENT_TIMESTAMP()
+        """, bigquery.QueryJobConfig(query_parameters=params), operation='company_lease_lookup')
+        claimed = {row.biz_identifier for row in rows}
+        return [company for company in companies if company.get('biz_identifier') in claimed]
+
+    def release_company_leases(self, companies: List[Dict], owner: str) -> None:
+        """Elimina las reservas de owner sobre esas empresas (quedan disponibles para otros procesos)"""
+        keys = [company['biz_identifier'] for company in companies if company.get('biz_identifier')]
+        if not keys:
+            return
+        table = self._ensure_company_lease_table()
+        self._run_query_job(f"""
+            DELETE FROM `{table}` WHERE owner = @owner AND biz_identifier IN UNNEST(@keys)
+        """, bigquery.QueryJobConfig(query_parameters=[
+            bigquery.ArrayQueryParameter("keys", "STRING", keys),
+            bigquery.ScalarQueryParameter("owner", "STRING", owner),
+        ]), operation='company_lease_release')
+
     def clean_duplicates_from_control_table(self, table_name: str = "linkedin_scrapped_contacts") -> Dict:
         """
         Limpia registros duplicados de la tabla linkedin_scrapped_contacts.
@@ -565,13 +1511,13 @@ class BigQueryService:
             logger.info(f"🧹 Iniciando limpieza de duplicados en {destination_table}...")
             
             # Ejecutar query de deduplicación
-            query_job = self.__bq_client.query(deduplication_query)
-            result = query_job.result()
+            self._run_query_job(deduplication_query, operation='deduplicate_control')
+            self._on_control_table_written()
             
             # Obtener estadísticas
             count_query = f"SELECT COUNT(*) as count FROM `{destination_table}`"
-            count_job = self.__bq_client.query(count_query)
-            count_result = list(count_job.result())
+            _, count_result = self._run_query_job(count_query, operation='count_control')
+            count_result = list(count_result)
             final_count = count_result[0].count if count_result else 0
             
             logger.info(f"✅ Limpieza de duplicados completada. Registros finales: {final_count}")
@@ -0,0 +1,201 @@
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """El circuito de una dependencia está abierto: se falla de inmediato sin llamarla"""
+
+    def __init__(self, name: str, retry_after: float) -> None:
+        super().__init__(f"Servicio {name} no disponible temporalmente (circuito abierto)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker por tasa de error en una ventana de tiempo.
+
+    - closed: las llamadas pasan; si en los últimos window_seconds hubo al menos min_calls
+      llamadas y la fracción de fallas llega a failure_rate_threshold, el circuito se abre.
+    - open: las llamadas fallan de inmediato con CircuitOpenError durante open_seconds.
+    - half_open: se dejan pasar hasta half_open_max_calls llamadas de prueba; si todas salen
+      bien el circuito se cierra, y con la primera falla se vuelve a abrir.
+    """
+
+    def __init__(self, name: str, failure_rate_threshold: float = 0.5, min_calls: int = 10,
+                 window_seconds: float = 60, open_seconds: float = 30, half_open_max_calls: int = 1,
+                 enabled: bool = True) -> None:
+        self.name = name
+        self.__failure_rate_threshold = failure_rate_threshold
+        self.__min_calls = max(1, min_calls)
+        self.__window_seconds = window_seconds
+        self.__open_seconds = open_seconds
+        self.__half_open_max_calls = max(1, half_open_max_calls)
+        self.__enabled = enabled
+        self.__lock = threading.Lock()
+        self.__state = CLOSED
+        self.__opened_at = 0.0
+        self.__calls: deque = deque()  # (monotonic, ok)
+        self.__probes_in_flight = 0
+        self.__probe_successes = 0
+        self.__stats = {'calls': 0, 'failures': 0, 'rejected': 0, 'opened': 0}
+
+    @property
+    def state(self) -> str:
+        with self.__lock:
+            self.__refresh_state()
+            return self.__state
+
+    def retry_after(self) -> float:
+        """Segundos hasta que el circuito deje pasar una llamada de prueba (0 si está cerrado)"""
+        with self.__lock:
+            self.__refresh_state()
+            if self.__state != OPEN:
+                return 0.0
+            return max(0.0, self.__opened_at + self.__open_seconds - time.monotonic())
+
+    def check(self) -> None:
+        """Lanza CircuitOpenError si el circuito está abierto, sin consumir una llamada de prueba"""
+        if not self.__enabled:
+            return
+        with self.__lock:
+            self.__refresh_state()
+            if self.__state == OPEN:
+                self.__stats['rejected'] += 1
+                raise CircuitOpenError(self.name, max(1.0, self.__opened_at + self.__open_seconds - time.monotonic()))
+
+    def before_call(self) -> None:
+        """Reserva una llamada; lanza CircuitOpenError si no se permite"""
+        if not self.__enabled:
+            return
+        with self.__lock:
+            self.__refresh_state()
+            if self.__state == OPEN or (self.__state == HALF_OPEN and self.__probes_in_flight >= self.__half_open_max_calls):
+                self.__stats['rejected'] += 1
+                raise CircuitOpenError(self.name, max(1.0, self.__opened_at + self.__open_seconds - time.monotonic()))
+            if self.__state == HALF_OPEN:
+                self.__probes_in_flight += 1
+
+    def record_success(self) -> None:
+        self.__record(True)
+
+    def record_failure(self) -> None:
+        self.__record(False)
+
+    def call(self, fn: Callable, *args, is_failure: Optional[Callable] = None, **kwargs):
+        """
+        Ejecuta fn dentro del circuito. Una excepción cuenta como falla; is_failure(resultado)
+        permite contar también resultados (por ejemplo, un status 5xx) como fallas.
+        """
+        self.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        if is_failure is not None and is_failure(result):
+            self.record_failure()
+        else:
+            self.record_success()
+        return result
+
+    def __record(self, ok: bool) -> None:
+        if not self.__enabled:
+            return
+        now = time.monotonic()
+        with self.__lock:
+            self.__stats['calls'] += 1
+            if not ok:
+                self.__stats['failures'] += 1
+
+            if self.__state == HALF_OPEN:
+                self.__probes_in_flight = max(0, self.__probes_in_flight - 1)
+                if not ok:
+                    self.__open(now)
+                    return
+                self.__probe_successes += 1
+                if self.__probe_successes >= self.__half_open_max_calls:
+                    logger.info(f"✅ Circuito {self.name} cerrado")
+                    self.__state = CLOSED
+                    self.__calls.clear()
+                return
+            if self.__state == OPEN:
+                # Llamada que empezó antes de abrir el circuito
+                return
+
+            self.__calls.append((now, ok))
+            self.__prune(now)
+            failures = sum(1 for _, call_ok in self.__calls if not call_ok)
+            if len(self.__calls) >= self.__min_calls and failures / len(self.__calls) >= self.__failure_rate_threshold:
+                self.__open(now)
+
+    def __open(self, now: float) -> None:
+        logger.warning(f"🔌 Circuito {self.name} abierto por {self.__open_seconds:.0f}s")
+        self.__state = OPEN
+        self.__opened_at = now
+        self.__probes_in_flight = 0
+        self.__probe_successes = 0
+        self.__calls.clear()
+        self.__stats['opened'] += 1
+
+    def __refresh_state(self) -> None:
+        if self.__state == OPEN and time.monotonic() >= self.__opened_at + self.__open_seconds:
+            self.__state = HALF_OPEN
+            self.__probes_in_flight = 0
+            self.__probe_successes = 0
+
+    def __prune(self, now: float) -> None:
+        while self.__calls and self.__calls[0][0] < now - self.__window_seconds:
+            self.__calls.popleft()
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            self.__refresh_state()
+            self.__prune(time.monotonic())
+            window_failures = sum(1 for _, ok in self.__calls if not ok)
+            return {
+                **self.__stats,
+                'state': self.__state,
+                'window_calls': len(self.__calls),
+                'window_failure_rate': window_failures / len(self.__calls) if self.__calls else 0.0,
+            }
+
+
+# Un circuito por dependencia, compartido por todos los hilos del proceso
+_breakers: Dict[str, CircuitBreaker] = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Retorna el circuito de una dependencia ('search', 'apify', 'bigquery'), creándolo con Config.CIRCUIT_BREAKER_*"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = CircuitBreaker(
+                    name,
+                    failure_rate_threshold=Config.CIRCUIT_BREAKER_FAILURE_RATE,
+                    min_calls=Config.CIRCUIT_BREAKER_MIN_CALLS,
+                    window_seconds=Config.CIRCUIT_BREAKER_WINDOW,
+                    open_seconds=Config.CIRCUIT_BREAKER_OPEN_SECONDS,
+                    half_open_max_calls=Config.CIRCUIT_BREAKER_HALF_OPEN_CALLS,
+                    enabled=Config.CIRCUIT_BREAKER_ENABLED
+                )
+                _breakers[name] = breaker
+    return breaker
+
+
+def circuit_breaker_stats() -> Dict:
+    return {name: breaker.stats() for name, breaker in list(_breakers.items())}
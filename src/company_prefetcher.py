@@ -0,0 +1,291 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def lease_owner() -> str:
+    """Identificador único del proceso como dueño de reservas de empresas (host, pid y sufijo aleatorio)"""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class PendingCompaniesPrefetcher:
+    """
+    Cola en memoria de empresas pendientes de scraping.
+
+    Un hilo en segundo plano trae empresas desde BigQuery en bloques grandes y rellena la cola
+    cuando baja de low_water_mark, de modo que cada request solo toma un lote de la cola en
+    lugar de ejecutar su propia query. Las empresas entregadas quedan "en proceso" hasta que se
+    liberan con release(), y no vuelven a entregarse mientras tanto. Las que se liberan para
+    reintento vuelven al final de la cola y no se entregan antes de requeue_backoff segundos
+    (doble en cada reintento); tras max_requeues reintentos salen de la cola.
+
+    Con varios procesos (workers de gunicorn, batch_runner) cada uno tiene su propia cola: con
+    claimer, cada bloque traído se reserva por lease_ttl segundos en un registro compartido y
+    solo se encolan las empresas reservadas por este proceso; el loader debe excluir las
+    reservadas por otros. Una empresa cuya reserva vence en menos de lease_margin segundos ya
+    no se entrega (otro proceso puede tomarla). Al detenerse se liberan las reservas de la cola.
+    """
+
+    def __init__(self,
+                 loader: Callable[[int, List[str]], List[Dict]],
+                 block_size: int = 500,
+                 low_water_mark: int = 50,
+                 max_queue_size: int = 1000,
+                 completed_ttl: float = 600,
+                 empty_backoff: float = 30,
+                 claimer: Optional[Callable[[List[Dict]], List[Dict]]] = None,
+                 unclaimer: Optional[Callable[[List[Dict]], None]] = None,
+                 lease_ttl: float = 1800,
+                 lease_margin: float = 300,
+                 requeue_backoff: float = 30,
+                 max_requeues: int = 3) -> None:
+        """
+        Args:
+            loader: Función (limit, exclude) -> empresas pendientes, por ejemplo
+                    BigQueryService.load_companies_from_bigquery_linkedin_contacts
+            block_size: Máximo de empresas a traer en cada consulta
+            low_water_mark: Tamaño de cola bajo el cual se dispara un nuevo llenado
+            max_queue_size: Tamaño máximo de la cola
+            completed_ttl: Segundos durante los que una empresa liberada no se vuelve a encolar,
+                           para dar tiempo a que su escritura en la tabla de control sea visible
+            empty_backoff: Segundos de espera antes de volver a consultar cuando no hubo pendientes
+            claimer: Función (empresas) -> empresas reservadas para este proceso, por ejemplo
+                     BigQueryService.claim_companies con el dueño y lease_ttl
+            unclaimer: Función (empresas) que libera sus reservas (al detener el prefetcher)
+            lease_ttl: Segundos que dura la reserva de claimer
+            lease_margin: Tiempo de reserva mínimo que debe quedarle a una empresa para entregarla
+            requeue_backoff: Espera antes de volver a entregar una empresa liberada para reintento
+            max_requeues: Reintentos de una empresa antes de sacarla de la cola (vuelve a cargarse
+                          desde BigQuery pasado completed_ttl)
+        """
+        self.__loader = loader
+        self.__block_size = block_size
+        self.__low_water_mark = low_water_mark
+        self.__max_queue_size = max_queue_size
+        self.__completed_ttl = completed_ttl
+        self.__empty_backoff = empty_backoff
+        self.__claimer = claimer
+        self.__unclaimer = unclaimer
+        self.__lease_ttl = lease_ttl
+        self.__lease_margin = lease_margin
+        self.__requeue_backoff = requeue_backoff
+        self.__max_requeues = max_requeues
+
+        self.__queue: Deque[Dict] = deque()
+        self.__queued_keys = set()
+        self.__in_flight = set()
+        self.__completed: Dict[str, float] = {}
+        # Vencimiento (time.monotonic()) de la reserva de cada empresa en cola o en proceso
+        self.__lease_expires: Dict[str, float] = {}
+        # Reintentos por empresa y momento (time.monotonic()) desde el que puede volver a entregarse
+        self.__requeues: Dict[str, int] = {}
+        self.__not_before: Dict[str, float] = {}
+
+        self.__condition = threading.Condition()
+        self.__exhausted_until = 0.0
+        self.__refilling = False
+        self.__stopped = False
+        self.__thread: Optional[threading.Thread] = None
+
+        self.__stats = {'refills': 0, 'companies_loaded': 0, 'companies_served': 0, 'refill_errors': 0,
+                        'claims_lost': 0, 'leases_expired': 0, 'requeued': 0, 'requeues_dropped': 0}
+
+    @staticmethod
+    def company_key(company: Dict) -> str:
+        return company.get('biz_identifier') or company.get('biz_name')
+
+    def start(self) -> None:
+        """Inicia el hilo de prefetch (idempotente)"""
+        with self.__condition:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+            self.__stopped = False
+            self.__thread = threading.Thread(target=self.__run, name="pending-companies-prefetcher", daemon=True)
+            self.__thread.start()
+        logger.info("✅ Prefetcher de empresas pendientes iniciado")
+
+    def stop(self) -> None:
+        """Detiene el hilo de prefetch y libera las reservas de las empresas que quedaron en cola"""
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+            queued = list(self.__queue)
+        if self.__thread is not None:
+            self.__thread.join(timeout=5)
+        if self.__unclaimer is not None and queued:
+            try:
+                self.__unclaimer(queued)
+                logger.info(f"🔓 {len(queued)} reservas de empresas en cola liberadas")
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudieron liberar las reservas de {len(queued)} empresas: {e}")
+
+    def acquire(self, count: int, timeout: float = 10) -> List[Dict]:
+        """
+        Entrega hasta count empresas de la cola y las marca como en proceso.
+
+        Si la cola está vacía (o solo tiene reintentos en espera) espera hasta timeout segundos a
+        que el hilo de prefetch la rellene o a que venza la espera de un reintento.
+        Retorna lista vacía si no hay empresas pendientes.
+        """
+        deadline = time.monotonic() + timeout
+        with self.__condition:
+            while not self.__stopped:
+                ready_in = self.__ready_in()
+                if ready_in == 0:
+                    break
+                if ready_in is None and time.monotonic() < self.__exhausted_until and not self.__refilling:
+                    break
+                self.__condition.notify_all()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.__condition.wait(remaining if ready_in is None else min(remaining, ready_in))
+
+            companies = []
+            now = time.monotonic()
+            lease_needed = now + self.__lease_margin
+            for _ in range(len(self.__queue)):
+                if len(companies) >= count:
+                    break
+                company = self.__queue.popleft()
+                key = self.company_key(company)
+                if self.__not_before.get(key, 0) > now:
+                    # Reintento todavía en espera: sigue en la cola
+                    self.__queue.append(company)
+                    continue
+                self.__not_before.pop(key, None)
+                self.__queued_keys.discard(key)
+                if self.__lease_expires.get(key, lease_needed) < lease_needed:
+                    # La reserva no alcanza para procesarla: queda libre para el próximo llenado
+                    del self.__lease_expires[key]
+                    self.__stats['leases_expired'] += 1
+                    continue
+                self.__in_flight.add(key)
+                companies.append(company)
+
+            self.__stats['companies_served'] += len(companies)
+            if len(self.__queue) < self.__low_water_mark:
+                self.__condition.notify_all()
+
+        return companies
+
+    def release(self, companies: List[Dict], requeue: bool = False) -> None:
+        """
+        Libera empresas entregadas por acquire().
+
+        Args:
+            companies: Empresas a liberar
+            requeue: Si es True las empresas vuelven al final de la cola con espera creciente (por
+                     ejemplo, si no alcanzaron a procesarse); si es False se consideran terminadas
+        """
+        now = time.monotonic()
+        with self.__condition:
+            for company in companies:
+                key = self.company_key(company)
+                if key not in self.__in_flight:
+                    continue
+                self.__in_flight.discard(key)
+                attempts = self.__requeues.get(key, 0) + 1
+                if requeue and attempts <= self.__max_requeues:
+                    self.__requeues[key] = attempts
+                    self.__not_before[key] = now + self.__requeue_backoff * 2 ** (attempts - 1)
+                    self.__queue.append(company)
+                    self.__queued_keys.add(key)
+                    self.__stats['requeued'] += 1
+                    continue
+                if requeue:
+                    logger.warning(f"⏭️ Empresa {key} fuera de la cola tras {self.__max_requeues} reintentos")
+                    self.__stats['requeues_dropped'] += 1
+                self.__requeues.pop(key, None)
+                # La reserva compartida se deja vencer: cubre la demora en ver la escritura
+                self.__lease_expires.pop(key, None)
+                self.__completed[key] = now + self.__completed_ttl
+            if requeue:
+                self.__condition.notify_all()
+
+    def stats(self) -> Dict:
+        with self.__condition:
+            return {
+                **self.__stats,
+                'queued': len(self.__queue),
+                'in_flight': len(self.__in_flight),
+                'recently_completed': len(self.__completed),
+            }
+
+    def __ready_in(self) -> Optional[float]:
+        """0 si hay una empresa lista para entregar, segundos hasta el próximo reintento, o None si la cola está vacía"""
+        if not self.__queue:
+            return None
+        now = time.monotonic()
+        first_ready = min(self.__not_before.get(self.company_key(company), 0) for company in self.__queue)
+        return max(0.0, first_ready - now)
+
+    def __excluded_keys(self) -> List[str]:
+        now = time.monotonic()
+        for key, expires_at in list(self.__completed.items()):
+            if expires_at <= now:
+                del self.__completed[key]
+        return list(self.__queued_keys | self.__in_flight | set(self.__completed))
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                while not self.__stopped and (
+                    len(self.__queue) >= self.__low_water_mark
+                    or time.monotonic() < self.__exhausted_until
+                ):
+                    wait_for = None
+                    if len(self.__queue) < self.__low_water_mark:
+                        wait_for = self.__exhausted_until - time.monotonic()
+                    self.__condition.wait(wait_for)
+                if self.__stopped:
+                    return
+                limit = min(self.__block_size, self.__max_queue_size - len(self.__queue))
+                exclude = self.__excluded_keys()
+                self.__refilling = True
+
+            candidates, companies = [], []
+            try:
+                start_time = time.time()
+                candidates = self.__loader(limit, exclude)
+                companies = candidates
+                if self.__claimer is not None and candidates:
+                    claimed_at = time.monotonic()
+                    companies = self.__claimer(candidates)
+                    with self.__condition:
+                        for company in companies:
+                            self.__lease_expires[self.company_key(company)] = claimed_at + self.__lease_ttl
+                        self.__stats['claims_lost'] += len(candidates) - len(companies)
+                logger.info(f"📦 Prefetch: {len(companies)} empresas cargadas en {time.time() - start_time:.2f}s"
+                            + (f" ({len(candidates) - len(companies)} reservadas por otro proceso)"
+                               if len(companies) < len(candidates) else ""))
+            except Exception as e:
+                logger.error(f"❌ Error en prefetch de empresas pendientes: {e}")
+                with self.__condition:
+                    self.__stats['refill_errors'] += 1
+
+            with self.__condition:
+                self.__refilling = False
+                self.__stats['refills'] += 1
+                added = 0
+                for company in companies:
+                    key = self.company_key(company)
+                    if not key or key in self.__queued_keys or key in self.__in_flight or key in self.__completed:
+                        continue
+                    self.__queue.append(company)
+                    self.__queued_keys.add(key)
+                    added += 1
+                self.__stats['companies_loaded'] += added
+                # Si otro proceso ganó las reservas hay más pendientes: se consulta de nuevo sin esperar
+                claims_lost = len(companies) < len(candidates)
+                if len(candidates) < limit or (added == 0 and not claims_lost):
+                    # No quedan más pendientes por ahora: esperar antes de volver a consultar
+                    self.__exhausted_until = time.monotonic() + self.__empty_backoff
+                self.__condition.notify_all()
@@ -10,6 +10,18 @@ from secret_manager_service import SecretManager
 # Cargar variables de entorno desde .env
 load_dotenv()
 
+
+def get_secret(env_var: str, secret_name: str, project: str) -> str:
+    """
+    Obtiene un secreto desde la variable de entorno env_var si está definida (útil para correr
+    sin acceso a GCP, por ejemplo en pruebas de carga) o, si no, desde Secret Manager
+    """
+    value = os.getenv(env_var)
+    if value:
+        return value
+    return SecretManager(project=project).get_secret(secret_name)
+
+
 class Config:
     GOOGLE_CLOUD_PROJECT_ID = os.getenv('GOOGLE_CLOUD_PROJECT_ID','qa-cdp-mx')
     LOCATION = os.getenv('LOCATION', 'us-central1')
@@ -18,6 +30,12 @@ class Config:
     BIGQUERY_DATASET = os.getenv('BIGQUERY_DATASET', 'raw_in_scrapper')
     CONTROL_TABLE_NAME = os.getenv('CONTROL_TABLE_NAME', 'linkedin_scraped_contacts')
     LINKEDIN_INFO_TABLE_NAME = os.getenv('LINKEDIN_INFO_TABLE_NAME', 'linkedin_contacts_info')
+    # Modelo normalizado: datos de la persona por contacto y de la empresa una vez por empresa
+    # (activarlo junto con migrar_contactos_a_modelo_normalizado, que reemplaza la tabla plana por una vista)
+    CONTACTS_NORMALIZED = os.getenv('CONTACTS_NORMALIZED', 'False').lower() == 'true'
+    LINKEDIN_PERSONS_TABLE_NAME = os.getenv('LINKEDIN_PERSONS_TABLE_NAME', 'linkedin_contacts_persons')
+    LINKEDIN_COMPANIES_TABLE_NAME = os.getenv('LINKEDIN_COMPANIES_TABLE_NAME', 'linkedin_contacts_companies')
+    LINKEDIN_INFO_BACKUP_TABLE_NAME = os.getenv('LINKEDIN_INFO_BACKUP_TABLE_NAME', 'linkedin_contacts_info_flat')  # Tabla plana tras la migración
 
     # Google Search Service URL
     GOOGLE_SEARCH_SERVICE_URL = os.getenv('GOOGLE_SEARCH_SERVICE_URL', 'https://google-search-contacts-601063044530.us-central1.run.app/search')
@@ -27,11 +45,16 @@ class Config:
     #GCS_FOLDER = os.getenv('GCS_FOLDER', 'linkedin_data')  # Carpeta dentro del bucket
 
     """Clase de configuración para el LinkedIn Scraper API"""
-    secret_manager_services = SecretManager(project=GOOGLE_CLOUD_PROJECT_ID)
     # API Keys
-    SERPER_API_KEY  = secret_manager_services.get_secret('api_key_serper_linkedin_contactos')
+    SERPER_API_KEY  = get_secret('SERPER_API_KEY', 'api_key_serper_linkedin_contactos', GOOGLE_CLOUD_PROJECT_ID)
     # 🆕 API KEY DE APIFY
-    APIFY_TOKEN = secret_manager_services.get_secret('apify_token')
+    APIFY_TOKEN = get_secret('APIFY_TOKEN', 'apify_token', GOOGLE_CLOUD_PROJECT_ID)
+    # URL base de la API de Apify (None usa la API pública; se sobreescribe en pruebas de carga)
+    APIFY_API_URL = os.getenv('APIFY_API_URL') or None
+    # Lectura del dataset del actor por páginas en paralelo
+    APIFY_DATASET_PAGE_SIZE = int(os.getenv('APIFY_DATASET_PAGE_SIZE', '1000'))  # Items por página
+    APIFY_DATASET_MAX_WORKERS = int(os.getenv('APIFY_DATASET_MAX_WORKERS', '4'))  # Páginas en vuelo a la vez
+    APIFY_DATASET_PROJECT_FIELDS = os.getenv('APIFY_DATASET_PROJECT_FIELDS', 'True').lower() == 'true'  # Pedir solo los campos usados
     
     # Service Account Configuration - múltiples opciones
     # GOOGLE_APPLICATION_CREDENTIALS = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')  
@@ -40,6 +63,13 @@ class Config:
     FLASK_HOST = os.getenv('FLASK_HOST', '0.0.0.0')
     PORT = int(os.getenv('PORT', '5000'))
     FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'
+
+    # Serialización y compresión de respuestas
+    JSON_ENCODER = os.getenv('JSON_ENCODER', 'orjson').lower()  # orjson | stdlib
+    COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'True').lower() == 'true'
+    COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))  # Bytes; respuestas menores van sin comprimir
+    COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+    COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '5'))  # Solo si brotli está instalado
     
     # Configuración de threading
     MAX_WORKERS = int(os.getenv('MAX_WORKERS', '5'))  # Reducido para API
@@ -57,8 +87,114 @@ class Config:
     }
     
     # Límites de requests por modelo
-    MAX_REQUESTS_PER_MODEL = 9500
+    MAX_REQUESTS_PER_MODEL = int(os.getenv('MAX_REQUESTS_PER_MODEL', '9500'))  # Por día; al llegar se rota al siguiente modelo
+    # Modelos a los que se rota cuando GEMINI_MODEL_NAME agota su cupo (separados por coma)
+    GEMINI_FALLBACK_MODELS = [model.strip() for model in os.getenv('GEMINI_FALLBACK_MODELS', 'gemini-2.5-flash').split(',') if model.strip()]
+    # Cuenta de requests por modelo compartida entre workers, instancias y reinicios
+    MODEL_QUOTA_SHARED_STORE = os.getenv('MODEL_QUOTA_SHARED_STORE', 'bigquery').lower()  # bigquery | none
+    MODEL_QUOTA_TABLE_NAME = os.getenv('MODEL_QUOTA_TABLE_NAME', 'gemini_model_quota')
+    MODEL_QUOTA_BLOCK_SIZE = int(os.getenv('MODEL_QUOTA_BLOCK_SIZE', '20'))  # Requests que reserva cada proceso por MERGE
+    # Parte del cupo que usa cada proceso si el contador compartido no está disponible (por defecto, uno por worker)
+    MODEL_QUOTA_LOCAL_SHARE = int(os.getenv('MODEL_QUOTA_LOCAL_SHARE', os.getenv('WEB_CONCURRENCY', str(os.cpu_count() or 1))))
+
+    # Segundos que un modelo queda en pausa tras un 429 por límite de tasa (si la API no sugiere otro)
+    MODEL_RATE_LIMIT_BACKOFF = float(os.getenv('MODEL_RATE_LIMIT_BACKOFF', '30'))
+
+    # Evaluación con IA de perfiles sin ai_score_value (gemini o stub para correr sin Gemini)
+    PROFILE_SCORING_ENABLED = os.getenv('PROFILE_SCORING_ENABLED', 'True').lower() == 'true'
+    PROFILE_SCORING_BACKEND = os.getenv('PROFILE_SCORING_BACKEND', 'gemini').lower()
+    PROFILE_SCORING_BATCH_SIZE = int(os.getenv('PROFILE_SCORING_BATCH_SIZE', '10'))  # Perfiles por request al modelo
+    PROFILE_SCORING_CACHE_SIZE = int(os.getenv('PROFILE_SCORING_CACHE_SIZE', '50000'))
     
+    # Prefetch de empresas pendientes para /scrape
+    PREFETCH_BLOCK_SIZE = int(os.getenv('PREFETCH_BLOCK_SIZE', '500'))  # Empresas por query a BigQuery
+    PREFETCH_LOW_WATER_MARK = int(os.getenv('PREFETCH_LOW_WATER_MARK', '50'))  # Rellenar bajo este tamaño
+    PREFETCH_MAX_QUEUE_SIZE = int(os.getenv('PREFETCH_MAX_QUEUE_SIZE', '1000'))
+    PREFETCH_COMPLETED_TTL = int(os.getenv('PREFETCH_COMPLETED_TTL', '600'))  # Segundos sin re-encolar empresas terminadas
+    PREFETCH_EMPTY_BACKOFF = int(os.getenv('PREFETCH_EMPTY_BACKOFF', '30'))  # Segundos de espera si no hay pendientes
+    PREFETCH_ACQUIRE_TIMEOUT = int(os.getenv('PREFETCH_ACQUIRE_TIMEOUT', '10'))  # Espera máxima de un request por empresas
+    PREFETCH_REQUEUE_BACKOFF = float(os.getenv('PREFETCH_REQUEUE_BACKOFF', '30'))  # Espera antes de reintentar una empresa (se duplica)
+    PREFETCH_MAX_REQUEUES = int(os.getenv('PREFETCH_MAX_REQUEUES', '3'))  # Reintentos antes de sacarla de la cola
+    # Reservas de empresas entre procesos: cada worker reserva en BigQuery los bloques que prefetchea
+    COMPANY_LEASE_ENABLED = os.getenv('COMPANY_LEASE_ENABLED', 'True').lower() == 'true'
+    COMPANY_LEASE_TABLE_NAME = os.getenv('COMPANY_LEASE_TABLE_NAME', 'company_scrape_leases')
+    COMPANY_LEASE_TTL = int(os.getenv('COMPANY_LEASE_TTL', '1800'))  # Segundos que dura la reserva de un bloque
+
+    # Selección de perfiles antes de scrapear (se pueden sobreescribir por request en /scrape)
+    SELECTION_MIN_SCORE = float(os.getenv('SELECTION_MIN_SCORE', '5'))  # ai_score_value mínimo
+    SELECTION_MAX_PER_COMPANY = int(os.getenv('SELECTION_MAX_PER_COMPANY', '5'))  # 0 = sin límite
+    SELECTION_TIE_BREAKER = os.getenv('SELECTION_TIE_BREAKER', 'finance_first')  # finance_first | search_order
+
+    # Re-scraping por frescura: además de las empresas nunca scrapeadas, vuelve a scrapear las que
+    # tienen contactos cuando envejecen y reintenta las sin contactos con backoff exponencial
+    RESCRAPE_ENABLED = os.getenv('RESCRAPE_ENABLED', 'True').lower() == 'true'
+    RESCRAPE_REFRESH_DAYS = float(os.getenv('RESCRAPE_REFRESH_DAYS', '90'))  # Antigüedad para refrescar empresas con contactos
+    RESCRAPE_RETRY_BASE_DAYS = float(os.getenv('RESCRAPE_RETRY_BASE_DAYS', '14'))  # Espera tras el primer "sin contactos"
+    RESCRAPE_RETRY_MAX_DAYS = float(os.getenv('RESCRAPE_RETRY_MAX_DAYS', '180'))  # Tope del backoff
+    RESCRAPE_MAX_NO_CONTACT_ATTEMPTS = int(os.getenv('RESCRAPE_MAX_NO_CONTACT_ATTEMPTS', '5'))  # Intentos sin contactos antes de descartar
+    RESCRAPE_REFRESH_WEIGHT = float(os.getenv('RESCRAPE_REFRESH_WEIGHT', '1.0'))  # Peso de refrescos frente a reintentos
+    RESCRAPE_RETRY_WEIGHT = float(os.getenv('RESCRAPE_RETRY_WEIGHT', '0.5'))
+
+    # Escritura diferida a BigQuery: agrupa filas de varias requests en un MERGE por tabla
+    WRITE_BEHIND_ENABLED = os.getenv('WRITE_BEHIND_ENABLED', 'True').lower() == 'true'
+    WRITE_BEHIND_MAX_ROWS = int(os.getenv('WRITE_BEHIND_MAX_ROWS', '500'))  # Filas por tabla que disparan un flush
+    WRITE_BEHIND_MAX_AGE = float(os.getenv('WRITE_BEHIND_MAX_AGE', '5'))  # Segundos máximos en el buffer
+    WRITE_BEHIND_MAX_RETRIES = int(os.getenv('WRITE_BEHIND_MAX_RETRIES', '3'))  # Reintentos de un MERGE fallido antes de descartar
+    WRITE_BEHIND_RETRY_BACKOFF = float(os.getenv('WRITE_BEHIND_RETRY_BACKOFF', '2'))  # Segundos hasta el primer reintento (se duplica)
+    # /scrape espera a que sus filas queden escritas: su tabla hace flush sin esperar WRITE_BEHIND_MAX_AGE
+    # y las filas que llegan durante un MERGE en curso salen juntas en el siguiente
+    WRITE_BEHIND_WAIT = os.getenv('WRITE_BEHIND_WAIT', 'True').lower() == 'true'
+
+    # Cache de resultados de queries a la tabla de control (conteos y estado de empresas)
+    QUERY_CACHE_ENABLED = os.getenv('QUERY_CACHE_ENABLED', 'True').lower() == 'true'
+    QUERY_CACHE_TTL = float(os.getenv('QUERY_CACHE_TTL', '30'))  # Segundos de vida de un resultado
+    QUERY_CACHE_MAX_ENTRIES = int(os.getenv('QUERY_CACHE_MAX_ENTRIES', '2000'))
+
+    # Consumo y topes de las queries a BigQuery
+    BIGQUERY_MAX_BYTES_BILLED = int(os.getenv('BIGQUERY_MAX_BYTES_BILLED', str(10 * 1024 ** 3)))  # Tope por job (0 = sin tope)
+    BIGQUERY_MAX_BYTES_BILLED_BY_OPERATION = os.getenv('BIGQUERY_MAX_BYTES_BILLED_BY_OPERATION', '')  # operacion=bytes,... (ej. deduplicate_control=0)
+    BIGQUERY_DRY_RUN_FIRST = os.getenv('BIGQUERY_DRY_RUN_FIRST', 'False').lower() == 'true'  # Estimar cada query antes de ejecutarla
+    BIGQUERY_PRICE_PER_TIB = float(os.getenv('BIGQUERY_PRICE_PER_TIB', '6.25'))  # USD por TiB facturado (on-demand)
+
+    # Índice en memoria de empresas scrapeadas para responder /validate sin ir a BigQuery
+    SCRAPED_INDEX_ENABLED = os.getenv('SCRAPED_INDEX_ENABLED', 'True').lower() == 'true'
+    SCRAPED_INDEX_REFRESH_INTERVAL = float(os.getenv('SCRAPED_INDEX_REFRESH_INTERVAL', '60'))  # Segundos entre refrescos incrementales
+    SCRAPED_INDEX_FULL_RELOAD_INTERVAL = float(os.getenv('SCRAPED_INDEX_FULL_RELOAD_INTERVAL', '3600'))  # Segundos entre recargas completas
+
+    # Profiling por request (header X-Profile: true o muestreo aleatorio); apagado no agrega costo
+    PROFILING_ENABLED = os.getenv('PROFILING_ENABLED', 'False').lower() == 'true'
+    PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))  # Fracción de requests a perfilar
+    PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', '0.005'))  # Segundos entre muestras
+    PROFILE_DIR = os.getenv('PROFILE_DIR', '/tmp/linkedin_contacts_profiles')
+    PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', '100'))
+
+    # Trazas OpenTelemetry de /scrape (search, Apify, BigQuery); apagado no agrega costo
+    TRACING_ENABLED = os.getenv('TRACING_ENABLED', 'False').lower() == 'true'
+    TRACING_EXPORTER = os.getenv('TRACING_EXPORTER', 'file').lower()  # console | file | otlp | none (provider ya configurado)
+    TRACING_FILE = os.getenv('TRACING_FILE', '/tmp/linkedin_contacts_traces.jsonl')  # Un span JSON por línea
+    TRACING_SAMPLE_RATE = float(os.getenv('TRACING_SAMPLE_RATE', '1.0'))  # Fracción de trazas nuevas a registrar
+    TRACING_SERVICE_NAME = os.getenv('TRACING_SERVICE_NAME', 'linkedin-contacts-scraper')
+
+    # Grabación y reproducción de las respuestas del search service y de Apify (benchmarks sin llamadas reales)
+    UPSTREAM_CASSETTE_MODE = os.getenv('UPSTREAM_CASSETTE_MODE', 'off').lower()  # off | record | replay
+    UPSTREAM_CASSETTE_PATH = os.getenv('UPSTREAM_CASSETTE_PATH', '/tmp/linkedin_contacts_cassette.jsonl.gz')
+    UPSTREAM_CASSETTE_SPEED = float(os.getenv('UPSTREAM_CASSETTE_SPEED', '1'))  # En replay: 1 = tiempos originales, 0 = sin esperas
+
+    # Streaming de /scrape: registros NDJSON en espera de un cliente lento antes de frenar el envío
+    SCRAPE_STREAM_QUEUE_LINES = int(os.getenv('SCRAPE_STREAM_QUEUE_LINES', '100'))
+
+    # Paginación de /validate
+    VALIDATE_MAX_PAGE_SIZE = int(os.getenv('VALIDATE_MAX_PAGE_SIZE', '1000'))
+    VALIDATE_STREAM_PAGE_SIZE = int(os.getenv('VALIDATE_STREAM_PAGE_SIZE', '5000'))  # Filas por página descargada al hacer streaming
+
+    # Exportación de contactos (/contacts/export) con la BigQuery Storage Read API
+    EXPORT_MAX_STREAMS = int(os.getenv('EXPORT_MAX_STREAMS', '4'))  # Streams de lectura en paralelo
+    EXPORT_QUEUE_BATCHES = int(os.getenv('EXPORT_QUEUE_BATCHES', '8'))  # Record batches leídos y aún no enviados
+    EXPORT_MAX_IDENTIFIERS = int(os.getenv('EXPORT_MAX_IDENTIFIERS', '10000'))  # biz_identifier por request
+    EXPORT_LZ4 = os.getenv('EXPORT_LZ4', 'True').lower() == 'true'  # Compresión LZ4 entre BigQuery y el servicio
+    # Segundos que el watermark devuelto queda antes del mayor src_scraped_dt exportado (filas de MERGE tardíos)
+    EXPORT_WATERMARK_OVERLAP = float(os.getenv('EXPORT_WATERMARK_OVERLAP', '300'))
+
     # Timeout para requests
     REQUEST_TIMEOUT = int(os.getenv('REQUEST_TIMEOUT', '300'))  # 5 minutos
     
@@ -67,6 +203,31 @@ class Config:
     RETRY_DELAY = int(os.getenv('RETRY_DELAY', '5'))  # Segundos entre reintentos
     BATCH_TIMEOUT = int(os.getenv('BATCH_TIMEOUT', '600'))  # 10 minutos para batch completo
     INDIVIDUAL_TIMEOUT = int(os.getenv('INDIVIDUAL_TIMEOUT', '120'))  # 2 minutos por empresa
+    DEADLINE_WRITE_RESERVE = int(os.getenv('DEADLINE_WRITE_RESERVE', '30'))  # Segundos del deadline reservados para escribir en BigQuery
+
+    # Circuit breakers de dependencias (search, apify, bigquery)
+    CIRCUIT_BREAKER_ENABLED = os.getenv('CIRCUIT_BREAKER_ENABLED', 'True').lower() == 'true'
+    CIRCUIT_BREAKER_FAILURE_RATE = float(os.getenv('CIRCUIT_BREAKER_FAILURE_RATE', '0.5'))  # Fracción de fallas que abre el circuito
+    CIRCUIT_BREAKER_MIN_CALLS = int(os.getenv('CIRCUIT_BREAKER_MIN_CALLS', '10'))  # Llamadas mínimas en la ventana para evaluar
+    CIRCUIT_BREAKER_WINDOW = float(os.getenv('CIRCUIT_BREAKER_WINDOW', '60'))  # Segundos de la ventana de llamadas
+    CIRCUIT_BREAKER_OPEN_SECONDS = float(os.getenv('CIRCUIT_BREAKER_OPEN_SECONDS', '30'))  # Segundos abierto antes de probar
+    CIRCUIT_BREAKER_HALF_OPEN_CALLS = int(os.getenv('CIRCUIT_BREAKER_HALF_OPEN_CALLS', '1'))  # Llamadas de prueba para cerrar
+
+    # Control de admisión de /scrape (por worker)
+    ADMISSION_CONTROL_ENABLED = os.getenv('ADMISSION_CONTROL_ENABLED', 'True').lower() == 'true'
+    ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', str(max(1, MAX_WORKERS - 1))))  # Deja un hilo libre para /status y /validate
+    ADMISSION_MAX_QUEUED = int(os.getenv('ADMISSION_MAX_QUEUED', '2'))  # Requests esperando lugar
+    ADMISSION_QUEUE_TIMEOUT = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', '5'))  # Segundos máximos en la cola
+    ADMISSION_MAX_PENDING_WRITES = int(os.getenv('ADMISSION_MAX_PENDING_WRITES', '10000'))  # Filas en el buffer de escritura
+    ADMISSION_RETRY_AFTER = int(os.getenv('ADMISSION_RETRY_AFTER', '5'))  # Segundos sugeridos en Retry-After
+
+    # Idempotency-Key en /scrape
+    IDEMPOTENCY_ENABLED = os.getenv('IDEMPOTENCY_ENABLED', 'True').lower() == 'true'
+    IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', '3600'))  # Segundos que se guarda una respuesta
+    IDEMPOTENCY_MAX_ENTRIES = int(os.getenv('IDEMPOTENCY_MAX_ENTRIES', '10000'))
+    IDEMPOTENCY_WAIT_SECONDS = float(os.getenv('IDEMPOTENCY_WAIT_SECONDS', '0'))  # Espera de un reintento a que termine la original
+    IDEMPOTENCY_SHARED_STORE = os.getenv('IDEMPOTENCY_SHARED_STORE', 'none').lower()  # none | bigquery
+    IDEMPOTENCY_TABLE_NAME = os.getenv('IDEMPOTENCY_TABLE_NAME', 'scrape_idempotency_keys')
 
     @classmethod
     def validate(cls):
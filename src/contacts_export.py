@@ -0,0 +1,299 @@
+"""
+Exportación de la tabla de contactos con la BigQuery Storage Read API.
+
+ContactsExporter abre una sesión de lectura sobre la tabla (con filtros por biz_identifier y
+marca de agua de src_scraped_dt aplicados en el servidor), lee sus streams en paralelo como
+record batches de Arrow y los entrega a medida que llegan. Entre la lectura y el envío hay una
+cola acotada: si el cliente consume lento, los streams esperan en lugar de acumular la tabla
+en memoria.
+
+Con el modelo normalizado (contactos con solo los datos de la persona y una tabla de empresas)
+la Storage Read API no puede leer la vista plana: se leen las empresas del filtro en memoria y
+se unen a cada record batch de contactos, de modo que la salida conserva la forma plana.
+
+La marca de agua que se devuelve queda overlap_seconds antes del mayor src_scraped_dt leído: un
+MERGE que termina tarde puede hacer visibles filas con src_scraped_dt anterior al máximo ya
+exportado. Las exportaciones incrementales se solapan, así que el cliente debe deduplicar por
+biz_identifier + web_linkedin_url (quedándose con el src_scraped_dt más reciente).
+"""
+
+import io
+import logging
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+try:
+    from google.cloud import bigquery_storage_v1
+    from google.cloud.bigquery_storage_v1 import types as storage_types
+except ImportError:  # pragma: no cover - dependencia opcional
+    bigquery_storage_v1 = None
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('ndjson', 'arrow')
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+WATERMARK_COLUMN = 'src_scraped_dt'
+
+_END_OF_STREAM = object()
+
+
+def _quote(value: str) -> str:
+    """Literal de string para row_restriction"""
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def build_row_restriction(biz_identifiers: Optional[Sequence[str]] = None, since: Optional[datetime] = None) -> str:
+    """Filtro SQL de la sesión: empresas indicadas y filas con src_scraped_dt desde since (inclusive)"""
+    conditions = []
+    if biz_identifiers:
+        conditions.append(f"biz_identifier IN ({', '.join(_quote(value) for value in biz_identifiers)})")
+    if since is not None:
+        conditions.append(f"{WATERMARK_COLUMN} >= CAST({_quote(since.isoformat())} AS TIMESTAMP)")
+    return ' AND '.join(conditions)
+
+
+class ExportStats:
+    """Conteo de una exportación en curso (filas, batches y marca de agua para la siguiente)"""
+
+    def __init__(self, since: Optional[datetime] = None, overlap_seconds: float = 0) -> None:
+        self.rows = 0
+        self.batches = 0
+        self.streams = 0
+        self.since = since
+        self.max_scraped_dt = None
+        self.overlap = timedelta(seconds=overlap_seconds)
+
+    @property
+    def watermark(self) -> Optional[datetime]:
+        """since de la siguiente exportación: el mayor src_scraped_dt menos el solape (nunca antes de since)"""
+        if self.max_scraped_dt is None:
+            return self.since
+        watermark = self.max_scraped_dt - self.overlap
+        return max(watermark, self.since) if self.since is not None else watermark
+
+    def add(self, batch: pa.RecordBatch) -> None:
+        self.rows += batch.num_rows
+        self.batches += 1
+        if WATERMARK_COLUMN in batch.schema.names and batch.num_rows:
+            batch_max = pc.max(batch.column(WATERMARK_COLUMN)).as_py()
+            if batch_max is not None and (self.max_scraped_dt is None or batch_max > self.max_scraped_dt):
+                self.max_scraped_dt = batch_max
+
+
+class ExportSession:
+    """Sesión de lectura de los contactos y, con la tabla de empresas aparte, la de sus empresas"""
+
+    def __init__(self, contacts, companies=None, columns: Optional[List[str]] = None) -> None:
+        self.contacts = contacts
+        self.companies = companies
+        # Orden de las columnas de salida (None = el de la tabla plana)
+        self.columns = columns
+
+    @property
+    def streams(self):
+        return self.contacts.streams
+
+
+class ContactsExporter:
+    """Lector paralelo de la tabla de contactos (ver el docstring del módulo)"""
+
+    def __init__(self, project: str, dataset: str, table: str, max_streams: int = 4, queue_batches: int = 8,
+                 lz4: bool = True, read_client=None, companies_table: Optional[str] = None,
+                 company_columns: Sequence[str] = ()) -> None:
+        if bigquery_storage_v1 is None:
+            raise RuntimeError("google-cloud-bigquery-storage no está instalado")
+        self.__project = project
+        self.__table_path = f"projects/{project}/datasets/{dataset}/tables/{table}"
+        self.__companies_path = f"projects/{project}/datasets/{dataset}/tables/{companies_table}" if companies_table else None
+        self.__company_columns = list(company_columns)
+        self.__max_streams = max(1, max_streams)
+        self.__queue_batches = max(1, queue_batches)
+        self.__lz4 = lz4
+        # El cliente gRPC se crea en el worker (después del fork), en la primera exportación
+        self.__read_client = read_client
+        self.__client_lock = threading.Lock()
+
+    def __client(self):
+        if self.__read_client is None:
+            with self.__client_lock:
+                if self.__read_client is None:
+                    self.__read_client = bigquery_storage_v1.BigQueryReadClient()
+        return self.__read_client
+
+    def open_session(self, biz_identifiers: Optional[Sequence[str]] = None, since: Optional[datetime] = None,
+                     columns: Optional[Sequence[str]] = None) -> ExportSession:
+        """Crea la sesión de lectura; BigQuery reparte la tabla en hasta max_streams streams"""
+        columns = list(columns or [])
+        if self.__companies_path is None:
+            return ExportSession(self.__create_session(self.__table_path, columns,
+                                                       build_row_restriction(biz_identifiers, since)))
+
+        company_columns = [column for column in columns if column in self.__company_columns] if columns else self.__company_columns
+        person_columns = [column for column in columns if column not in self.__company_columns]
+        if columns and company_columns and 'biz_identifier' not in person_columns:
+            # Clave para unir las empresas; no sale en la exportación si no se pidió
+            person_columns.append('biz_identifier')
+        contacts = self.__create_session(self.__table_path, person_columns, build_row_restriction(biz_identifiers, since))
+        companies = None
+        if company_columns:
+            companies = self.__create_session(self.__companies_path, ['biz_identifier'] + company_columns,
+                                              build_row_restriction(biz_identifiers))
+        return ExportSession(contacts, companies, columns or None)
+
+    def __create_session(self, table_path: str, columns: List[str], row_restriction: str):
+        read_options = storage_types.ReadSession.TableReadOptions(
+            selected_fields=columns,
+            row_restriction=row_restriction,
+        )
+        if self.__lz4:
+            read_options.arrow_serialization_options = storage_types.ArrowSerializationOptions(
+                buffer_compression=storage_types.ArrowSerializationOptions.CompressionCodec.LZ4_FRAME
+            )
+        session = self.__client().create_read_session(
+            parent=f"projects/{self.__project}",
+            read_session=storage_types.ReadSession(
+                table=table_path,
+                data_format=storage_types.DataFormat.ARROW,
+                read_options=read_options,
+            ),
+            max_stream_count=self.__max_streams,
+        )
+        logger.info(f"📤 Sesión de exportación de {table_path} con {len(session.streams)} streams")
+        return session
+
+    @staticmethod
+    def _read_schema(read_session) -> pa.Schema:
+        return pa.ipc.read_schema(pa.py_buffer(read_session.arrow_schema.serialized_schema))
+
+    def session_schema(self, session: ExportSession) -> pa.Schema:
+        """Schema de la exportación: columnas de los contactos más las de su empresa"""
+        schema = self._read_schema(session.contacts)
+        if session.companies is None:
+            return schema
+        fields = {field.name: field for field in schema}
+        # Un contacto sin fila en la tabla de empresas sale con esas columnas nulas
+        fields.update({field.name: field.with_nullable(True) for field in self._read_schema(session.companies)
+                       if field.name != 'biz_identifier'})
+        names = session.columns or (['biz_identifier'] + [column for column in self.__company_columns if column in fields]
+                                    + [name for name in schema.names if name != 'biz_identifier'])
+        return pa.schema([fields[name] for name in names])
+
+    def iter_record_batches(self, session: ExportSession, stats: Optional[ExportStats] = None) -> Iterator[pa.RecordBatch]:
+        """
+        Genera los record batches de todos los streams de la sesión a medida que llegan (sin
+        orden entre streams). Si el generador se cierra antes de terminar (cliente desconectado),
+        los hilos de lectura se detienen.
+        """
+        if stats is not None:
+            stats.streams = len(session.streams)
+        companies = None
+        if session.companies is not None:
+            # Las empresas del filtro son pocas frente a sus contactos: se leen completas antes
+            schema = self.session_schema(session)
+            companies = pa.Table.from_batches(list(self.__iter_session(session.companies)),
+                                              schema=self._read_schema(session.companies))
+        batches = self.__iter_session(session.contacts)
+        try:
+            for batch in batches:
+                parts = [batch] if companies is None else self.__join_companies(batch, companies, schema).to_batches()
+                for part in parts:
+                    if stats is not None:
+                        stats.add(part)
+                    yield part
+        finally:
+            batches.close()
+
+    @staticmethod
+    def __join_companies(batch: pa.RecordBatch, companies: pa.Table, schema: pa.Schema) -> pa.Table:
+        joined = pa.Table.from_batches([batch]).join(companies, 'biz_identifier', join_type='left outer')
+        return joined.select(schema.names).cast(schema).combine_chunks()
+
+    def __iter_session(self, read_session) -> Iterator[pa.RecordBatch]:
+        streams = list(read_session.streams)
+        if not streams:
+            return
+        schema = self._read_schema(read_session)
+        batches: queue.Queue = queue.Queue(maxsize=self.__queue_batches)
+        stop = threading.Event()
+
+        # Sin "with": al cerrar el generador no se espera a que terminen los streams
+        executor = ThreadPoolExecutor(max_workers=len(streams), thread_name_prefix="contacts-export")
+        for stream in streams:
+            executor.submit(self.__read_stream, stream.name, schema, batches, stop)
+        finished = 0
+        try:
+            while finished < len(streams):
+                item = batches.get()
+                if item is _END_OF_STREAM:
+                    finished += 1
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def __read_stream(self, stream_name: str, schema: pa.Schema, batches: queue.Queue, stop: threading.Event) -> None:
+        try:
+            for response in self.__client().read_rows(stream_name):
+                if stop.is_set():
+                    return
+                batch = pa.ipc.read_record_batch(
+                    pa.py_buffer(response.arrow_record_batch.serialized_record_batch), schema
+                )
+                if not self.__put(batches, batch, stop):
+                    return
+            self.__put(batches, _END_OF_STREAM, stop)
+        except Exception as e:
+            logger.error(f"❌ Error leyendo el stream {stream_name}: {e}")
+            self.__put(batches, e, stop)
+
+    @staticmethod
+    def __put(batches: queue.Queue, item, stop: threading.Event) -> bool:
+        # Espera lugar en la cola sin quedar bloqueado si la exportación se cancela
+        while not stop.is_set():
+            try:
+                batches.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+
+def iter_ndjson(batches: Iterator[pa.RecordBatch], dumps: Callable[[Dict], str]) -> Iterator[str]:
+    """Un registro {"type": "contact", ...} por fila; un chunk por record batch"""
+    for batch in batches:
+        yield ''.join(dumps({"type": "contact", **row}) + "\n" for row in batch.to_pylist())
+
+
+def iter_arrow_ipc(schema: pa.Schema, batches: Iterator[pa.RecordBatch]) -> Iterator[bytes]:
+    """Formato Arrow IPC stream: el schema y luego un mensaje por record batch"""
+    sink = io.BytesIO()
+
+    def drain() -> bytes:
+        data = sink.getvalue()
+        sink.seek(0)
+        sink.truncate(0)
+        return data
+
+    with pa.ipc.new_stream(sink, schema) as writer:
+        yield drain()
+        for batch in batches:
+            writer.write_batch(batch)
+            yield drain()
+    yield drain()
+
+
+def parse_identifiers(values: List[str]) -> List[str]:
+    """biz_identifier repetidos o separados por coma, sin vacíos ni repetidos"""
+    identifiers = []
+    for value in values:
+        identifiers.extend(part.strip() for part in str(value).split(',') if part.strip())
+    return list(dict.fromkeys(identifiers))
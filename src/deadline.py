@@ -0,0 +1,51 @@
+import time
+from typing import Optional
+
+
+class DeadlineExceeded(Exception):
+    """Se agotó el tiempo de la request antes de terminar una etapa"""
+
+
+class Deadline:
+    """
+    Tiempo límite de una request de /scrape, compartido por todas sus etapas.
+
+    Las etapas de búsqueda y scraping usan remaining(), que descuenta write_reserve segundos
+    para que siempre quede tiempo de escribir en BigQuery lo que se alcanzó a obtener; las
+    escrituras usan remaining(include_reserve=True).
+    """
+
+    def __init__(self, seconds: float, write_reserve: float = 0) -> None:
+        self.__expires_at = time.monotonic() + seconds
+        self.__write_reserve = min(write_reserve, seconds / 2)
+        self.seconds = seconds
+        self.__exceeded = False
+
+    def remaining(self, include_reserve: bool = False) -> float:
+        remaining = self.__expires_at - time.monotonic()
+        if not include_reserve:
+            remaining -= self.__write_reserve
+        return max(0.0, remaining)
+
+    def expired(self) -> bool:
+        if self.remaining() <= 0:
+            self.__exceeded = True
+        return self.__exceeded
+
+    def mark_exceeded(self) -> None:
+        """Registra que una etapa se cortó por el deadline (por ejemplo, un run que no alcanzó a terminar)"""
+        self.__exceeded = True
+
+    @property
+    def exceeded(self) -> bool:
+        """True si alguna etapa ya encontró el deadline vencido"""
+        return self.__exceeded
+
+    def timeout(self, cap: Optional[float] = None, include_reserve: bool = False) -> float:
+        """Timeout para una llamada: lo que queda, sin pasar de cap"""
+        remaining = self.remaining(include_reserve=include_reserve)
+        return remaining if cap is None else min(remaining, cap)
+
+    def check(self, stage: str) -> None:
+        if self.expired():
+            raise DeadlineExceeded(f"Tiempo agotado antes de {stage}")
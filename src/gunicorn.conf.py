@@ -0,0 +1,60 @@
+"""
+Configuración de gunicorn para producción
+
+    gunicorn --config gunicorn.conf.py main:app
+
+Modelo de workers: WEB_CONCURRENCY procesos (por defecto uno por CPU) con MAX_WORKERS hilos
+cada uno (gthread), adecuado para requests largas que pasan la mayor parte del tiempo esperando
+al search service, a Apify y a BigQuery.
+
+La app se importa en el proceso maestro antes del fork (preload_app), de modo que la
+configuración, los secretos y los clientes se cargan una sola vez y se comparten copy-on-write.
+Los hilos en segundo plano (buffer de escritura, prefetcher) se inician en cada worker; los
+prefetchers reservan sus empresas en BigQuery (COMPANY_LEASE_*) para no repartir las mismas.
+"""
+
+import multiprocessing
+import os
+
+bind = f"{os.getenv('FLASK_HOST', '0.0.0.0')}:{os.getenv('PORT', '8080')}"
+
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.getenv('MAX_WORKERS', '5'))
+
+preload_app = True
+
+# En gthread el timeout solo vigila que el worker siga vivo; las requests largas no lo disparan
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '120'))
+# Tiempo para terminar las requests en curso y vaciar el buffer de escritura al apagar/reiniciar
+graceful_timeout = int(os.getenv('GRACEFUL_TIMEOUT', os.getenv('REQUEST_TIMEOUT', '300')))
+keepalive = int(os.getenv('KEEPALIVE', '75'))
+
+# Reinicio escalonado de workers para acotar el crecimiento de memoria
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', '100'))
+
+accesslog = '-'
+errorlog = '-'
+loglevel = os.getenv('GUNICORN_LOG_LEVEL', 'info')
+
+
+def on_starting(server):
+    # Precarga en el maestro: config y secretos ya se cargaron al importar la app
+    import main
+    try:
+        main.create_services()
+    except Exception as e:
+        # Cada worker reintentará crear los clientes en su primera request
+        server.log.warning(f"No se pudieron precargar los servicios: {e}")
+
+
+def post_fork(server, worker):
+    import main
+    main.start_background_tasks()
+
+
+def worker_exit(server, worker):
+    # Drenado: se llama tras terminar las requests en curso (SIGTERM / reinicio por max_requests)
+    import main
+    main.shutdown_services()
@@ -0,0 +1,167 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+NEW = 'new'
+IN_PROGRESS = 'in_progress'
+COMPLETED = 'completed'
+MISMATCH = 'mismatch'
+
+
+def request_fingerprint(body: bytes) -> str:
+    """Huella del body; la misma Idempotency-Key con otro body es un error del cliente"""
+    return hashlib.sha256(body or b'').hexdigest()
+
+
+class IdempotencyRecord:
+    """Estado de una Idempotency-Key: en curso o completada con su respuesta"""
+
+    def __init__(self, key: str, fingerprint: str, expires_at: float, state: str = IN_PROGRESS) -> None:
+        self.key = key
+        self.fingerprint = fingerprint
+        self.state = state
+        self.started_at = time.time()
+        self.expires_at = expires_at
+        self.status_code: Optional[int] = None
+        self.body: Optional[bytes] = None
+        self.mimetype: Optional[str] = None
+        self.done = threading.Event()
+
+
+class IdempotencyStore:
+    """
+    Registro de Idempotency-Key de /scrape con TTL.
+
+    begin() reserva una llave de forma atómica: la primera request la ejecuta y las que llegan
+    con la misma llave reciben la respuesta guardada (COMPLETED) o el estado en curso
+    (IN_PROGRESS), sin repetir búsqueda, run del actor ni escrituras. Las llaves completadas
+    duran ttl_seconds; las en curso, in_progress_ttl (por si el worker muere sin terminarlas).
+
+    shared (opcional) es un registro compartido entre workers e instancias con los métodos
+    claim_idempotency_key, save_idempotency_response y release_idempotency_key de
+    BigQueryService. Si falla se sigue solo con el registro local.
+    """
+
+    def __init__(self, ttl_seconds: float = 3600, in_progress_ttl: float = 900, max_entries: int = 10000,
+                 shared=None) -> None:
+        self.__ttl_seconds = ttl_seconds
+        self.__in_progress_ttl = in_progress_ttl
+        self.__max_entries = max_entries
+        self.__shared = shared
+        self.__lock = threading.Lock()
+        self.__records: "OrderedDict[str, IdempotencyRecord]" = OrderedDict()
+        self.__stats = {'started': 0, 'replayed': 0, 'in_progress_hits': 0, 'mismatches': 0,
+                        'completed': 0, 'released': 0, 'shared_errors': 0}
+
+    def begin(self, key: str, fingerprint: str) -> Tuple[str, Optional[IdempotencyRecord]]:
+        """
+        Returns:
+            (NEW, record) si esta request debe ejecutar el trabajo (y luego llamar complete o release),
+            (IN_PROGRESS | COMPLETED | MISMATCH, record) si no
+        """
+        now = time.time()
+        with self.__lock:
+            record = self.__records.get(key)
+            if record is not None and record.expires_at <= now:
+                self.__records.pop(key)
+                record = None
+            if record is None:
+                record = IdempotencyRecord(key, fingerprint, now + self.__in_progress_ttl)
+                self.__records[key] = record
+                while len(self.__records) > self.__max_entries:
+                    self.__records.popitem(last=False)
+                state = NEW
+            else:
+                state = self.__state_for(record, fingerprint)
+
+        if state == NEW and self.__shared is not None:
+            state, record = self.__begin_shared(record)
+        with self.__lock:
+            self.__stats[{NEW: 'started', COMPLETED: 'replayed', IN_PROGRESS: 'in_progress_hits',
+                          MISMATCH: 'mismatches'}[state]] += 1
+        return state, record
+
+    @staticmethod
+    def __state_for(record: IdempotencyRecord, fingerprint: str) -> str:
+        if record.fingerprint != fingerprint:
+            return MISMATCH
+        return record.state
+
+    def __begin_shared(self, record: IdempotencyRecord) -> Tuple[str, IdempotencyRecord]:
+        """Reserva la llave también en el registro compartido (otro worker pudo tomarla antes)"""
+        try:
+            claimed, shared_record = self.__shared.claim_idempotency_key(
+                record.key, record.fingerprint, ttl_seconds=self.__in_progress_ttl
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ Registro de idempotencia compartido no disponible: {e}")
+            with self.__lock:
+                self.__stats['shared_errors'] += 1
+            return NEW, record
+        if claimed:
+            return NEW, record
+
+        # La llave es de otra instancia: se refleja su estado en el registro local
+        with self.__lock:
+            self.__records.pop(record.key, None)
+        other = IdempotencyRecord(record.key, shared_record['fingerprint'], time.time() + self.__in_progress_ttl,
+                                  state=shared_record['state'])
+        if shared_record['state'] == COMPLETED:
+            other.status_code = shared_record['status_code']
+            other.mimetype = shared_record['mimetype']
+            other.body = (shared_record['body'] or '').encode('utf-8')
+            other.done.set()
+        return self.__state_for(other, record.fingerprint), other
+
+    def complete(self, key: str, status_code: int, body: bytes, mimetype: str) -> None:
+        """Guarda la respuesta de una llave propia; los reintentos la reciben hasta que expira"""
+        with self.__lock:
+            record = self.__records.get(key)
+            if record is None:
+                return
+            record.state = COMPLETED
+            record.status_code = status_code
+            record.body = body
+            record.mimetype = mimetype
+            record.expires_at = time.time() + self.__ttl_seconds
+            self.__stats['completed'] += 1
+        record.done.set()
+        if self.__shared is not None:
+            try:
+                self.__shared.save_idempotency_response(key, status_code, body.decode('utf-8'), mimetype,
+                                                        ttl_seconds=self.__ttl_seconds)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo guardar la respuesta en el registro de idempotencia compartido: {e}")
+                with self.__lock:
+                    self.__stats['shared_errors'] += 1
+
+    def release(self, key: str) -> None:
+        """Libera una llave propia sin respuesta (error o rechazo): un reintento vuelve a ejecutar"""
+        with self.__lock:
+            record = self.__records.pop(key, None)
+            self.__stats['released'] += 1
+        if record is not None:
+            record.done.set()
+        if self.__shared is not None:
+            try:
+                self.__shared.release_idempotency_key(key)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo liberar la llave en el registro de idempotencia compartido: {e}")
+                with self.__lock:
+                    self.__stats['shared_errors'] += 1
+
+    def wait(self, record: IdempotencyRecord, timeout: float) -> IdempotencyRecord:
+        """Espera hasta timeout segundos a que una llave en curso de este worker termine"""
+        if timeout > 0 and record.state == IN_PROGRESS:
+            record.done.wait(timeout)
+        return record
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            in_progress = sum(1 for record in self.__records.values() if record.state == IN_PROGRESS)
+            return {**self.__stats, 'size': len(self.__records), 'in_progress': in_progress}
@@ -2,11 +2,16 @@ from annotated_types import LowerCase
 import requests
 import json
 import time
-from typing import List, Dict, Tuple
+from typing import List, Dict, Tuple, Iterable, Iterator, Optional
 from apify_client import ApifyClient
 from datetime import datetime
 from config import Config
-from urllib.parse import urlparse
+from apify_dataset_reader import ParallelDatasetReader, SCRAPED_PROFILE_FIELDS
+from deadline import Deadline
+from circuit_breaker import CircuitOpenError, get_circuit_breaker
+from tracing import set_span_attributes, start_span
+from upstream_cassette import get_upstream_cassette
+from linkedin_profile_keys import canonical_profile_key, dedupe_profile_urls, build_profile_index
 
 import logging
 logger = logging.getLogger(__name__)
@@ -15,7 +20,17 @@ class LinkedInContactsSelectiveScraper:
     def __init__(self, serper_api_key: str, apify_token: str):
         self.serper_api_key = serper_api_key
     
-        self.apify_client = ApifyClient(apify_token)
+        self.apify_client = ApifyClient(apify_token, api_url=Config.APIFY_API_URL)
+        cassette = get_upstream_cassette()
+        if cassette is not None:
+            # Runs y datasets grabados en el cassette, o leídos de él sin llamar a Apify
+            self.apify_client = cassette.wrap_apify_client(self.apify_client)
+        self.dataset_reader = ParallelDatasetReader(
+            self.apify_client,
+            page_size=Config.APIFY_DATASET_PAGE_SIZE,
+            max_workers=Config.APIFY_DATASET_MAX_WORKERS,
+            fields=SCRAPED_PROFILE_FIELDS if Config.APIFY_DATASET_PROJECT_FIELDS else None
+        )
 
         # Configuración de proyecto y dataset específicos
         self.project_id = Config.GOOGLE_CLOUD_PROJECT_ID
@@ -33,15 +48,21 @@ class LinkedInContactsSelectiveScraper:
             'profiles_scraped': 0,
             'profiles_with_emails': 0,
             'cost_estimate': 0,
-            'companies_processed': []
+            'companies_processed': [],
+            # False si el run del actor o la lectura del dataset se cortaron por el deadline
+            'run_complete': True
         }
 
         # Resultados finales para guardar en BigQuery
         self.contacts_results = []
 
-    def scrape_selected_profiles(self, selected_profiles: List[Dict]) -> Dict:
+    def scrape_selected_profiles(self, selected_profiles: List[Dict], deadline: Optional[Deadline] = None) -> Dict:
         """
-        Scrapea solo los perfiles seleccionados con dev_fusion
+        Scrapea solo los perfiles seleccionados con dev_fusion.
+
+        Con deadline, el run del actor se limita al tiempo restante (timeout_secs y wait_secs);
+        si no termina a tiempo se aborta y se leen los perfiles que alcanzó a guardar.
+        Si el circuito de Apify está abierto lanza CircuitOpenError sin ejecutar el actor.
         """
 
         if not selected_profiles:
@@ -50,8 +71,10 @@ class LinkedInContactsSelectiveScraper:
 
         logger.info(f"\n🚀 Scrapeando {len(selected_profiles)} perfiles seleccionados...")
 
-        # Extraer URLs
-        profile_urls = [profile['web_linkedin_url'] for profile in selected_profiles]
+        # Extraer URLs, sin repetir perfiles que llegan con distintas variantes de URL
+        profile_urls = dedupe_profile_urls(profile['web_linkedin_url'] for profile in selected_profiles)
+        if len(profile_urls) < len(selected_profiles):
+            logger.info(f"🔁 {len(selected_profiles) - len(profile_urls)} URLs repetidas omitidas, {len(profile_urls)} perfiles únicos")
 
         # Calcular costo estimado
         estimated_cost = (len(profile_urls) / 1000) * 10
@@ -66,17 +89,58 @@ class LinkedInContactsSelectiveScraper:
             logger.info("⏳ Ejecutando dev_fusion/linkedin-profile-scraper...")
             start_time = time.time()
 
-            run = self.apify_client.actor("dev_fusion/linkedin-profile-scraper").call(run_input=run_input)
+            run_limits = {}
+            if deadline is not None:
+                deadline.check("ejecutar el actor")
+                seconds = max(1, int(deadline.remaining()))
+                # Sin logger el cliente no se queda leyendo el log del run después de que termina
+                run_limits = {'timeout_secs': seconds, 'wait_secs': seconds, 'logger': None}
+
+            # Con el circuito abierto se falla de inmediato en lugar de esperar a un actor degradado
+            apify_breaker = get_circuit_breaker('apify')
+            apify_breaker.before_call()
+            with start_span('apify.actor_run', {'apify.actor': "dev_fusion/linkedin-profile-scraper",
+                                                'urls.count': len(profile_urls)}) as span:
+                try:
+                    run = self.apify_client.actor("dev_fusion/linkedin-profile-scraper").call(run_input=run_input, **run_limits)
+                except Exception:
+                    apify_breaker.record_failure()
+                    raise
+                set_span_attributes(span, **{'apify.run_id': run.get('id'), 'apify.run_status': run.get('status'),
+                                             'apify.dataset_id': run.get('defaultDatasetId')})
+            # Un run que falla o que no termina a tiempo cuenta como falla del servicio
+            if run.get('status') == 'SUCCEEDED':
+                apify_breaker.record_success()
+            else:
+                apify_breaker.record_failure()
 
             scraping_time = time.time() - start_time
             
             logger.info(f"⏱️ Tiempo de scraping: {scraping_time:.1f} segundos")
 
-            # Obtener resultados
+            if run.get('status') != 'SUCCEEDED':
+                self.test_metrics['run_complete'] = False
+                if run.get('status') in ('READY', 'RUNNING'):
+                    if deadline is not None:
+                        deadline.mark_exceeded()
+                    logger.warning(f"⏰ El run {run['id']} no terminó a tiempo, se aborta y se usan resultados parciales")
+                    try:
+                        self.apify_client.run(run['id']).abort(gracefully=True)
+                    except Exception as e:
+                        logger.warning(f"⚠️ No se pudo abortar el run {run['id']}: {e}")
+                else:
+                    logger.warning(f"⚠️ El run {run['id']} terminó con estado {run.get('status')}, se usan resultados parciales")
+
+            # Obtener resultados (páginas en paralelo, en orden)
             scraped_profiles = []
-            for item in self.apify_client.dataset(run["defaultDatasetId"]).iterate_items():
-                logger.info(f"🔍 Scraping: {item}")
-                scraped_profiles.append(item)
+            with start_span('apify.dataset_read', {'apify.dataset_id': run["defaultDatasetId"]}) as span:
+                for item in self.dataset_reader.iter_items(run["defaultDatasetId"], deadline=deadline):
+                    logger.info(f"🔍 Scraping: {item}")
+                    scraped_profiles.append(item)
+                set_span_attributes(span, **{'items.count': len(scraped_profiles)})
+            if deadline is not None and deadline.exceeded:
+                logger.warning(f"⏰ Tiempo agotado, {len(scraped_profiles)} perfiles leídos del dataset")
+                self.test_metrics['run_complete'] = False
 
             logger.info(f"✅ Scraping completado:")
             logger.info(f"  Perfiles scrapeados: {len(scraped_profiles)}")
@@ -88,8 +152,12 @@ class LinkedInContactsSelectiveScraper:
                 'run_info': run
             }
 
+        except CircuitOpenError:
+            self.test_metrics['run_complete'] = False
+            raise
         except Exception as e:
             logger.error(f"❌ Error en scraping: {e}")
+            self.test_metrics['run_complete'] = False
             return {'success': False, 'error': e , 'scraped_profiles': []}
 
     def clean_scraped_data(self, scraped_data: List[Dict]) -> Dict:
@@ -127,13 +195,9 @@ class LinkedInContactsSelectiveScraper:
     def standardize_url(self, url: str) -> str:
         """
         Standardizes a URL to ensure consistent keys for a dictionary.
-        
+        Different URL variants of the same profile map to the same canonical key.
         """
-        if not url:
-            return ''
-        # Normalize URL by parsing and re-forming it
-        parsed_url = urlparse(url)
-        return parsed_url.path
+        return canonical_profile_key(url)
 
     def merge_evaluation_and_scraping(self, selected_profiles: List[Dict], scraped_data: List[Dict]) -> List[Dict]:
         """
@@ -142,11 +206,9 @@ class LinkedInContactsSelectiveScraper:
         logger.info("\n🔗 Combinando datos de evaluación con scraping...")
 
 
-        # Crear un diccionario para mapeo rápido por URL
-        scraped_by_url_map = {
-            self.standardize_url(scraped.get('linkedinUrl')): scraped
-        for scraped in scraped_data
-        }
+        # Índice por llave canónica de perfil; cada perfil scrapeado se reparte a todas
+        # las filas de evaluación que lo referencian
+        scraped_by_url_map = build_profile_index(scraped_data, 'linkedinUrl')
 
         merged_profiles = []
 
@@ -162,6 +224,11 @@ class LinkedInContactsSelectiveScraper:
                     scraped_data_match = scraped_by_url_map.get(normalized_url)
 
                     logger.info(f"🔍 Scraped data match: {scraped_data_match}")
+
+                    if scraped_data_match is None:
+                        # El actor no devolvió este perfil (privado, o run cortado por el deadline)
+                        logger.info(f"⚠️ Perfil sin datos scrapeados, se omite: {original_url}")
+                        continue
                     
                     # Preferir campos de evaluación (incluida 'explicacion') y fusionar datos scrapeados si existen
                     scraped_fields = scraped_data_match or {}
@@ -176,7 +243,7 @@ class LinkedInContactsSelectiveScraper:
                     logger.error(f"❌ Error formateando los datos del perfil: {original_url}  msg:{e}")
                     continue
             
-            logger.info(f"✅ Perfiles combinados: {merged_profile}")
+            logger.info(f"✅ Perfiles combinados: {merged_profiles}")
             print(f"✅ Combinados {len(merged_profiles)} perfiles")
             return merged_profiles
 
@@ -190,8 +257,15 @@ class LinkedInContactsSelectiveScraper:
         """
         print("\n📊 Procesando contactos para BigQuery...")
 
-        contacts_data = []
+        contacts_data = list(self.iter_contacts_for_bigquery(merged_profiles))
+
+        print(f"\n📈 Total contactos procesados: {len(contacts_data)}")
+        return contacts_data
 
+    def iter_contacts_for_bigquery(self, merged_profiles: Iterable[Dict]) -> Iterator[Dict]:
+        """
+        Genera los registros de contacto uno a uno, a medida que se formatea cada perfil
+        """
         for profile in merged_profiles:
             # Crear registro de contacto
             contact_record = {
@@ -214,22 +288,19 @@ class LinkedInContactsSelectiveScraper:
                 'cntry_value': profile['addressCountryOnly'],
                 'cntry_city_value': profile['addressWithCountry'],
                 'src_scraped_dt': datetime.now(),
-                'ai_score_cat': profile['ai_score_cat'],
-                'ai_explanation': profile['ai_explanation'],
-                'ai_current_biz_flg': profile['ai_current_biz_flg'],
-                'ai_role_finance_flg': profile['ai_role_finance_flg']
+                # Los campos de IA pueden faltar si el modelo no alcanzó a evaluar el perfil
+                'ai_score_value': profile.get('ai_score_value'),
+                'ai_score_cat': profile.get('ai_score_cat'),
+                'ai_explanation': profile.get('ai_explanation'),
+                'ai_current_biz_flg': profile.get('ai_current_biz_flg'),
+                'ai_role_finance_flg': profile.get('ai_role_finance_flg')
             }
 
-            contacts_data.append(contact_record)
             print(f"  ✅ Contacto procesado: {contact_record['full_name']} - {contact_record['role']}")
-
-    #tendria que pushear
-            
-        print(f"\n📈 Total contactos procesados: {len(contacts_data)}")
-        return contacts_data
+            yield contact_record
 
 
-    def scrape_linkedin_profiles(self, profiles: List[Dict] ):
+    def scrape_linkedin_profiles(self, profiles: List[Dict], deadline: Optional[Deadline] = None):
         """
         Ejecuta el test selectivo completo
         """
@@ -238,7 +309,7 @@ class LinkedInContactsSelectiveScraper:
 
         logger.info(f"🔍 Selected profiles: {selected_profiles}")
 
-        scraping_results = self.scrape_selected_profiles(selected_profiles)
+        scraping_results = self.scrape_selected_profiles(selected_profiles, deadline=deadline)
 
         if not scraping_results['success']:
             logger.error(f"❌ Error en scraping: {scraping_results['error']}")
@@ -246,17 +317,19 @@ class LinkedInContactsSelectiveScraper:
         
         logger.info(f"🔍 Scraping results: {scraping_results['scraped_profiles']}")
 
-        # . Limpia los datos scrapeados
-        cleaned_scraped_data = self.clean_scraped_data(scraping_results['scraped_profiles'])
+        with start_span('scrape.clean_and_merge', {'items.count': len(scraping_results['scraped_profiles'])}) as span:
+            # . Limpia los datos scrapeados
+            cleaned_scraped_data = self.clean_scraped_data(scraping_results['scraped_profiles'])
 
-        logger.info(f"🔍 Cleaned scraped data: {cleaned_scraped_data}")
+            logger.info(f"🔍 Cleaned scraped data: {cleaned_scraped_data}")
 
-        # . Combinar datos de evaluación con scraping
+            # . Combinar datos de evaluación con scraping
 
-        merged_profiles = self.merge_evaluation_and_scraping(
-            selected_profiles,
-            cleaned_scraped_data
-        )
+            merged_profiles = self.merge_evaluation_and_scraping(
+                selected_profiles,
+                cleaned_scraped_data
+            )
+            set_span_attributes(span, **{'profiles.merged': len(merged_profiles)})
         
  
         return merged_profiles
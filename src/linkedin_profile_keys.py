@@ -0,0 +1,64 @@
+import unicodedata
+from typing import Dict, Iterable, List
+from urllib.parse import unquote, urlparse
+
+# Prefijos de ruta que identifican un perfil personal de LinkedIn
+PROFILE_PATH_PREFIXES = ('in', 'pub')
+
+
+def canonical_profile_key(url: str) -> str:
+    """
+    Obtiene la llave canónica de un perfil de LinkedIn a partir de cualquier variante de su URL.
+
+    Todas estas URLs producen la llave 'in/foo':
+        https://www.linkedin.com/in/foo
+        https://mx.linkedin.com/in/foo/
+        https://mx.linkedin.com/in/foo/en
+        linkedin.com/in/FOO?trk=abc
+        /in/f%6Fo
+
+    Se decodifica el percent-encoding, se normaliza a minúsculas y Unicode NFC, y se descarta
+    todo lo que viene después del slug (sufijo de idioma, subrutas, query y fragmento).
+    Para URLs que no son de perfil se retorna la ruta normalizada.
+    """
+    if not url:
+        return ''
+
+    url = str(url).strip()
+    if '//' not in url and not url.startswith('/'):
+        url = f"https://{url}"
+
+    path = unquote(urlparse(url).path)
+    path = unicodedata.normalize('NFC', path).lower()
+    segments = [segment for segment in path.split('/') if segment]
+
+    if len(segments) >= 2 and segments[0] in PROFILE_PATH_PREFIXES:
+        if segments[0] == 'in':
+            return f"in/{segments[1]}"
+        # Formato antiguo: /pub/nombre/xx/yyy/zzz, el sufijo de idioma va al final
+        return '/'.join(segments[:5])
+
+    return '/'.join(segments)
+
+
+def dedupe_profile_urls(urls: Iterable[str]) -> List[str]:
+    """Elimina URLs que apuntan al mismo perfil, conservando la primera aparición y el orden"""
+    seen = set()
+    unique_urls = []
+    for url in urls:
+        key = canonical_profile_key(url)
+        if not key or key in seen:
+            continue
+        seen.add(key)
+        unique_urls.append(url)
+    return unique_urls
+
+
+def build_profile_index(profiles: Iterable[Dict], url_field: str) -> Dict[str, Dict]:
+    """Indexa perfiles por llave canónica; si hay repetidos se conserva el primero"""
+    index = {}
+    for profile in profiles:
+        key = canonical_profile_key(profile.get(url_field))
+        if key and key not in index:
+            index[key] = profile
+    return index
@@ -1,12 +1,38 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, Response, stream_with_context, g, send_file
 from flask_cors import CORS
 from config import Config
+import json
 import logging
-from bigquery_services import BigQueryService
+import math
+import queue
+import random
+import uuid
+from bigquery_services import COMPANY_COLUMNS, BigQueryService
 from linkedin_contacts_scrapper import LinkedInContactsSelectiveScraper
-from datetime import datetime
-from typing import List, Dict
-import requests
+from company_prefetcher import PendingCompaniesPrefetcher, lease_owner
+from rescrape_scheduler import RescrapeScheduler
+from scraped_index import ScrapedCompaniesIndex
+from profile_scoring import ProfileScorer
+from profile_selection import TIE_BREAKERS
+from deadline import Deadline
+from scrape_pipeline import iter_scrape_companies
+from single_flight import SingleFlight
+from request_profiler import ProfileStore, SamplingProfiler
+from response_encoding import ResponseCompressor, ResponseStats, create_json_provider
+from circuit_breaker import CircuitOpenError, circuit_breaker_stats, get_circuit_breaker
+from admission_control import AdmissionController, AdmissionRejected
+from idempotency import COMPLETED, IN_PROGRESS, MISMATCH, NEW, IdempotencyStore, request_fingerprint
+from bigquery_cost import QueryUsage
+from contacts_export import (ARROW_STREAM_MIMETYPE, EXPORT_FORMATS, ContactsExporter, ExportStats,
+                             iter_arrow_ipc, iter_ndjson, parse_identifiers)
+from tracing import configure_tracing, extract_trace_context, set_span_attributes, shutdown_tracing, start_span
+from upstream_cassette import close_upstream_cassette, get_upstream_cassette
+from datetime import datetime, timezone
+from google.api_core.exceptions import ClientError
+from typing import List, Dict, Optional
+import signal
+import sys
+import threading
 
 
 
@@ -21,32 +47,422 @@ logger = logging.getLogger(__name__)
 app = Flask(__name__)
 CORS(app)  # Habilitar CORS para requests cross-origin
 
+# Serialización JSON (jsonify, dicts de las vistas y líneas NDJSON) y compresión de respuestas
+response_stats = ResponseStats()
+app.json = create_json_provider(app, Config.JSON_ENCODER, stats=response_stats)
+
+# Trazas de /scrape (ver tracing.py); sin hilos antes del fork, se puede configurar al importar
+configure_tracing(Config.TRACING_ENABLED, exporter=Config.TRACING_EXPORTER, file_path=Config.TRACING_FILE,
+                  service_name=Config.TRACING_SERVICE_NAME, sample_rate=Config.TRACING_SAMPLE_RATE)
+
 bigquery_service = None
 secret_manager = None
+companies_prefetcher = None
+rescrape_scheduler = None
+scraped_index = None
+profile_scorer = None
+idempotency_store = None
+contacts_exporter = None
+_services_lock = threading.Lock()
+_background_started = False
 
+# Scrapings en curso por biz_identifier, para que requests concurrentes por la misma empresa
+# compartan un solo scraping
+scrape_flights = SingleFlight()
+
+# Límite de scrapings simultáneos por worker; el resto se rechaza con 503 en lugar de acumular hilos
+scrape_admission = AdmissionController(
+    max_in_flight=Config.ADMISSION_MAX_IN_FLIGHT,
+    max_queued=Config.ADMISSION_MAX_QUEUED,
+    queue_timeout=Config.ADMISSION_QUEUE_TIMEOUT,
+    retry_after=Config.ADMISSION_RETRY_AFTER
+)
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+
+
+def wants_ndjson() -> bool:
+    """Indica si el cliente pidió una respuesta en streaming NDJSON (?stream=true o Accept)"""
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return request.accept_mimetypes.best == NDJSON_MIMETYPE
 
-def get_services():
-    try: 
-        # Inicializar BigQuery service
-        bigquery_service = BigQueryService(
-            project = Config.GOOGLE_CLOUD_PROJECT_ID,
-            dataset = Config.BIGQUERY_DATASET,
-            table_control_name = Config.CONTROL_TABLE_NAME,
-            table_info_name = Config.LINKEDIN_INFO_TABLE_NAME
-        )
-        logger.info("✅ Servicios inicializados correctamente")
-    except Exception as e:
-        logger.error(f"❌ Error inicializando servicios: {e}")
-        raise
+
+def service_unavailable(error: Exception):
+    """Respuesta 503 con Retry-After para AdmissionRejected y CircuitOpenError"""
+    retry_after = max(1, math.ceil(getattr(error, 'retry_after', Config.ADMISSION_RETRY_AFTER)))
+    response = jsonify({"error": f"{error}", "retry_after": retry_after})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(retry_after)
+    return response
+
+
+def create_services():
+    """
+    Crea los clientes compartidos sin iniciar hilos en segundo plano.
+    Es seguro llamarla antes de hacer fork (ver gunicorn.conf.py, preload_app).
+    """
+    global bigquery_service
+
+    if bigquery_service is not None:
+        return bigquery_service
+
+    with _services_lock:
+        if bigquery_service is None:
+            try: 
+                # Inicializar BigQuery service (compartido entre requests)
+                bigquery_service = BigQueryService(
+                    project = Config.GOOGLE_CLOUD_PROJECT_ID,
+                    dataset = Config.BIGQUERY_DATASET,
+                    table_control_name = Config.CONTROL_TABLE_NAME,
+                    table_info_name = Config.LINKEDIN_INFO_TABLE_NAME
+                )
+                logger.info("✅ Servicios inicializados correctamente")
+            except Exception as e:
+                logger.error(f"❌ Error inicializando servicios: {e}")
+                raise
 
     return bigquery_service
 
 
+def start_background_tasks():
+    """Inicia los hilos del proceso actual (los hilos no sobreviven a un fork, por eso van aparte)"""
+    global _background_started, scraped_index
+
+    if _background_started or bigquery_service is None:
+        return
+    with _services_lock:
+        if _background_started:
+            return
+        if Config.WRITE_BEHIND_ENABLED:
+            bigquery_service.enable_write_behind(
+                max_rows=Config.WRITE_BEHIND_MAX_ROWS,
+                max_age_seconds=Config.WRITE_BEHIND_MAX_AGE,
+                max_retries=Config.WRITE_BEHIND_MAX_RETRIES,
+                retry_backoff=Config.WRITE_BEHIND_RETRY_BACKOFF
+            )
+        if Config.SCRAPED_INDEX_ENABLED:
+            scraped_index = ScrapedCompaniesIndex(
+                loader=lambda since: bigquery_service.iter_scraped_companies(since=since),
+                refresh_interval=Config.SCRAPED_INDEX_REFRESH_INTERVAL,
+                full_reload_interval=Config.SCRAPED_INDEX_FULL_RELOAD_INTERVAL
+            )
+            bigquery_service.add_control_write_listener(scraped_index.apply_control_rows)
+            scraped_index.start()
+        _background_started = True
+
+
+def get_services():
+    create_services()
+    start_background_tasks()
+    return bigquery_service
+
+
+def shutdown_services():
+    """Detiene el prefetcher y escribe las filas pendientes del buffer (drenado al apagar un worker)"""
+    if companies_prefetcher is not None:
+        companies_prefetcher.stop()
+    if scraped_index is not None:
+        scraped_index.stop()
+    if bigquery_service is not None and bigquery_service.write_behind_enabled:
+        bigquery_service.close()
+    shutdown_tracing()
+    close_upstream_cassette()
+
+
+def get_prefetcher() -> PendingCompaniesPrefetcher:
+    """Retorna el prefetcher de empresas pendientes compartido, iniciándolo si hace falta"""
+    global companies_prefetcher, rescrape_scheduler
+
+    if companies_prefetcher is None:
+        service = get_services()
+        with _services_lock:
+            if companies_prefetcher is None:
+                if Config.RESCRAPE_ENABLED:
+                    # Nuevas primero, después refrescos y reintentos priorizados por frescura y resultado
+                    rescrape_scheduler = RescrapeScheduler.from_config(service)
+                    loader = rescrape_scheduler.next_batch
+                else:
+                    loader = lambda limit, exclude: service.load_companies_from_bigquery_linkedin_contacts(limit, exclude=exclude)
+                claimer = unclaimer = None
+                if Config.COMPANY_LEASE_ENABLED:
+                    # Cada worker reserva lo que prefetchea para no entregar las mismas empresas que otro
+                    owner = lease_owner()
+                    claimer = lambda companies: service.claim_companies(companies, owner, Config.COMPANY_LEASE_TTL)
+                    unclaimer = lambda companies: service.release_company_leases(companies, owner)
+                companies_prefetcher = PendingCompaniesPrefetcher(
+                    loader=loader,
+                    block_size=Config.PREFETCH_BLOCK_SIZE,
+                    low_water_mark=Config.PREFETCH_LOW_WATER_MARK,
+                    max_queue_size=Config.PREFETCH_MAX_QUEUE_SIZE,
+                    completed_ttl=Config.PREFETCH_COMPLETED_TTL,
+                    empty_backoff=Config.PREFETCH_EMPTY_BACKOFF,
+                    claimer=claimer,
+                    unclaimer=unclaimer,
+                    lease_ttl=Config.COMPANY_LEASE_TTL,
+                    lease_margin=Config.BATCH_TIMEOUT,
+                    requeue_backoff=Config.PREFETCH_REQUEUE_BACKOFF,
+                    max_requeues=Config.PREFETCH_MAX_REQUEUES
+                )
+    companies_prefetcher.start()
+    return companies_prefetcher
+
+
+def get_profile_scorer():
+    """
+    Retorna el evaluador de perfiles compartido (su cache es por proceso; la cuenta de requests
+    por modelo se comparte en BigQuery con Config.MODEL_QUOTA_SHARED_STORE)
+    """
+    global profile_scorer
+
+    if not Config.PROFILE_SCORING_ENABLED:
+        return None
+    if profile_scorer is None:
+        quota_store = get_services()
+        with _services_lock:
+            if profile_scorer is None:
+                profile_scorer = ProfileScorer.from_config(quota_store=quota_store)
+    return profile_scorer
+
+
+def get_contacts_exporter() -> ContactsExporter:
+    """Lector de la tabla de contactos con la Storage Read API (su cliente gRPC es por proceso)"""
+    global contacts_exporter
+
+    if contacts_exporter is None:
+        with _services_lock:
+            if contacts_exporter is None:
+                # Con el modelo normalizado se leen los contactos y se les unen los datos de su empresa
+                contacts_exporter = ContactsExporter(
+                    project=Config.GOOGLE_CLOUD_PROJECT_ID,
+                    dataset=Config.BIGQUERY_DATASET,
+                    table=Config.LINKEDIN_PERSONS_TABLE_NAME if Config.CONTACTS_NORMALIZED else Config.LINKEDIN_INFO_TABLE_NAME,
+                    max_streams=Config.EXPORT_MAX_STREAMS,
+                    queue_batches=Config.EXPORT_QUEUE_BATCHES,
+                    lz4=Config.EXPORT_LZ4,
+                    companies_table=Config.LINKEDIN_COMPANIES_TABLE_NAME if Config.CONTACTS_NORMALIZED else None,
+                    company_columns=COMPANY_COLUMNS
+                )
+    return contacts_exporter
+
+
+def get_idempotency_store() -> IdempotencyStore:
+    """Registro de Idempotency-Key del proceso (con registro compartido en BigQuery si se configura)"""
+    global idempotency_store
+
+    if idempotency_store is None:
+        shared = get_services() if Config.IDEMPOTENCY_SHARED_STORE == 'bigquery' else None
+        with _services_lock:
+            if idempotency_store is None:
+                idempotency_store = IdempotencyStore(
+                    ttl_seconds=Config.IDEMPOTENCY_TTL,
+                    # Una request en curso no puede durar más que el timeout de lote
+                    in_progress_ttl=Config.BATCH_TIMEOUT + 60,
+                    max_entries=Config.IDEMPOTENCY_MAX_ENTRIES,
+                    shared=shared
+                )
+    return idempotency_store
+
+
+if Config.PROFILING_ENABLED:
+    # Los hooks solo se registran si el profiling está habilitado, así no hay costo cuando está apagado
+    profile_store = ProfileStore(Config.PROFILE_DIR, max_profiles=Config.PROFILE_MAX_FILES)
+
+    @app.before_request
+    def start_request_profiler():
+        if request.path.startswith('/debug/'):
+            return
+        requested = request.headers.get('X-Profile', '').lower() in ('1', 'true', 'yes')
+        if not requested and random.random() >= Config.PROFILE_SAMPLE_RATE:
+            return
+        g.request_id = request.headers.get('X-Request-ID') or uuid.uuid4().hex
+        g.profiler = SamplingProfiler(threading.get_ident(), interval=Config.PROFILE_INTERVAL)
+        g.profiler.start()
+
+    @app.after_request
+    def stop_request_profiler(response):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return response
+        request_id = g.request_id
+        response.headers['X-Request-ID'] = request_id
+
+        def save_profile():
+            # Se ejecuta al cerrar la respuesta, para incluir el tiempo de las respuestas en streaming
+            profiler.stop()
+            name = profile_store.save(request_id, profiler)
+            logger.info(f"🔬 Profile {name}: {profiler.sample_count} muestras en {profiler.duration:.2f}s")
+
+        response.call_on_close(save_profile)
+        return response
+
+    @app.route("/debug/profiles", methods=['GET'])
+    def list_profiles():
+        """Lista los profiles guardados, del más reciente al más antiguo"""
+        return jsonify({"profiles": profile_store.list()})
+
+    @app.route("/debug/profiles/<name>", methods=['GET'])
+    def download_profile(name):
+        """Descarga un profile en formato folded (speedscope / flamegraph.pl)"""
+        path = profile_store.path(name)
+        if path is None:
+            return jsonify({"error": f"Profile {name} no encontrado"}), 404
+        return send_file(path, mimetype='text/plain', as_attachment=True, download_name=name)
+
+
+if Config.COMPRESSION_ENABLED:
+    response_compressor = ResponseCompressor(
+        min_size=Config.COMPRESSION_MIN_SIZE,
+        gzip_level=Config.COMPRESSION_GZIP_LEVEL,
+        brotli_quality=Config.COMPRESSION_BROTLI_QUALITY,
+        stats=response_stats
+    )
+
+    @app.after_request
+    def compress_response(response):
+        return response_compressor.compress(response, request.accept_encodings)
+
+
+if Config.IDEMPOTENCY_ENABLED:
+    # Se registra antes del control de admisión: un reintento no ocupa lugar ni se rechaza por saturación
+    @app.before_request
+    def begin_idempotent_scrape():
+        """Con Idempotency-Key, un reintento de /scrape recibe la respuesta guardada o el estado en curso"""
+        if request.endpoint != 'scrape':
+            return None
+        key = request.headers.get(IDEMPOTENCY_HEADER, '').strip()
+        if not key:
+            return None
+        if len(key) > 255:
+            return jsonify({"error": f"{IDEMPOTENCY_HEADER} debe tener a lo más 255 caracteres"}), 400
+
+        store = get_idempotency_store()
+        state, record = store.begin(key, request_fingerprint(request.get_data()))
+        if state == IN_PROGRESS:
+            state = store.wait(record, Config.IDEMPOTENCY_WAIT_SECONDS).state
+        if state == NEW:
+            g.idempotency_key = key
+            return None
+        if state == MISMATCH:
+            return jsonify({"error": f"{IDEMPOTENCY_HEADER} ya se usó con otro body"}), 422
+        if state == COMPLETED:
+            logger.info(f"🔁 Respuesta repetida para {IDEMPOTENCY_HEADER} {key}")
+            response = app.response_class(record.body, status=record.status_code, mimetype=record.mimetype)
+            response.headers['Idempotency-Replayed'] = 'true'
+            return response
+        response = jsonify({
+            "status": "in_progress",
+            "idempotency_key": key,
+            "started_at": datetime.fromtimestamp(record.started_at).isoformat()
+        })
+        response.status_code = 409
+        response.headers['Retry-After'] = str(Config.ADMISSION_RETRY_AFTER)
+        return response
+
+    @app.after_request
+    def finish_idempotent_scrape(response):
+        # Se guarda antes de comprimir; solo las respuestas exitosas se repiten
+        key = g.pop('idempotency_key', None)
+        if key is None:
+            return response
+        store = get_idempotency_store()
+        if not 200 <= response.status_code < 300:
+            store.release(key)
+        elif response.is_streamed:
+            response.response = record_idempotent_stream(store, key, response.response, response.mimetype)
+        else:
+            store.complete(key, response.status_code, response.get_data(), response.mimetype)
+        return response
+
+    @app.teardown_request
+    def release_idempotency_key(error=None):
+        # La vista falló sin pasar por after_request
+        key = g.pop('idempotency_key', None)
+        if key is not None:
+            get_idempotency_store().release(key)
+
+
+def record_idempotent_stream(store: IdempotencyStore, key: str, chunks, mimetype: str):
+    """Reenvía un streaming NDJSON y lo guarda para reintentos si termina con su registro 'summary'"""
+    body = []
+    completed = False
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            body.append(chunk)
+            yield chunk
+        lines = b''.join(body).strip().splitlines()
+        completed = bool(lines) and json.loads(lines[-1]).get('type') == 'summary'
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+        if completed:
+            store.complete(key, 200, b''.join(body), mimetype)
+        else:
+            store.release(key)
+
+
+if Config.ADMISSION_CONTROL_ENABLED:
+    @app.before_request
+    def admit_scrape():
+        """Rechaza /scrape si una dependencia tiene el circuito abierto o si el worker está saturado"""
+        if request.endpoint != 'scrape':
+            return None
+        try:
+            for dependency in ('search', 'apify', 'bigquery'):
+                get_circuit_breaker(dependency).check()
+            if bigquery_service is not None and bigquery_service.write_behind_enabled:
+                pending_writes = sum((bigquery_service.write_behind_stats() or {}).get('rows_pending', {}).values())
+                if pending_writes > Config.ADMISSION_MAX_PENDING_WRITES:
+                    raise AdmissionRejected(f"Servicio saturado: {pending_writes} filas pendientes de escribir",
+                                            Config.ADMISSION_RETRY_AFTER)
+            scrape_admission.acquire()
+        except (AdmissionRejected, CircuitOpenError) as error:
+            logger.warning(f"🚦 /scrape rechazado: {error}")
+            return service_unavailable(error)
+        g.scrape_admitted = True
+        return None
+
+    @app.after_request
+    def release_scrape_admission_on_close(response):
+        # Un streaming sigue trabajando después de retornar la vista: libera su lugar al cerrarse
+        if response.is_streamed and g.pop('scrape_admitted', False):
+            response.call_on_close(scrape_admission.release)
+        return response
+
+    @app.teardown_request
+    def release_scrape_admission(error=None):
+        if g.pop('scrape_admitted', False):
+            scrape_admission.release()
+
+
 @app.route("/status", methods=['GET'])
 def health_check():
     return {"status": "OK"}
 
 
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    """Métricas internas del proceso: cache de queries, buffer de escritura, prefetcher y scrapings compartidos"""
+    return {
+        "query_cache": bigquery_service.query_cache_stats() if bigquery_service is not None else None,
+        "write_behind": bigquery_service.write_behind_stats() if bigquery_service is not None else None,
+        "bigquery_cost": bigquery_service.query_cost_stats() if bigquery_service is not None else None,
+        "prefetcher": companies_prefetcher.stats() if companies_prefetcher is not None else None,
+        "rescrape_scheduler": rescrape_scheduler.stats() if rescrape_scheduler is not None else None,
+        "scraped_index": scraped_index.stats() if scraped_index is not None else None,
+        "profile_scoring": profile_scorer.stats() if profile_scorer is not None else None,
+        "single_flight": scrape_flights.stats(),
+        "circuit_breakers": circuit_breaker_stats(),
+        "admission": scrape_admission.stats() if Config.ADMISSION_CONTROL_ENABLED else None,
+        "idempotency": idempotency_store.stats() if idempotency_store is not None else None,
+        "responses": response_stats.stats(),
+        "upstream_cassette": get_upstream_cassette().stats() if get_upstream_cassette() is not None else None,
+    }
+
+
 
 @app.route("/scrape", methods=['POST'])
 def scrape():
@@ -56,8 +472,40 @@ def scrape():
     Body JSON (opcional):
     {
         "batch_size": 10,
-        "max_per_company": 4
+        "min_score": 7,
+        "max_per_company": 4,
+        "tie_breaker": "finance_first",
+        "timeout": 300,
+        "companies": [{"biz_name": "Empresa 1", "biz_identifier": "ABC123456789"}]
     }
+
+    timeout: segundos máximos para la request (por defecto Config.INDIVIDUAL_TIMEOUT por empresa,
+    con tope Config.BATCH_TIMEOUT). Si se agotan, se responde con los contactos obtenidos hasta
+    ese momento y las empresas sin terminar ("empresas sin terminar") quedan para reintento.
+
+    min_score, max_per_company y tie_breaker ("finance_first" o "search_order") deciden qué
+    perfiles encontrados se envían a Apify; por defecto Config.SELECTION_*.
+
+    Con "stream": true (o ?stream=true / Accept: application/x-ndjson) la respuesta es NDJSON:
+    un registro {"type": "contact", ...} por contacto apenas se formatea y un registro final
+    {"type": "summary", ...} con los conteos y los tiempos por etapa, enviado una vez guardados
+    los contactos.
+
+    "consumo bigquery" reporta los jobs de BigQuery de la request (bytes procesados y
+    facturados, slot-ms, aciertos de cache y costo estimado); con el buffer de escritura los
+    MERGE son compartidos y se ven en /metrics ("bigquery_cost").
+
+    Si vienen "companies" se scrapean esas empresas en lugar de tomar pendientes de la cola.
+    Si otra request ya está scrapeando alguna de las empresas, se espera y se comparte su
+    resultado en lugar de repetir la búsqueda, el scraping y las escrituras.
+
+    Con el header Idempotency-Key, los reintentos con la misma llave y el mismo body no repiten
+    el trabajo: reciben la respuesta guardada (header Idempotency-Replayed) o, si la request
+    original sigue en curso, 409 con Retry-After. La llave con otro body responde 422.
+
+    Responde 503 con Retry-After si el worker ya tiene Config.ADMISSION_MAX_IN_FLIGHT scrapings
+    en curso (y la cola está llena) o si el circuito de search, Apify o BigQuery está abierto;
+    en ese caso las empresas tomadas de la cola vuelven a ella.
     
     Retorna:
     {
@@ -106,7 +554,9 @@ def scrape():
     # PASO 0: Crear tablas si no existen
     if not bigquery_service.table_exists(Config.CONTROL_TABLE_NAME):
         bigquery_service.crear_tabla_empresas_scrapeadas_linkedin_contacts()
-    if not bigquery_service.table_exists(Config.LINKEDIN_INFO_TABLE_NAME):
+    if Config.CONTACTS_NORMALIZED:
+        bigquery_service.crear_tablas_contactos_normalizadas()
+    elif not bigquery_service.table_exists(Config.LINKEDIN_INFO_TABLE_NAME):
         bigquery_service.crear_tabla_linkedin_contacts_info()
 
 
@@ -114,11 +564,41 @@ def scrape():
     data = request.get_json(silent=True) or {}
     
     batch_size = int(str(data.get('batch_size', 1)))
-    
-    # Cargar empresas no scrapeadas
-    #companies_data = bigquery_service.load_companies_from_bigquery_linkedin_contacts(batch_size)
 
-    companies_data =[{"biz_name" : "SERVICIOS INDUSTRIALES Y GESTION AMBIEN   TAL SC","biz_identifier" : "SIG090929CQ3"}]
+    try:
+        min_score = data.get('min_score', Config.SELECTION_MIN_SCORE)
+        min_score = float(min_score) if min_score is not None else None
+        max_per_company = int(data.get('max_per_company', Config.SELECTION_MAX_PER_COMPANY) or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'min_score' y 'max_per_company' deben ser numéricos"}), 400
+    tie_breaker = data.get('tie_breaker', Config.SELECTION_TIE_BREAKER)
+    if tie_breaker not in TIE_BREAKERS or max_per_company < 0:
+        return jsonify({"error": f"'tie_breaker' debe ser uno de {sorted(TIE_BREAKERS)} y 'max_per_company' >= 0"}), 400
+    selection = {'min_score': min_score, 'max_per_company': max_per_company, 'tie_breaker': tie_breaker}
+
+    try:
+        requested_timeout = float(data['timeout']) if data.get('timeout') is not None else None
+    except (TypeError, ValueError):
+        return jsonify({"error": "'timeout' debe ser numérico (segundos)"}), 400
+
+    requested_companies = data.get('companies')
+    prefetcher = None
+    if requested_companies is not None:
+        if not isinstance(requested_companies, list) or not all(
+            isinstance(company, dict) and company.get('biz_name') and company.get('biz_identifier')
+            for company in requested_companies
+        ):
+            return jsonify(
+                {"error": "El campo 'companies' debe ser un array de empresas con 'biz_name' y 'biz_identifier'"}
+                ), 400
+        companies_data = [
+            {'biz_name': str(company['biz_name']).strip(), 'biz_identifier': str(company['biz_identifier']).strip()}
+            for company in requested_companies
+        ]
+    else:
+        # Cargar empresas no scrapeadas desde la cola de prefetch
+        prefetcher = get_prefetcher()
+        companies_data = prefetcher.acquire(batch_size, timeout=Config.PREFETCH_ACQUIRE_TIMEOUT)
 
     if not companies_data:
         logger.error("❌ No se pudieron cargar empresas desde BigQuery o todas ya fueron scrapeadas. ")
@@ -126,58 +606,234 @@ def scrape():
             {"error": "No se pudieron cargar empresas desde BigQuery o todas ya fueron scrapeadas. "}
             ), 400
 
-    # Extraer nombres y crear mapeo de biz_identifier
-    #companies = [company['biz_name'] for company in companies_data]
-   # company_biz_mapping = {company['biz_name']: company['biz_identifier'] for company in companies_data}
+    # El deadline empieza a correr una vez que se tienen las empresas
+    timeout = min(Config.BATCH_TIMEOUT, Config.INDIVIDUAL_TIMEOUT * len(companies_data))
+    if requested_timeout is not None:
+        timeout = min(Config.BATCH_TIMEOUT, max(1.0, requested_timeout))
+    deadline = Deadline(timeout, write_reserve=Config.DEADLINE_WRITE_RESERVE)
+    unfinished_keys = set()
+
+    def release_companies():
+        # Las empresas dejan de estar en proceso; su estado queda en la tabla de control.
+        # Las que no se terminaron vuelven al final de la cola con espera antes del reintento
+        if prefetcher is not None:
+            prefetcher.release([company for company in companies_data if company['biz_identifier'] in unfinished_keys],
+                               requeue=True)
+            prefetcher.release([company for company in companies_data if company['biz_identifier'] not in unfinished_keys])
 
     scraper = LinkedInContactsSelectiveScraper(SERPER_API_KEY, APIFY_TOKEN)
+    events = scrape_events(bigquery_service, scraper, companies_data, selection, deadline)
+    # Span raíz de la traza; continúa la del cliente si envía traceparent
+    trace_parent = extract_trace_context(request.headers)
+    span_attributes = {'companies.count': len(companies_data), 'deadline.seconds': timeout}
 
-    try:
-        profiles = request_profiles(companies_data)
-        # Ejecutar scraping selectivo
-        results = scraper.scrape_linkedin_profiles(
-            profiles = profiles,
-        )
-
-        if not results:
-            logger.info("❌ No se obtuvieron resultados de acuerdo a los criterios de busqueda")
-            
-            return jsonify({
-                "status": "success",
-                "message": "No se obtuvieron resultados de acuerdo a los criterios de busqueda"}), 200
-    except Exception as error:
+    if data.get('stream') is True or wants_ndjson():
+        # El pipeline corre en su propio hilo hasta terminar aunque el cliente se desconecte:
+        # las escrituras y la liberación de las empresas no dependen de que se lea el streaming.
+        # La cola acotada frena el envío ante un cliente lento; si se desconecta se deja de encolar
+        lines = queue.Queue(maxsize=Config.SCRAPE_STREAM_QUEUE_LINES)
+        client_gone = threading.Event()
+        admitted = g.pop('scrape_admitted', False)
 
-        logger.error(f"❌ Error en scraping: {error}")
+        def put_line(line) -> None:
+            while not client_gone.is_set():
+                try:
+                    lines.put(line, timeout=0.5)
+                    return
+                except queue.Full:
+                    continue
 
-        return jsonify({"error": f"{error}"}), 400
+        def run_events():
+            with start_span('scrape', span_attributes, parent=trace_parent) as span:
+                try:
+                    for kind, payload in events:
+                        if kind == 'summary':
+                            unfinished_keys.update(payload["empresas sin terminar"])
+                            record_scrape_summary(span, payload)
+                        put_line({"type": kind, **payload})
+                except CircuitOpenError as error:
+                    # Ninguna empresa quedó terminada: todas vuelven a la cola
+                    logger.warning(f"🔌 Scraping interrumpido: {error}")
+                    span.record_exception(error)
+                    unfinished_keys.update(company['biz_identifier'] for company in companies_data)
+                    put_line({"type": "error", "error": f"{error}",
+                              "retry_after": max(1, math.ceil(error.retry_after))})
+                except Exception as error:
+                    logger.error(f"❌ Error en scraping: {error}")
+                    span.record_exception(error)
+                    put_line({"type": "error", "error": f"{error}"})
+                finally:
+                    release_companies()
+                    if admitted:
+                        scrape_admission.release()
+                    put_line(None)
 
-    # Solo mostrar estadísticas finales si el proceso se completó
-    logger.info("📝 MARCANDO EMPRESAS COMO SCRAPEADAS...")
-    logger.info(f"Contacts results: {results}")
-    
-    contacts_data = scraper.format_contacts_for_bigquery(results)
+        threading.Thread(target=run_events, name='scrape-stream').start()
 
-    logger.info(f"Contacts data: {contacts_data}")
-    logger.info(f"Companies data: {companies_data}")
-    
-    logger.info("Marcando empresas como scrapeadas")
+        def generate():
+            try:
+                while True:
+                    line = lines.get()
+                    if line is None:
+                        return
+                    yield app.json.dumps(line) + "\n"
+            finally:
+                client_gone.set()
 
-    bigquery_service.marcar_empresas_contacts_como_scrapeadas(contacts_data, companies_data)
+        response = Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+        # También si el cliente se desconecta antes de empezar a leer
+        response.call_on_close(client_gone.set)
+        return response
 
-    # Guardar contactos en BigQuery
-    logger.info("\n💾 GUARDANDO CONTACTOS EN BIGQUERY...")
+    contacts_data = []
+    summary = {}
+    with start_span('scrape', span_attributes, parent=trace_parent) as span:
+        try:
+            for kind, payload in events:
+                if kind == 'contact':
+                    contacts_data.append(payload)
+                else:
+                    summary = payload
+                    unfinished_keys.update(summary["empresas sin terminar"])
+                    record_scrape_summary(span, summary)
+        except CircuitOpenError as error:
+            logger.warning(f"🔌 Scraping interrumpido: {error}")
+            span.record_exception(error)
+            unfinished_keys.update(company['biz_identifier'] for company in companies_data)
+            return service_unavailable(error)
+        except Exception as error:
+            logger.error(f"❌ Error en scraping: {error}")
+            span.record_exception(error)
+            return jsonify({"error": f"{error}"}), 400
+        finally:
+            release_companies()
 
-    logger.info(f"Contactos: {contacts_data}")
-    bigquery_service.save_contacts_to_bigquery(contacts_data)
+    if not contacts_data:
+        return jsonify({
+            "status": "success",
+            "message": "No se obtuvieron resultados de acuerdo a los criterios de busqueda",
+            "empresas sin terminar": summary.get("empresas sin terminar", [])}), 200
 
     return jsonify(
         {"message": "Proceso completado exitosamente",
-        "empresas procesadas": len(companies_data),
-        "perfiles scrapeados": len(results),
+        "empresas procesadas": summary["empresas procesadas"],
+        "total perfiles encontrados": summary["perfiles encontrados"],
+        "perfiles seleccionados": summary["perfiles seleccionados"],
+        "perfiles scrapeados": summary["perfiles scrapeados"],
+        "contactos compartidos": summary["contactos compartidos"],
+        "empresas sin terminar": summary["empresas sin terminar"],
+        "tiempo agotado": summary["tiempo agotado"],
+        "consumo bigquery": summary["consumo bigquery"],
         "contactos": contacts_data
     }), 200
 
 
+def record_scrape_summary(span, summary: Dict) -> None:
+    set_span_attributes(span, **{
+        'contacts.count': summary["contactos obtenidos"],
+        'profiles.found': summary["perfiles encontrados"],
+        'profiles.selected': summary["perfiles seleccionados"],
+        'companies.shared': summary["empresas compartidas"],
+        'contacts.shared': summary["contactos compartidos"],
+        'companies.unfinished': len(summary["empresas sin terminar"]),
+        'deadline.exceeded': summary["tiempo agotado"],
+    })
+
+
+def scrape_events(bigquery_service: BigQueryService,
+                  scraper: LinkedInContactsSelectiveScraper,
+                  companies_data: List[Dict],
+                  selection: Optional[Dict] = None,
+                  deadline: Optional[Deadline] = None):
+    """
+    Ejecuta el scraping de un lote de empresas y genera eventos ('contact', contacto) a medida
+    que se formatean, terminando con ('summary', conteos y tiempos) una vez guardados.
+
+    Las empresas que otra request ya está scrapeando no se vuelven a procesar: se espera su
+    resultado y se generan sus contactos. Si el deadline no alcanza, o la otra request falla o no
+    termina la empresa, esta se reporta como sin terminar.
+    """
+    owned_keys, waiting_calls = scrape_flights.begin(company['biz_identifier'] for company in companies_data)
+    owned_companies = [company for company in companies_data if company['biz_identifier'] in owned_keys]
+    contacts_by_company = {key: [] for key in owned_keys}
+    # El biz_identifier de un contacto viene del scraper y puede diferir en espacios o mayúsculas
+    owned_by_normalized_key = {str(key).strip().upper(): key for key in owned_keys}
+    published = False
+
+    try:
+        if waiting_calls:
+            logger.info(f"🔗 {len(waiting_calls)} empresas ya se están scrapeando en otra request, se esperará su resultado")
+
+        outcome = {'profiles_found': 0, 'profiles_selected': 0, 'profiles_scraped': 0, 'contacts_count': 0,
+                   'unfinished_companies': [], 'deadline_exceeded': False, 'timings': {},
+                   'bigquery_usage': QueryUsage().stats()}
+        if owned_companies:
+            for kind, payload in iter_scrape_companies(bigquery_service, scraper, owned_companies,
+                                                       scorer=get_profile_scorer(), selection=selection,
+                                                       deadline=deadline):
+                if kind == 'contact':
+                    key = owned_by_normalized_key.get(str(payload.get('biz_identifier', '')).strip().upper())
+                    if key is not None:
+                        contacts_by_company[key].append(payload)
+                    else:
+                        logger.warning(f"⚠️ Contacto con biz_identifier {payload.get('biz_identifier')!r} fuera del lote; "
+                                       f"no se comparte con otras requests")
+                    yield 'contact', payload
+                else:
+                    outcome = payload
+
+        # Publicar el resultado de cada empresa para las requests que la estén esperando; las que
+        # quedaron sin terminar se publican como error para que no se reporten terminadas sin contactos
+        owned_unfinished = set(outcome['unfinished_companies'])
+        for key in owned_keys:
+            if key in owned_unfinished:
+                scrape_flights.fail(key, TimeoutError(f"La empresa {key} quedó sin terminar en la request que la scrapeaba"))
+            else:
+                scrape_flights.complete(key, contacts_by_company[key])
+        published = True
+
+        contacts_count = outcome['contacts_count']
+        # Los contactos de empresas compartidas los scrapeó otra request: no suman perfiles scrapeados
+        shared_contacts_count = 0
+        unfinished = list(outcome['unfinished_companies'])
+        for key, call in waiting_calls.items():
+            try:
+                shared_contacts = call.wait(
+                    timeout=deadline.remaining(include_reserve=True) if deadline is not None else Config.REQUEST_TIMEOUT
+                )
+            except Exception as error:
+                # Sin resultado de la otra request (tiempo agotado o falla): las empresas propias ya
+                # quedaron guardadas, así que solo esta se reporta para reintento
+                logger.warning(f"⚠️ Sin resultado compartido para la empresa {key}: {error}")
+                unfinished.append(key)
+                continue
+            for contact in shared_contacts:
+                yield 'contact', contact
+            contacts_count += len(shared_contacts)
+            shared_contacts_count += len(shared_contacts)
+
+        yield 'summary', {
+            "message": "Proceso completado exitosamente",
+            "empresas procesadas": len(companies_data),
+            "empresas compartidas": len(waiting_calls),
+            "perfiles encontrados": outcome['profiles_found'],
+            "perfiles seleccionados": outcome['profiles_selected'],
+            "perfiles scrapeados": outcome['profiles_scraped'],
+            "contactos obtenidos": contacts_count,
+            "contactos compartidos": shared_contacts_count,
+            "empresas sin terminar": unfinished,
+            "tiempo agotado": outcome['deadline_exceeded'] or bool(deadline is not None and deadline.exceeded),
+            "tiempos": outcome['timings'],
+            "consumo bigquery": outcome['bigquery_usage']
+        }
+    except BaseException as error:
+        if not published:
+            shared_error = error if isinstance(error, Exception) else RuntimeError("Scraping cancelado")
+            for key in owned_keys:
+                scrape_flights.fail(key, shared_error)
+        raise
+
+
 
 @app.route('/validate', methods=['POST'])
 def validate_request():
@@ -196,6 +852,13 @@ def validate_request():
     
     Si no vienen parámetros, verifica todas las empresas pendientes en la tabla de control.
     Si vienen parámetros, verifica si esas empresas específicas están pendientes.
+
+    Query params (solo sin body):
+        page_size: empresas por página (default 100, máximo Config.VALIDATE_MAX_PAGE_SIZE)
+        cursor: valor "next_cursor" de la página anterior
+        stream: si es "true" (o Accept: application/x-ndjson) se devuelven todas las
+                empresas pendientes desde el cursor como NDJSON, una por línea, terminando
+                con un registro {"type": "summary", ...}
     
     Retorna:
     {
@@ -220,15 +883,69 @@ def validate_request():
         if not request.is_json:
             # No hay parámetros JSON, verificar todas las empresas pendientes
             logger.info("🔍 Validando empresas pendientes sin parámetros específicos")
-            
-            pending_companies = bigquery_service.get_pending_companies(Config.CONTROL_TABLE_NAME)
-            total_pending = bigquery_service.get_pending_companies_count(Config.CONTROL_TABLE_NAME)
-            
+
+            cursor = request.args.get('cursor') or None
+            try:
+                page_size = int(request.args.get('page_size', 100))
+            except ValueError:
+                page_size = 0
+            if page_size < 1:
+                return jsonify({
+                    "success": False,
+                    "error": "El parámetro 'page_size' debe ser un entero positivo",
+                    "timestamp": datetime.now().isoformat()
+                }), 400
+
+            if wants_ndjson():
+                try:
+                    total_pending, pending_iterator = bigquery_service.iter_pending_companies(
+                        Config.CONTROL_TABLE_NAME,
+                        cursor=cursor,
+                        page_size=Config.VALIDATE_STREAM_PAGE_SIZE
+                    )
+                except ValueError as e:
+                    return jsonify({
+                        "success": False,
+                        "error": str(e),
+                        "timestamp": datetime.now().isoformat()
+                    }), 400
+
+                def generate():
+                    streamed = 0
+                    for company in pending_iterator:
+                        streamed += 1
+                        yield app.json.dumps({"type": "company", **company}) + "\n"
+                    yield app.json.dumps({
+                        "type": "summary",
+                        "success": True,
+                        "validation_type": "no_params",
+                        "streamed": streamed,
+                        "total_pending": total_pending,
+                        "timestamp": datetime.now().isoformat()
+                    }) + "\n"
+
+                return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+            try:
+                page = bigquery_service.get_pending_companies_page(
+                    Config.CONTROL_TABLE_NAME,
+                    page_size=min(page_size, Config.VALIDATE_MAX_PAGE_SIZE),
+                    cursor=cursor
+                )
+            except ValueError as e:
+                return jsonify({
+                    "success": False,
+                    "error": str(e),
+                    "timestamp": datetime.now().isoformat()
+                }), 400
+            total_pending = page['total_pending']
+
             return jsonify({
                 "success": True,
                 "validation_type": "no_params",
-                "pending_companies": pending_companies,
+                "pending_companies": page['pending_companies'],
                 "total_pending": total_pending,
+                "next_cursor": page['next_cursor'],
                 "message": f"Se encontraron {total_pending} empresas pendientes de scraping en total",
                 "timestamp": datetime.now().isoformat()
             })
@@ -270,14 +987,17 @@ def validate_request():
             rfc = company['rfc'].strip()
             company_name = company['company_name'].strip()
             
-            # Verificar si la empresa está pendiente
-            verification = bigquery_service.verificar_empresa_scrapeada(
-                biz_identifier=rfc,
-                company_name=company_name,
-                table_name=Config.CONTROL_TABLE_NAME
-            )
+            # Verificar si la empresa está pendiente (en memoria si el índice ya está cargado)
+            if scraped_index is not None and scraped_index.ready:
+                needs_scraping = scraped_index.needs_scraping(rfc, company_name)
+            else:
+                needs_scraping = bigquery_service.verificar_empresa_scrapeada(
+                    biz_identifier=rfc,
+                    company_name=company_name,
+                    table_name=Config.CONTROL_TABLE_NAME
+                )['needs_scraping']
             
-            if verification['needs_scraping']:
+            if needs_scraping:
                 pending_companies.append({
                     'rfc': rfc,
                     'company_name': company_name
@@ -303,45 +1023,109 @@ def validate_request():
         }), 500
 
 
-def request_profiles(companies: List[Dict]):
+@app.route('/contacts/export', methods=['GET', 'POST'])
+def export_contacts():
     """
-    Funcion para solicitar perfiles de LinkedIn a Google Search Service
+    Exporta la tabla de contactos en streaming con la BigQuery Storage Read API (varios streams
+    en paralelo, sin cargar la tabla completa en memoria).
+
+    Parámetros (query string o body JSON):
+        biz_identifier: empresas a exportar (repetido, separado por comas o lista en el body)
+        since: marca de agua ISO 8601; solo contactos con src_scraped_dt desde esa fecha
+        columns: columnas a exportar (por defecto todas)
+        format: "ndjson" (por defecto) o "arrow" (también con Accept: application/vnd.apache.arrow.stream)
+
+    NDJSON: un registro {"type": "contact", ...} por contacto y un registro final
+    {"type": "summary", "exported": n, "watermark": ...}; el watermark es el "since" de la
+    siguiente exportación incremental (queda EXPORT_WATERMARK_OVERLAP segundos antes del último
+    contacto, así que las exportaciones se solapan y se deduplican por biz_identifier +
+    web_linkedin_url). Arrow: formato Arrow IPC stream.
     """
+    data = request.get_json(silent=True) if request.method == 'POST' else None
+    data = data if isinstance(data, dict) else {}
+
+    def param(name):
+        return data.get(name) if name in data else request.args.get(name)
+
+    identifiers = data.get('biz_identifier')
+    if identifiers is None:
+        identifiers = request.args.getlist('biz_identifier')
+    elif not isinstance(identifiers, list):
+        identifiers = [identifiers]
+    identifiers = parse_identifiers(identifiers)
+    if len(identifiers) > Config.EXPORT_MAX_IDENTIFIERS:
+        return jsonify({"error": f"Máximo {Config.EXPORT_MAX_IDENTIFIERS} 'biz_identifier' por exportación"}), 400
+
+    since = None
+    if param('since'):
+        try:
+            since = datetime.fromisoformat(str(param('since')).replace('Z', '+00:00'))
+        except ValueError:
+            return jsonify({"error": "'since' debe ser una fecha ISO 8601"}), 400
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+
+    columns = param('columns') or []
+    if isinstance(columns, str):
+        columns = parse_identifiers([columns])
+
+    export_format = param('format')
+    if export_format is None:
+        export_format = 'arrow' if request.accept_mimetypes.best == ARROW_STREAM_MIMETYPE else 'ndjson'
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({"error": f"'format' debe ser uno de {list(EXPORT_FORMATS)}"}), 400
+
     try:
-        logger.info(f"companies: {companies}")
+        get_circuit_breaker('bigquery').check()
+        exporter = get_contacts_exporter()
+    except CircuitOpenError as error:
+        return service_unavailable(error)
+    except RuntimeError as error:
+        return jsonify({"error": f"{error}"}), 501
+    try:
+        session = exporter.open_session(biz_identifiers=identifiers, since=since, columns=columns)
+    except ClientError as error:
+        # Columna inexistente o filtro inválido
+        return jsonify({"error": f"{error}"}), 400
 
-        url = Config.GOOGLE_SEARCH_SERVICE_URL
-        
-        headers = {
-            'Content-Type': 'application/json'
-        }
-        body = { "companies": companies }
+    stats = ExportStats(since=since, overlap_seconds=Config.EXPORT_WATERMARK_OVERLAP)
+    batches = exporter.iter_record_batches(session, stats=stats)
 
-        
-        response = requests.post(url=url, headers=headers, json=body, timeout=Config.REQUEST_TIMEOUT)
+    if export_format == 'arrow':
+        response = Response(stream_with_context(iter_arrow_ipc(exporter.session_schema(session), batches)),
+                            mimetype=ARROW_STREAM_MIMETYPE)
+        response.headers['X-Export-Streams'] = str(len(session.streams))
+        return response
 
-        # Intentar decodificar JSON de la respuesta de forma segura
+    def generate():
         try:
-            response_json = response.json()
-        except Exception:
-            response_json = {"error": response.text}
-
-        logger.info(f"🔍 Response status: {response.status_code}")
-        logger.info(f"🔍 Response: {response_json}")
-
-        if response.status_code != 200:
-            logger.error(f"❌ Error en Google Search Service ({response.status_code}): {response_json}")
-            return []
-        logger.info(f"response_json: {response_json}")
-        return response_json.get('profiles', [])
-    except Exception as e:
-        logger.error(f"❌ Error en solicitud de perfiles: {e}")
-        return []
-    
+            yield from iter_ndjson(batches, app.json.dumps)
+        except Exception as error:
+            logger.error(f"❌ Error exportando contactos: {error}")
+            yield app.json.dumps({"type": "error", "error": f"{error}"}) + "\n"
+            return
+        logger.info(f"📤 {stats.rows} contactos exportados en {stats.batches} batches ({stats.streams} streams)")
+        yield app.json.dumps({
+            "type": "summary",
+            "exported": stats.rows,
+            "streams": stats.streams,
+            "watermark": stats.watermark,
+            "timestamp": datetime.now().isoformat()
+        }) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype=NDJSON_MIMETYPE)
+
+
+def handle_sigterm(signum, frame):
+    """Al recibir SIGTERM se sale normalmente para que atexit vacíe el buffer de escritura"""
+    logger.info("🛑 SIGTERM recibido, vaciando escrituras pendientes...")
+    sys.exit(0)
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8080, debug=False)
+    # Servidor de desarrollo; en producción usar gunicorn (ver gunicorn.conf.py)
+    signal.signal(signal.SIGTERM, handle_sigterm)
+    app.run(host=Config.FLASK_HOST, port=Config.PORT, debug=Config.FLASK_DEBUG, threaded=True)
 
 
 
@@ -0,0 +1,411 @@
+"""
+Evaluación con IA de los perfiles encontrados por el Google Search Service.
+
+Llena ai_score_value, ai_score_cat, ai_explanation, ai_current_biz_flg y ai_role_finance_flg en
+los perfiles que no los traen, enviando varios perfiles por request al modelo. Lleva la cuenta
+de requests por modelo (compartida entre procesos en BigQuery) y rota al siguiente cuando uno
+llega a MAX_REQUESTS_PER_MODEL en el día o cuando la API informa que se agotó su cuota diaria;
+un límite de tasa (429 por minuto) solo deja al modelo en pausa unos segundos en este proceso.
+Las evaluaciones se guardan por (biz_identifier, perfil) para no volver a pagar por ellas.
+"""
+
+import json
+import logging
+import random
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, List, Optional, Tuple
+
+from config import Config
+from deadline import Deadline
+from linkedin_profile_keys import canonical_profile_key
+
+logger = logging.getLogger(__name__)
+
+AI_FIELDS = ('ai_score_value', 'ai_score_cat', 'ai_explanation', 'ai_current_biz_flg', 'ai_role_finance_flg')
+
+FINANCE_KEYWORDS = ('cfo', 'financ', 'finanz', 'tesor', 'treasur', 'contralor', 'controller', 'contab',
+                    'account', 'fiscal', 'tax', 'auditor')
+SENIOR_KEYWORDS = ('chief', 'director', 'gerente', 'manager', 'head', 'vp', 'vice', 'jefe', 'socio',
+                   'partner', 'owner', 'dueno', 'founder', 'fundador', 'ceo', 'cfo', 'coo')
+
+
+class ModelQuotaExhausted(Exception):
+    """Todos los modelos configurados alcanzaron su límite de requests del día"""
+
+
+class ModelScoringFailed(Exception):
+    """Los modelos con cupo fallaron por errores que no son de cuota"""
+
+
+def _error_details(error) -> List[Dict]:
+    """Detalles google.rpc del error de la API (QuotaFailure, RetryInfo...)"""
+    details = getattr(error, 'details', None)
+    if isinstance(details, dict):
+        details = (details.get('error') or details).get('details')
+    return [detail for detail in details if isinstance(detail, dict)] if isinstance(details, list) else []
+
+
+def quota_error(error) -> Tuple[Optional[str], Optional[float]]:
+    """
+    Clasifica un error de google-genai por su código HTTP o status:
+    ('daily', None) si se agotó la cuota diaria del modelo, ('rate', segundos sugeridos o None)
+    si es un límite de tasa temporal y (None, None) si no es un error de cuota
+    """
+    if getattr(error, 'code', None) != 429 and getattr(error, 'status', None) != 'RESOURCE_EXHAUSTED':
+        return None, None
+    retry_after = None
+    for detail in _error_details(error):
+        detail_type = str(detail.get('@type', ''))
+        if detail_type.endswith('QuotaFailure'):
+            for violation in detail.get('violations') or []:
+                quota = f"{violation.get('quotaId', '')} {violation.get('quotaMetric', '')}"
+                if 'PerDay' in quota:
+                    return 'daily', None
+        elif detail_type.endswith('RetryInfo'):
+            match = re.fullmatch(r'([\d.]+)s', str(detail.get('retryDelay', '')))
+            if match:
+                retry_after = float(match.group(1))
+    return 'rate', retry_after
+
+
+def score_category(score: Optional[float]) -> Optional[str]:
+    if score is None:
+        return None
+    if score >= 8:
+        return 'alto'
+    if score >= 5:
+        return 'medio'
+    return 'bajo'
+
+
+def _normalize(text) -> str:
+    text = unicodedata.normalize('NFKD', str(text or '')).encode('ascii', 'ignore').decode('ascii')
+    return text.lower()
+
+
+class ModelRotation:
+    """
+    Reparte requests entre modelos; cada uno admite max_requests_per_model por día.
+
+    shared (opcional) es el contador compartido entre workers, instancias y reinicios, con los
+    métodos reserve_model_requests y exhaust_model_quota de BigQueryService: el proceso reserva
+    bloques de block_size requests y los gasta localmente, así el cupo del día se respeta sin un
+    MERGE por request (lo que queda del último bloque al final del día no se usa). Si el contador
+    compartido falla, el proceso sigue con max_requests_per_model / local_share contados en memoria.
+    """
+
+    def __init__(self, models: List[str], max_requests_per_model: int, shared=None, block_size: int = 20,
+                 local_share: int = 1) -> None:
+        self.__models = list(models)
+        self.__max_requests = max_requests_per_model
+        self.__shared = shared
+        self.__block_size = max(1, min(block_size, max_requests_per_model))
+        self.__local_limit = max_requests_per_model // max(1, local_share)
+        self.__lock = threading.Lock()
+        self.__shared_errors = 0
+        # Modelos en pausa por límite de tasa (solo en este proceso): {modelo: time.monotonic() de fin}
+        self.__paused_until: Dict[str, float] = {}
+        self.__reset(date.today())
+
+    def __reset(self, day: date) -> None:
+        self.__day = day
+        self.__counts = {model: 0 for model in self.__models}
+        # Requests del día asignados a este proceso (reservados en el contador compartido o del cupo local)
+        self.__reserved = {model: 0 if self.__shared is not None else self.__max_requests for model in self.__models}
+
+    def acquire(self, skip: Tuple[str, ...] = ()) -> str:
+        """Retorna el primer modelo con cupo y sin pausa (omitiendo skip) y le descuenta un request"""
+        with self.__lock:
+            if date.today() != self.__day:
+                self.__reset(date.today())
+            now = time.monotonic()
+            for model in self.__models:
+                if model in skip or self.__paused_until.get(model, 0) > now:
+                    continue
+                if self.__counts[model] < self.__reserved[model] or self.__reserve(model):
+                    self.__counts[model] += 1
+                    return model
+        raise ModelQuotaExhausted(f"Sin cupo o en pausa por límite de tasa los modelos {self.__models}")
+
+    def __reserve(self, model: str) -> bool:
+        """Reserva el siguiente bloque de requests del modelo (con el lock tomado)"""
+        if self.__shared is None or self.__reserved[model] >= self.__max_requests:
+            return False
+        try:
+            granted = self.__shared.reserve_model_requests(model, self.__day, self.__block_size, self.__max_requests)
+        except Exception as e:
+            logger.warning(f"⚠️ Contador compartido de requests por modelo no disponible: {e}")
+            self.__shared_errors += 1
+            # Sin el contador compartido solo se usa la parte del cupo que le toca a este proceso
+            granted = max(0, min(self.__block_size, self.__local_limit - self.__reserved[model]))
+        if not granted:
+            # El cupo del día se agotó entre todos los procesos
+            self.__reserved[model] = self.__max_requests
+            self.__counts[model] = self.__max_requests
+            return False
+        self.__reserved[model] += granted
+        return True
+
+    def pause(self, model: str, seconds: float) -> None:
+        """Omite un modelo en este proceso durante seconds (límite de tasa); su cupo del día no cambia"""
+        with self.__lock:
+            self.__paused_until[model] = max(self.__paused_until.get(model, 0), time.monotonic() + seconds)
+
+    def exhaust(self, model: str) -> None:
+        """Marca un modelo sin cupo por el resto del día en todos los procesos (error de cuota diaria)"""
+        with self.__lock:
+            self.__reserved[model] = self.__max_requests
+            self.__counts[model] = self.__max_requests
+            day = self.__day
+        if self.__shared is not None:
+            try:
+                self.__shared.exhaust_model_quota(model, day, self.__max_requests)
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo marcar {model} sin cupo en el contador compartido: {e}")
+                with self.__lock:
+                    self.__shared_errors += 1
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            now = time.monotonic()
+            return {'day': self.__day.isoformat(), 'requests_per_model': dict(self.__counts),
+                    'paused_models': sorted(model for model, until in self.__paused_until.items() if until > now),
+                    'max_requests_per_model': self.__max_requests, 'shared_quota': self.__shared is not None,
+                    'reserved_per_model': dict(self.__reserved), 'quota_shared_errors': self.__shared_errors}
+
+
+class GeminiModelClient:
+    """Evalúa un lote de perfiles en un solo request a Gemini (Vertex AI), con respuesta JSON"""
+
+    PROMPT = """Eres un analista que busca contactos de finanzas en empresas mexicanas.
+Evalúa cada perfil de LinkedIn respecto a la empresa indicada y responde SOLO con un arreglo JSON,
+un objeto por perfil, en el mismo orden, con las llaves:
+  "id": el id del perfil,
+  "ai_score_value": entero de 1 a 10 (10 = tomador de decisiones de finanzas que trabaja hoy en la empresa),
+  "ai_explanation": explicación breve (máximo 20 palabras),
+  "ai_current_biz_flg": true si trabaja actualmente en la empresa,
+  "ai_role_finance_flg": true si su rol es de finanzas, contabilidad o tesorería.
+
+Perfiles:
+{profiles}
+"""
+
+    def __init__(self, project: str, location: str, generation_config: Dict) -> None:
+        from google import genai
+        from google.genai import types
+
+        self.__client = genai.Client(vertexai=True, project=project, location=location)
+        self.__config = types.GenerateContentConfig(**generation_config, response_mime_type='application/json')
+
+    def score(self, model: str, profiles: List[Dict]) -> List[Dict]:
+        payload = [
+            {
+                'id': index,
+                'empresa': profile.get('biz_name'),
+                'nombre': profile.get('full_name'),
+                'rol': profile.get('role'),
+                'titular': profile.get('headline') or profile.get('snippet') or profile.get('title'),
+                'url': profile.get('web_linkedin_url'),
+            }
+            for index, profile in enumerate(profiles)
+        ]
+        response = self.__client.models.generate_content(
+            model=model,
+            contents=self.PROMPT.format(profiles=json.dumps(payload, ensure_ascii=False)),
+            config=self.__config
+        )
+        by_id = {item.get('id'): item for item in json.loads(response.text)}
+        return [by_id.get(index, {}) for index in range(len(profiles))]
+
+
+class StubModelClient:
+    """
+    Modelo local sin costo para correr sin acceso a Gemini (desarrollo, pruebas de carga):
+    puntúa por palabras clave del rol y por coincidencia del nombre de la empresa
+    """
+
+    def score(self, model: str, profiles: List[Dict]) -> List[Dict]:
+        results = []
+        for profile in profiles:
+            text = _normalize(' '.join(str(profile.get(field) or '') for field in
+                                       ('role', 'headline', 'title', 'snippet', 'full_name')))
+            finance = any(keyword in text for keyword in FINANCE_KEYWORDS)
+            senior = any(word.startswith(keyword) for word in text.split() for keyword in SENIOR_KEYWORDS)
+            company_words = [word for word in _normalize(profile.get('biz_name')).split() if len(word) > 3]
+            current = not company_words or company_words[0] in text or company_words[0] in _normalize(profile.get('web_linkedin_url'))
+            score = (6 if finance else 2) + (3 if senior else 0) + (1 if current else 0)
+            results.append({
+                'ai_score_value': score,
+                'ai_explanation': f"stub: finanzas={finance}, directivo={senior}, empresa={current}",
+                'ai_current_biz_flg': current,
+                'ai_role_finance_flg': finance,
+            })
+        return results
+
+
+class ProfileScorer:
+
+    def __init__(self, client, models: List[str], max_requests_per_model: int, batch_size: int = 10,
+                 cache_max_entries: int = 50000, rotation: Optional[ModelRotation] = None,
+                 rate_limit_backoff: float = 30) -> None:
+        self.__client = client
+        self.__rate_limit_backoff = rate_limit_backoff
+        self.__rotation = rotation or ModelRotation(models, max_requests_per_model)
+        self.__batch_size = max(1, batch_size)
+        self.__cache_max_entries = cache_max_entries
+        self.__cache: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__stats = {'profiles_scored': 0, 'cache_hits': 0, 'model_requests': 0, 'model_errors': 0,
+                        'rate_limited': 0, 'unscored': 0}
+
+    @classmethod
+    def from_config(cls, quota_store=None) -> "ProfileScorer":
+        """quota_store: BigQueryService para el contador compartido de requests por modelo"""
+        models = [Config.GEMINI_MODEL_NAME] + Config.GEMINI_FALLBACK_MODELS
+        if Config.PROFILE_SCORING_BACKEND == 'stub':
+            # El modelo local no tiene cupo que compartir
+            client, quota_store = StubModelClient(), None
+        else:
+            client = GeminiModelClient(Config.GOOGLE_CLOUD_PROJECT_ID, Config.LOCATION, Config.GEMINI_CONFIG)
+        rotation = ModelRotation(
+            models,
+            Config.MAX_REQUESTS_PER_MODEL,
+            shared=quota_store if Config.MODEL_QUOTA_SHARED_STORE == 'bigquery' else None,
+            block_size=Config.MODEL_QUOTA_BLOCK_SIZE,
+            local_share=Config.MODEL_QUOTA_LOCAL_SHARE
+        )
+        return cls(
+            client,
+            models=models,
+            max_requests_per_model=Config.MAX_REQUESTS_PER_MODEL,
+            batch_size=Config.PROFILE_SCORING_BATCH_SIZE,
+            cache_max_entries=Config.PROFILE_SCORING_CACHE_SIZE,
+            rotation=rotation,
+            rate_limit_backoff=Config.MODEL_RATE_LIMIT_BACKOFF
+        )
+
+    @staticmethod
+    def profile_key(profile: Dict) -> Tuple[str, str]:
+        # La evaluación depende de la empresa (ai_current_biz_flg), no solo del perfil
+        return profile.get('biz_identifier') or '', canonical_profile_key(profile.get('web_linkedin_url'))
+
+    def score_profiles(self, profiles: List[Dict], deadline: Optional[Deadline] = None) -> List[Dict]:
+        """
+        Retorna los perfiles con los campos ai_* llenos. Los que ya los traen (por ejemplo,
+        evaluados por el Google Search Service) no se vuelven a evaluar. Si el modelo falla los
+        campos quedan en None y el perfil sigue en el pipeline; lo mismo si se agota el deadline.
+        """
+        evaluations: Dict[Tuple[str, str], Dict] = {}
+        to_score: "OrderedDict[Tuple[str, str], Dict]" = OrderedDict()
+        with self.__lock:
+            for profile in profiles:
+                if profile.get('ai_score_value') is not None:
+                    continue
+                key = self.profile_key(profile)
+                if key in evaluations or key in to_score:
+                    continue
+                cached = self.__cache.get(key)
+                if cached is not None:
+                    self.__cache.move_to_end(key)
+                    self.__stats['cache_hits'] += 1
+                    evaluations[key] = cached
+                else:
+                    to_score[key] = profile
+
+        pending = list(to_score.items())
+        for start in range(0, len(pending), self.__batch_size):
+            if deadline is not None and deadline.expired():
+                logger.warning(f"⏰ Tiempo agotado, {len(pending) - start} perfiles quedan sin evaluar")
+                break
+            batch = pending[start:start + self.__batch_size]
+            batch_results = self.__score_batch([profile for _, profile in batch])
+            with self.__lock:
+                for (key, _), result in zip(batch, batch_results):
+                    evaluations[key] = result
+                    if result:
+                        self.__cache[key] = result
+                        self.__cache.move_to_end(key)
+                while len(self.__cache) > self.__cache_max_entries:
+                    self.__cache.popitem(last=False)
+
+        scored = []
+        for profile in profiles:
+            if profile.get('ai_score_value') is not None:
+                scored.append(profile)
+                continue
+            evaluation = evaluations.get(self.profile_key(profile)) or {}
+            scored.append({**profile, **{field: evaluation.get(field) for field in AI_FIELDS}})
+        return scored
+
+    def __score_batch(self, profiles: List[Dict]) -> List[Dict]:
+        try:
+            return self.__score_with_rotation(profiles)
+        except (ModelQuotaExhausted, ModelScoringFailed) as e:
+            logger.error(f"❌ {e}; {len(profiles)} perfiles quedan sin evaluar")
+            with self.__lock:
+                self.__stats['unscored'] += len(profiles)
+            return [{} for _ in profiles]
+
+    def __score_with_rotation(self, profiles: List[Dict]) -> List[Dict]:
+        """Prueba los modelos en orden hasta que uno responda"""
+        tried: Tuple[str, ...] = ()
+        failures: Dict[str, str] = {}
+        while True:
+            try:
+                model = self.__rotation.acquire(skip=tried)
+            except ModelQuotaExhausted as e:
+                if failures:
+                    raise ModelScoringFailed(f"Fallaron los modelos {failures}") from e
+                raise
+
+            try:
+                raw_results = self.__client.score(model, profiles)
+            except Exception as e:
+                logger.warning(f"⚠️ Error evaluando {len(profiles)} perfiles con {model}: {e}")
+                with self.__lock:
+                    self.__stats['model_requests'] += 1
+                    self.__stats['model_errors'] += 1
+                kind, retry_after = quota_error(e)
+                if kind == 'daily':
+                    self.__rotation.exhaust(model)
+                else:
+                    if kind == 'rate':
+                        # Pausa con jitter para que los workers no vuelvan todos al mismo tiempo
+                        backoff = (retry_after or self.__rate_limit_backoff) * random.uniform(1.0, 1.5)
+                        logger.warning(f"🐢 {model} limitado por tasa, en pausa {backoff:.0f}s")
+                        self.__rotation.pause(model, backoff)
+                        with self.__lock:
+                            self.__stats['rate_limited'] += 1
+                    failures[model] = f"{e}"
+                tried += (model,)
+                continue
+
+            with self.__lock:
+                self.__stats['model_requests'] += 1
+                self.__stats['profiles_scored'] += len(profiles)
+            return [self.__normalize_result(result) for result in raw_results]
+
+    @staticmethod
+    def __normalize_result(result: Dict) -> Dict:
+        try:
+            score = float(result.get('ai_score_value'))
+        except (TypeError, ValueError):
+            return {}
+        score = min(10.0, max(0.0, score))
+        return {
+            'ai_score_value': score,
+            'ai_score_cat': result.get('ai_score_cat') or score_category(score),
+            'ai_explanation': result.get('ai_explanation'),
+            'ai_current_biz_flg': bool(result.get('ai_current_biz_flg')),
+            'ai_role_finance_flg': bool(result.get('ai_role_finance_flg')),
+        }
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            stats = {**self.__stats, 'cache_size': len(self.__cache)}
+        return {**stats, **self.__rotation.stats()}
@@ -0,0 +1,63 @@
+import heapq
+from typing import Callable, Dict, List, Optional, Tuple
+
+from linkedin_profile_keys import canonical_profile_key
+
+# Criterios de desempate entre perfiles con el mismo ai_score_value
+TIE_BREAKERS: Dict[str, Callable[[Dict, int], Tuple]] = {
+    # Primero rol de finanzas y empleo actual en la empresa, después el orden de la búsqueda
+    'finance_first': lambda profile, position: (
+        bool(profile.get('ai_role_finance_flg')), bool(profile.get('ai_current_biz_flg')), -position
+    ),
+    # Respeta el orden en que el Google Search Service devolvió los perfiles
+    'search_order': lambda profile, position: (-position,),
+}
+DEFAULT_TIE_BREAKER = 'finance_first'
+
+
+def _score(profile: Dict) -> Optional[float]:
+    try:
+        return float(profile.get('ai_score_value'))
+    except (TypeError, ValueError):
+        return None
+
+
+def select_profiles(profiles: List[Dict], min_score: Optional[float] = None,
+                    max_per_company: Optional[int] = None, tie_breaker: str = DEFAULT_TIE_BREAKER) -> List[Dict]:
+    """
+    Elige los perfiles que vale la pena scrapear.
+
+    - Descarta los que tienen ai_score_value menor que min_score. Los que no tienen score (el
+      modelo no alcanzó a evaluarlos) no se descartan, pero quedan detrás de los evaluados.
+    - Por biz_identifier conserva los max_per_company mejores (heap de tamaño k), desempatando
+      con tie_breaker ('finance_first' o 'search_order'). Un mismo perfil repetido con distintas
+      URLs cuenta una sola vez.
+
+    Retorna los perfiles elegidos agrupados por empresa, en orden de prioridad.
+    """
+    if tie_breaker not in TIE_BREAKERS:
+        raise ValueError(f"tie_breaker debe ser uno de {sorted(TIE_BREAKERS)}")
+    tie_key = TIE_BREAKERS[tie_breaker]
+
+    candidates_by_company: Dict[str, List] = {}
+    seen = set()
+    for position, profile in enumerate(profiles):
+        score = _score(profile)
+        if min_score is not None and score is not None and score < min_score:
+            continue
+        company = profile.get('biz_identifier') or ''
+        profile_key = (company, canonical_profile_key(profile.get('web_linkedin_url')))
+        if profile_key in seen:
+            continue
+        seen.add(profile_key)
+        rank = (score is not None, score if score is not None else 0.0, *tie_key(profile, position))
+        candidates_by_company.setdefault(company, []).append((rank, position, profile))
+
+    selected = []
+    for candidates in candidates_by_company.values():
+        if max_per_company:
+            best = heapq.nlargest(max_per_company, candidates, key=lambda candidate: candidate[0])
+        else:
+            best = sorted(candidates, key=lambda candidate: candidate[0], reverse=True)
+        selected.extend(profile for _, _, profile in best)
+    return selected
@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable
+
+
+class QueryResultCache:
+    """
+    Cache LRU con TTL para resultados de queries.
+
+    Las entradas expiran a los ttl_seconds y, si se supera max_entries, se descarta la menos
+    usada. invalidate() vacía el cache completo (por ejemplo, tras escribir en la tabla consultada).
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl_seconds: float = 30) -> None:
+        self.__max_entries = max_entries
+        self.__ttl_seconds = ttl_seconds
+        self.__entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__generation = 0
+        self.__stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0, 'invalidations': 0}
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Retorna el valor en cache para key o lo calcula con loader y lo guarda"""
+        now = time.monotonic()
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self.__entries.move_to_end(key)
+                    self.__stats['hits'] += 1
+                    return value
+                del self.__entries[key]
+                self.__stats['expirations'] += 1
+            self.__stats['misses'] += 1
+            generation = self.__generation
+
+        value = loader()
+
+        with self.__lock:
+            # Si hubo una invalidación mientras se ejecutaba la query, el resultado puede estar viejo
+            if generation == self.__generation:
+                self.__entries[key] = (time.monotonic() + self.__ttl_seconds, value)
+                self.__entries.move_to_end(key)
+                while len(self.__entries) > self.__max_entries:
+                    self.__entries.popitem(last=False)
+                    self.__stats['evictions'] += 1
+        return value
+
+    def invalidate(self) -> None:
+        with self.__lock:
+            self.__entries.clear()
+            self.__generation += 1
+            self.__stats['invalidations'] += 1
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            lookups = self.__stats['hits'] + self.__stats['misses']
+            return {
+                **self.__stats,
+                'size': len(self.__entries),
+                'hit_ratio': round(self.__stats['hits'] / lookups, 4) if lookups else 0.0,
+            }
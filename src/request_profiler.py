@@ -0,0 +1,106 @@
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+PROFILE_EXTENSION = '.folded'
+_SAFE_NAME = re.compile(r'[^A-Za-z0-9_.-]')
+
+
+class SamplingProfiler:
+    """
+    Profiler estadístico de un hilo: cada interval segundos toma el stack del hilo objetivo
+    desde otro hilo y acumula cuántas veces aparece cada stack.
+
+    El resultado se guarda en formato "folded" (una línea 'frame;frame;frame N' por stack),
+    que se puede abrir directamente en speedscope o convertir con flamegraph.pl.
+    """
+
+    def __init__(self, target_thread_id: int, interval: float = 0.005) -> None:
+        self.__target_thread_id = target_thread_id
+        self.__interval = interval
+        self.__samples: Counter = Counter()
+        self.__stop_event = threading.Event()
+        self.__thread: Optional[threading.Thread] = None
+        self.started_at = None
+        self.duration = 0.0
+
+    def start(self) -> None:
+        self.started_at = time.time()
+        self.__thread = threading.Thread(target=self.__run, name="request-profiler", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        if self.__thread is not None:
+            self.__thread.join()
+        self.duration = time.time() - self.started_at
+
+    @property
+    def sample_count(self) -> int:
+        return sum(self.__samples.values())
+
+    def __run(self) -> None:
+        while not self.__stop_event.wait(self.__interval):
+            frame = sys._current_frames().get(self.__target_thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.__samples[';'.join(reversed(stack))] += 1
+
+    def folded(self) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in self.__samples.most_common())
+
+
+class ProfileStore:
+    """Directorio local con los profiles más recientes, con un máximo de archivos"""
+
+    def __init__(self, directory: str, max_profiles: int = 100) -> None:
+        self.__directory = directory
+        self.__max_profiles = max_profiles
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, request_id: str, profiler: SamplingProfiler) -> str:
+        name = f"{time.strftime('%Y%m%dT%H%M%S')}_{_SAFE_NAME.sub('_', request_id)}{PROFILE_EXTENSION}"
+        path = os.path.join(self.__directory, name)
+        with open(path, 'w') as profile_file:
+            profile_file.write(profiler.folded())
+        self.__prune()
+        return name
+
+    def list(self) -> List[Dict]:
+        profiles = []
+        for name in os.listdir(self.__directory):
+            if not name.endswith(PROFILE_EXTENSION):
+                continue
+            stat = os.stat(os.path.join(self.__directory, name))
+            profiles.append({
+                'name': name,
+                'size_bytes': stat.st_size,
+                'created_at': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(stat.st_mtime)),
+            })
+        return sorted(profiles, key=lambda profile: profile['name'], reverse=True)
+
+    def path(self, name: str) -> Optional[str]:
+        """Ruta de un profile guardado, o None si el nombre no es válido o no existe"""
+        if _SAFE_NAME.search(name) or not name.endswith(PROFILE_EXTENSION):
+            return None
+        path = os.path.join(self.__directory, name)
+        return path if os.path.isfile(path) else None
+
+    def __prune(self) -> None:
+        for profile in self.list()[self.__max_profiles:]:
+            try:
+                os.remove(os.path.join(self.__directory, profile['name']))
+            except OSError:
+                pass
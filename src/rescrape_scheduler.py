@@ -0,0 +1,70 @@
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+
+class RescrapeScheduler:
+    """
+    Decide qué empresas se scrapean a continuación.
+
+    Primero las nunca scrapeadas; después, según antigüedad de scrapping_d y resultado anterior,
+    las que tienen contactos y envejecieron (refresh) y las que no tuvieron contactos y ya
+    cumplieron su backoff (retry). La priorización se hace en BigQuery
+    (BigQueryService.rank_companies_for_scraping); esta clase fija la política y lleva la cuenta
+    de qué tipo de empresas se están entregando.
+
+    next_batch(limit, exclude) tiene la firma de loader que espera PendingCompaniesPrefetcher.
+    """
+
+    def __init__(self, bigquery_service, refresh_days: float = 90, retry_base_days: float = 14,
+                 retry_max_days: float = 180, max_no_contact_attempts: int = 5,
+                 refresh_weight: float = 1.0, retry_weight: float = 0.5) -> None:
+        self.__bigquery_service = bigquery_service
+        self.__policy = {
+            'refresh_days': refresh_days,
+            'retry_base_days': retry_base_days,
+            'retry_max_days': retry_max_days,
+            'max_no_contact_attempts': max_no_contact_attempts,
+            'refresh_weight': refresh_weight,
+            'retry_weight': retry_weight,
+        }
+        self.__lock = threading.Lock()
+        self.__stats = {'batches': 0, 'never': 0, 'refresh': 0, 'retry': 0}
+
+    @classmethod
+    def from_config(cls, bigquery_service) -> "RescrapeScheduler":
+        return cls(
+            bigquery_service,
+            refresh_days=Config.RESCRAPE_REFRESH_DAYS,
+            retry_base_days=Config.RESCRAPE_RETRY_BASE_DAYS,
+            retry_max_days=Config.RESCRAPE_RETRY_MAX_DAYS,
+            max_no_contact_attempts=Config.RESCRAPE_MAX_NO_CONTACT_ATTEMPTS,
+            refresh_weight=Config.RESCRAPE_REFRESH_WEIGHT,
+            retry_weight=Config.RESCRAPE_RETRY_WEIGHT
+        )
+
+    def next_batch(self, limit: int, exclude: Optional[List[str]] = None) -> List[Dict]:
+        """Retorna hasta limit empresas ({'biz_name', 'biz_identifier'}) en orden de prioridad"""
+        ranked = self.__bigquery_service.rank_companies_for_scraping(limit, exclude=exclude, **self.__policy)
+
+        counts = {'never': 0, 'refresh': 0, 'retry': 0}
+        for company in ranked:
+            counts[company['reason']] = counts.get(company['reason'], 0) + 1
+        with self.__lock:
+            self.__stats['batches'] += 1
+            for reason, count in counts.items():
+                self.__stats[reason] = self.__stats.get(reason, 0) + count
+
+        if ranked:
+            logger.info(f"🗓️ Lote priorizado: {counts['never']} nuevas, {counts['refresh']} a refrescar, "
+                        f"{counts['retry']} a reintentar")
+        # El resto del pipeline solo espera nombre e identificador
+        return [{'biz_name': company['biz_name'], 'biz_identifier': company['biz_identifier']} for company in ranked]
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            return {**self.__stats, 'policy': dict(self.__policy)}
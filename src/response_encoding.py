@@ -0,0 +1,220 @@
+"""
+Serialización JSON rápida y compresión de respuestas.
+
+- OrjsonProvider reemplaza el JSONProvider de Flask (jsonify, dicts retornados por las vistas y
+  app.json.dumps de los streams NDJSON) con orjson, que serializa datetime de forma nativa en
+  ISO 8601. Si orjson no está instalado se usa el encoder estándar de Flask.
+- ResponseCompressor comprime con br o gzip (según Accept-Encoding) las respuestas de más de
+  min_size bytes; las respuestas en streaming se comprimen por chunk, con flush, para que el
+  cliente siga recibiendo cada línea en cuanto se genera.
+
+Ambos registran tiempos de serialización y tamaños en ResponseStats (ver /metrics).
+"""
+
+import dataclasses
+import decimal
+import gzip
+import logging
+import threading
+import time
+import zlib
+from typing import Dict, Iterable, Iterator, Optional
+
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - dependencia opcional
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - dependencia opcional
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+JSON_ENCODERS = ('orjson', 'stdlib')
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/plain', 'text/html', 'text/csv')
+
+
+class ResponseStats:
+    """Contadores de serialización y tamaño de respuestas, compartidos por todos los hilos del worker"""
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__encode = {'count': 0, 'seconds_total': 0.0, 'seconds_max': 0.0, 'bytes': 0}
+        self.__responses = {'count': 0, 'compressed': 0, 'bytes_uncompressed': 0, 'bytes_sent': 0}
+        self.__by_encoding: Dict[str, int] = {}
+
+    def record_encode(self, seconds: float, size: int) -> None:
+        with self.__lock:
+            self.__encode['count'] += 1
+            self.__encode['seconds_total'] += seconds
+            self.__encode['seconds_max'] = max(self.__encode['seconds_max'], seconds)
+            self.__encode['bytes'] += size
+
+    def record_response(self, uncompressed: int, sent: int, encoding: Optional[str] = None) -> None:
+        with self.__lock:
+            self.__responses['count'] += 1
+            self.__responses['bytes_uncompressed'] += uncompressed
+            self.__responses['bytes_sent'] += sent
+            if encoding:
+                self.__responses['compressed'] += 1
+                self.__by_encoding[encoding] = self.__by_encoding.get(encoding, 0) + 1
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            encode = dict(self.__encode)
+            responses = dict(self.__responses)
+            by_encoding = dict(self.__by_encoding)
+        encode['seconds_avg'] = encode['seconds_total'] / encode['count'] if encode['count'] else 0.0
+        responses['compression_ratio'] = (
+            responses['bytes_sent'] / responses['bytes_uncompressed'] if responses['bytes_uncompressed'] else None
+        )
+        return {'encode': encode, 'responses': {**responses, 'by_encoding': by_encoding}}
+
+
+def _default(o):
+    # Lo que orjson no serializa por sí mismo; datetime, date y UUID los resuelve de forma nativa
+    if isinstance(o, decimal.Decimal):
+        return str(o)
+    if isinstance(o, (set, frozenset)):
+        return list(o)
+    if dataclasses.is_dataclass(o):
+        return dataclasses.asdict(o)
+    if hasattr(o, '__html__'):
+        return str(o.__html__())
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSONProvider de Flask sobre orjson. Las llaves no se ordenan (a diferencia de jsonify)"""
+
+    stats: Optional[ResponseStats] = None
+
+    def dumps(self, obj, **kwargs) -> str:
+        return self.__encode(obj, indent=bool(kwargs.get('indent'))).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = (self.compact is None and self._app.debug) or self.compact is False
+        body = self.__encode(obj, indent=indent) + b"\n"
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+    def __encode(self, obj, indent: bool = False) -> bytes:
+        start = time.perf_counter()
+        option = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        body = orjson.dumps(obj, default=_default, option=option)
+        if self.stats is not None:
+            self.stats.record_encode(time.perf_counter() - start, len(body))
+        return body
+
+
+class StdlibJSONProvider(DefaultJSONProvider):
+    """Encoder estándar de Flask, midiendo el tiempo de serialización"""
+
+    stats: Optional[ResponseStats] = None
+
+    def dumps(self, obj, **kwargs) -> str:
+        start = time.perf_counter()
+        body = super().dumps(obj, **kwargs)
+        if self.stats is not None:
+            self.stats.record_encode(time.perf_counter() - start, len(body))
+        return body
+
+
+def create_json_provider(app, encoder: str, stats: Optional[ResponseStats] = None) -> DefaultJSONProvider:
+    """Crea el provider para app.json según JSON_ENCODER ('orjson' o 'stdlib')"""
+    if encoder not in JSON_ENCODERS:
+        raise ValueError(f"JSON_ENCODER debe ser uno de {JSON_ENCODERS}")
+    if encoder == 'orjson' and orjson is None:
+        logger.warning("⚠️ orjson no está instalado, se usa el encoder JSON estándar")
+        encoder = 'stdlib'
+    provider = OrjsonProvider(app) if encoder == 'orjson' else StdlibJSONProvider(app)
+    provider.stats = stats
+    return provider
+
+
+class ResponseCompressor:
+    """Comprime respuestas con br o gzip según Accept-Encoding (ver compress())"""
+
+    def __init__(self, min_size: int = 1024, gzip_level: int = 6, brotli_quality: int = 5,
+                 stats: Optional[ResponseStats] = None) -> None:
+        self.__min_size = min_size
+        self.__gzip_level = gzip_level
+        self.__brotli_quality = brotli_quality
+        self.__stats = stats
+
+    def choose_encoding(self, accept_encodings) -> Optional[str]:
+        """Prefiere br (si brotli está instalado) sobre gzip; None si el cliente no acepta ninguno"""
+        if brotli is not None and accept_encodings['br'] > 0:
+            return 'br'
+        if accept_encodings['gzip'] > 0:
+            return 'gzip'
+        return None
+
+    def compress(self, response, accept_encodings):
+        """Hook de after_request: retorna la respuesta comprimida si aplica, o la misma respuesta"""
+        if (response.status_code < 200 or response.status_code in (204, 304)
+                or response.direct_passthrough or 'Content-Encoding' in response.headers
+                or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+            return response
+        response.vary.add('Accept-Encoding')
+        encoding = self.choose_encoding(accept_encodings)
+
+        if response.is_streamed:
+            if encoding is None:
+                return response
+            response.response = self.__compress_stream(response.response, encoding)
+            response.headers['Content-Encoding'] = encoding
+            response.headers.pop('Content-Length', None)
+            return response
+
+        body = response.get_data()
+        if encoding is None or len(body) < self.__min_size:
+            if self.__stats is not None:
+                self.__stats.record_response(len(body), len(body))
+            return response
+        compressed = self.__compress_body(body, encoding)
+        response.set_data(compressed)
+        response.headers['Content-Encoding'] = encoding
+        if self.__stats is not None:
+            self.__stats.record_response(len(body), len(compressed), encoding)
+        return response
+
+    def __compress_body(self, body: bytes, encoding: str) -> bytes:
+        if encoding == 'br':
+            return brotli.compress(body, quality=self.__brotli_quality)
+        return gzip.compress(body, compresslevel=self.__gzip_level, mtime=0)
+
+    def __compress_stream(self, chunks: Iterable, encoding: str) -> Iterator[bytes]:
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.__brotli_quality)
+            compress, flush, finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            # wbits=31: formato gzip (encabezado y CRC), no zlib crudo
+            compressor = zlib.compressobj(self.__gzip_level, zlib.DEFLATED, 31)
+            compress, flush, finish = compressor.compress, lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+        uncompressed = sent = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode('utf-8')
+                uncompressed += len(chunk)
+                # Flush por chunk: la compresión no debe retrasar líneas ya generadas
+                data = compress(chunk) + flush()
+                sent += len(data)
+                yield data
+            data = finish()
+            sent += len(data)
+            yield data
+        finally:
+            # Cierra el generador original (stream_with_context libera ahí el contexto del request)
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            if self.__stats is not None:
+                self.__stats.record_response(uncompressed, sent, encoding)
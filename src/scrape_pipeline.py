@@ -0,0 +1,274 @@
+import logging
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from config import Config
+from bigquery_services import BigQueryService
+from linkedin_contacts_scrapper import LinkedInContactsSelectiveScraper
+from linkedin_profile_keys import canonical_profile_key
+from deadline import Deadline
+from circuit_breaker import get_circuit_breaker
+from profile_scoring import ProfileScorer
+from profile_selection import select_profiles
+from tracing import set_span_attributes, start_span, inject_trace_headers
+from bigquery_cost import QueryUsage, track_query_usage
+from upstream_cassette import get_upstream_cassette
+
+logger = logging.getLogger(__name__)
+
+
+def request_profiles(companies: List[Dict], timeout: Optional[float] = None):
+    """
+    Funcion para solicitar perfiles de LinkedIn a Google Search Service
+    (timeout: segundos máximos; por defecto Config.REQUEST_TIMEOUT)
+
+    Retorna la lista de perfiles, o None si la búsqueda falló (no se sabe si hay perfiles)
+
+    Raises:
+        CircuitOpenError: Si el circuito del servicio está abierto (falla de inmediato)
+    """
+    search_breaker = get_circuit_breaker('search')
+    search_breaker.before_call()
+    with start_span('search.request_profiles', {'companies.count': len(companies)}) as span:
+        return _request_profiles(companies, timeout, search_breaker, span)
+
+
+def _request_profiles(companies: List[Dict], timeout: Optional[float], search_breaker, span):
+    try:
+        logger.info(f"companies: {companies}")
+
+        url = Config.GOOGLE_SEARCH_SERVICE_URL
+
+        # traceparent: el search service continúa la traza de esta request
+        headers = inject_trace_headers({
+            'Content-Type': 'application/json'
+        })
+        body = { "companies": companies }
+
+
+        request_timeout = timeout if timeout is not None else Config.REQUEST_TIMEOUT
+
+        def send():
+            return requests.post(url=url, headers=headers, json=body, timeout=request_timeout)
+
+        try:
+            # Con cassette la respuesta se graba, o se reproduce sin llamar al servicio
+            cassette = get_upstream_cassette()
+            response = cassette.search(companies, send, request_timeout) if cassette is not None else send()
+        except Exception:
+            search_breaker.record_failure()
+            raise
+        set_span_attributes(span, **{'http.status_code': response.status_code})
+        # Solo errores del servicio (5xx, 429) cuentan para abrir el circuito
+        if response.status_code >= 500 or response.status_code == 429:
+            search_breaker.record_failure()
+        else:
+            search_breaker.record_success()
+
+        # Intentar decodificar JSON de la respuesta de forma segura
+        try:
+            response_json = response.json()
+        except Exception:
+            response_json = {"error": response.text}
+
+        logger.info(f"🔍 Response status: {response.status_code}")
+        logger.info(f"🔍 Response: {response_json}")
+
+        if response.status_code != 200:
+            logger.error(f"❌ Error en Google Search Service ({response.status_code}): {response_json}")
+            return None
+        logger.info(f"response_json: {response_json}")
+        profiles = response_json.get('profiles', [])
+        set_span_attributes(span, **{'profiles.count': len(profiles)})
+        return profiles
+    except Exception as e:
+        logger.error(f"❌ Error en solicitud de perfiles: {e}")
+        span.record_exception(e)
+        return None
+
+
+def iter_scrape_companies(bigquery_service: BigQueryService,
+                          scraper: LinkedInContactsSelectiveScraper,
+                          companies_data: List[Dict],
+                          scorer: Optional[ProfileScorer] = None,
+                          selection: Optional[Dict] = None,
+                          deadline: Optional[Deadline] = None) -> Iterator[Tuple[str, Dict]]:
+    """
+    Ejecuta el pipeline completo para un lote de empresas: búsqueda de perfiles, evaluación con
+    IA de los perfiles que no la traen (si se pasa scorer), selección de los mejores perfiles
+    por empresa (selection: argumentos de select_profiles), scraping, formateo de contactos y
+    escritura en las tablas de control y de contactos.
+
+    Con deadline cada etapa usa solo el tiempo restante. Si se agota, los contactos obtenidos se
+    escriben igual, pero solo se marcan como scrapeadas las empresas terminadas; las demás se
+    reportan en 'unfinished_companies' para reintentarlas. Las empresas terminadas sin contactos
+    (sin perfiles, sin seleccionados o sin resultados del actor) se marcan con contact_found_flg
+    False; si la búsqueda falla, ninguna se marca.
+
+    Genera eventos a medida que avanza; el consumidor debe agotar el generador, porque las
+    escrituras ocurren después del último contacto y antes del summary:
+        ('contact', contacto formateado para BigQuery)  -- uno por contacto, recién formateado
+        ('summary', {'profiles_found': int, 'profiles_selected': int, 'profiles_scraped': int,
+                     'contacts_count': int, 'unfinished_companies': [biz_identifier],
+                     'deadline_exceeded': bool, 'timings': {etapa: segundos},
+                     'bigquery_usage': {jobs, bytes procesados y facturados, slot-ms, costo estimado}})
+    """
+    timings = {}
+    # Jobs de BigQuery de esta request (con el buffer de escritura, los MERGE se cuentan en el flush)
+    bigquery_usage = QueryUsage()
+    pipeline_start = time.time()
+
+    stage_start = time.time()
+    if deadline is not None and deadline.expired():
+        profiles = []
+    else:
+        profiles = request_profiles(
+            companies_data,
+            timeout=deadline.timeout(cap=Config.REQUEST_TIMEOUT) if deadline is not None else None
+        )
+    timings['busqueda'] = round(time.time() - stage_start, 3)
+    # Sin perfiles por falta de tiempo o por falla de la búsqueda no se puede saber si las
+    # empresas tienen contactos
+    search_cut_short = profiles is None or (deadline is not None and deadline.expired())
+    profiles = profiles or []
+
+    if scorer is not None and profiles:
+        stage_start = time.time()
+        with start_span('pipeline.evaluacion', {'profiles.count': len(profiles)}):
+            profiles = scorer.score_profiles(profiles, deadline=deadline)
+        timings['evaluacion'] = round(time.time() - stage_start, 3)
+
+    # Solo se pagan scrapes de los perfiles que pasan el umbral y están en el top por empresa
+    selected_profiles = select_profiles(profiles, **(selection or {}))
+    counts = {'profiles_found': len(profiles), 'profiles_selected': len(selected_profiles)}
+    logger.info(f"🎯 {len(selected_profiles)} de {len(profiles)} perfiles seleccionados para scraping")
+
+    # Ejecutar scraping selectivo
+    results = []
+    if selected_profiles:
+        stage_start = time.time()
+        with start_span('pipeline.scraping', {'profiles.count': len(selected_profiles)}) as span:
+            results = scraper.scrape_linkedin_profiles(
+                profiles = selected_profiles,
+                deadline = deadline,
+            )
+            set_span_attributes(span, **{'profiles.scraped': len(results)})
+        timings['scraping'] = round(time.time() - stage_start, 3)
+
+    unfinished_keys = set()
+    if search_cut_short:
+        unfinished_keys = {company['biz_identifier'] for company in companies_data}
+    elif not scraper.test_metrics['run_complete']:
+        # Run cortado: una empresa está terminada solo si llegaron todos sus perfiles seleccionados
+        scraped_keys = {(profile['biz_identifier'], canonical_profile_key(profile['web_linkedin_url'])) for profile in results}
+        unfinished_keys = {
+            profile['biz_identifier'] for profile in selected_profiles
+            if (profile['biz_identifier'], canonical_profile_key(profile['web_linkedin_url'])) not in scraped_keys
+        }
+    finished_companies = [company for company in companies_data if company['biz_identifier'] not in unfinished_keys]
+    counts['unfinished_companies'] = sorted(unfinished_keys)
+    counts['deadline_exceeded'] = deadline is not None and deadline.exceeded
+    if unfinished_keys:
+        logger.warning(f"⏰ {len(unfinished_keys)} empresas sin terminar quedan para reintento: {sorted(unfinished_keys)}")
+
+    contacts_data = []
+    if results:
+        logger.info("📝 MARCANDO EMPRESAS COMO SCRAPEADAS...")
+        logger.info(f"Contacts results: {results}")
+
+        stage_start = time.time()
+        for contact in scraper.iter_contacts_for_bigquery(results):
+            contacts_data.append(contact)
+            yield 'contact', contact
+        timings['formato'] = round(time.time() - stage_start, 3)
+    else:
+        # Las empresas terminadas se marcan igual (contact_found_flg = False) para que apliquen
+        # el backoff de reintento en lugar de volver al inicio de la cola
+        logger.info("❌ No se obtuvieron resultados de acuerdo a los criterios de busqueda")
+
+    logger.info(f"Contacts data: {contacts_data}")
+    logger.info(f"Companies data: {companies_data}")
+
+    logger.info("Marcando empresas como scrapeadas")
+
+    # Las escrituras usan también la reserva del deadline para no perder lo ya obtenido
+    write_timeout = deadline.remaining(include_reserve=True) if deadline is not None else None
+
+    stage_start = time.time()
+    with track_query_usage(bigquery_usage):
+        _write_results(bigquery_service, contacts_data, finished_companies, write_timeout)
+    timings['bigquery'] = round(time.time() - stage_start, 3)
+    timings['total'] = round(time.time() - pipeline_start, 3)
+
+    # El summary confirma que los contactos ya enviados quedaron guardados
+    yield 'summary', {**counts, 'profiles_scraped': len(results), 'contacts_count': len(contacts_data),
+                      'timings': timings, 'bigquery_usage': bigquery_usage.stats()}
+
+
+def _write_results(bigquery_service: BigQueryService, contacts_data: List[Dict], finished_companies: List[Dict],
+                   write_timeout: Optional[float]) -> None:
+    """Marca las empresas terminadas en la tabla de control y guarda los contactos"""
+    if bigquery_service.write_behind_enabled:
+        # Las filas se agrupan con las de otras requests y se escriben en un MERGE por tabla
+        # (los jobs del flush quedan en trazas propias del hilo del buffer)
+        with start_span('pipeline.bigquery_write_behind', {'companies.count': len(finished_companies),
+                                                           'contacts.count': len(contacts_data)}):
+            # Si se espera la escritura, el MERGE sale sin esperar WRITE_BEHIND_MAX_AGE
+            pending_writes = [
+                bigquery_service.enqueue_companies_as_scraped(contacts_data, finished_companies,
+                                                              wait=Config.WRITE_BEHIND_WAIT),
+                bigquery_service.enqueue_contacts(contacts_data, wait=Config.WRITE_BEHIND_WAIT),
+            ]
+            if Config.WRITE_BEHIND_WAIT:
+                try:
+                    for pending_write in pending_writes:
+                        pending_write.result(timeout=write_timeout)
+                except FutureTimeoutError:
+                    logger.warning("⏰ Tiempo agotado esperando la escritura; se completará en segundo plano")
+    else:
+        if finished_companies:
+            with start_span('pipeline.control_write', {'companies.count': len(finished_companies)}):
+                bigquery_service.marcar_empresas_contacts_como_scrapeadas(contacts_data, finished_companies,
+                                                                          timeout=write_timeout)
+
+        if contacts_data:
+            # Guardar contactos en BigQuery
+            logger.info("\n💾 GUARDANDO CONTACTOS EN BIGQUERY...")
+
+            logger.info(f"Contactos: {contacts_data}")
+            with start_span('pipeline.contacts_write', {'contacts.count': len(contacts_data)}):
+                bigquery_service.save_contacts_to_bigquery(contacts_data, timeout=write_timeout)
+
+
+def scrape_companies(bigquery_service: BigQueryService,
+                     scraper: LinkedInContactsSelectiveScraper,
+                     companies_data: List[Dict],
+                     scorer: Optional[ProfileScorer] = None,
+                     selection: Optional[Dict] = None,
+                     deadline: Optional[Deadline] = None) -> Dict:
+    """
+    Versión no streaming de iter_scrape_companies
+
+    Returns:
+        {
+            'profiles_scraped': int,
+            'contacts': [contactos formateados para BigQuery],
+            'unfinished_companies': [biz_identifier],
+            'timings': {etapa: segundos},
+            'bigquery_usage': {jobs, bytes procesados y facturados, slot-ms, costo estimado}
+        }
+    """
+    contacts_data = []
+    summary = {}
+    for kind, payload in iter_scrape_companies(bigquery_service, scraper, companies_data,
+                                               scorer=scorer, selection=selection, deadline=deadline):
+        if kind == 'contact':
+            contacts_data.append(payload)
+        else:
+            summary = payload
+    return {'profiles_scraped': summary['profiles_scraped'], 'contacts': contacts_data,
+            'unfinished_companies': summary['unfinished_companies'], 'timings': summary['timings'],
+            'bigquery_usage': summary['bigquery_usage']}
@@ -0,0 +1,148 @@
+import logging
+import threading
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class ScrapedCompaniesIndex:
+    """
+    Índice en memoria de las empresas ya scrapeadas (biz_identifier -> biz_name) para responder
+    /validate sin ir a BigQuery.
+
+    - Se construye con un solo escaneo de la tabla de control (loader(since=None))
+    - Las escrituras de este proceso lo actualizan al momento (apply_control_rows)
+    - Un hilo lo refresca cada refresh_interval segundos con las filas cuyo scrapping_d es mayor
+      o igual a la marca de agua (lo que escribieron otros procesos) y cada full_reload_interval
+      segundos lo reconstruye completo (por ejemplo, si la tabla se recreó o se deduplicó)
+
+    Mientras no termina la primera carga, ready es False y quien consulta debe usar BigQuery.
+    """
+
+    def __init__(self, loader: Callable[[Optional[datetime]], Iterable], refresh_interval: float = 60,
+                 full_reload_interval: float = 3600) -> None:
+        self.__loader = loader
+        self.__refresh_interval = refresh_interval
+        self.__full_reload_interval = full_reload_interval
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__companies: Dict[str, str] = {}
+        self.__watermark: Optional[datetime] = None
+        self.__ready = False
+        self.__needs_full_reload = True
+        self.__last_full_reload = 0.0
+        self.__reload_log: Optional[List[Dict]] = None
+        self.__stopped = False
+        self.__thread: Optional[threading.Thread] = None
+        self.__stats = {'lookups': 0, 'full_reloads': 0, 'incremental_refreshes': 0,
+                        'local_updates': 0, 'refresh_errors': 0}
+
+    @property
+    def ready(self) -> bool:
+        return self.__ready
+
+    def start(self) -> None:
+        """Inicia el hilo de carga y refresco (idempotente)"""
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+        self.__stopped = False
+        self.__thread = threading.Thread(target=self.__run, name="scraped-companies-index", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stopped = True
+        self.__wakeup.set()
+        if self.__thread is not None:
+            self.__thread.join(timeout=5)
+
+    def needs_scraping(self, biz_identifier: str, company_name: str) -> bool:
+        """Misma respuesta que BigQueryService.verificar_empresa_scrapeada()['needs_scraping']"""
+        with self.__lock:
+            self.__stats['lookups'] += 1
+            return self.__companies.get(biz_identifier) != company_name
+
+    def apply_control_rows(self, rows: Optional[List[Dict]]) -> None:
+        """
+        Aplica filas recién escritas en la tabla de control por este proceso.
+        rows=None indica un cambio que no se puede aplicar fila a fila (tabla recreada o deduplicada).
+        """
+        if rows is None:
+            self.__needs_full_reload = True
+            self.__wakeup.set()
+            return
+        with self.__lock:
+            self.__apply(rows)
+            self.__stats['local_updates'] += len(rows)
+            if self.__reload_log is not None:
+                self.__reload_log.extend(rows)
+
+    def __apply(self, rows: Iterable[Dict]) -> None:
+        for row in rows:
+            if row.get('scrapping_d') is not None and row.get('contact_found_flg') is not None:
+                self.__companies[row['biz_identifier']] = row['biz_name']
+            else:
+                self.__companies.pop(row['biz_identifier'], None)
+
+    def __run(self) -> None:
+        while not self.__stopped:
+            try:
+                if self.__needs_full_reload or time.monotonic() - self.__last_full_reload >= self.__full_reload_interval:
+                    self.__full_reload()
+                else:
+                    self.__incremental_refresh()
+            except Exception as e:
+                self.__stats['refresh_errors'] += 1
+                logger.error(f"❌ Error refrescando índice de empresas scrapeadas: {e}")
+            self.__wakeup.wait(self.__refresh_interval)
+            self.__wakeup.clear()
+
+    def __full_reload(self) -> None:
+        start = time.time()
+        self.__needs_full_reload = False
+        with self.__lock:
+            # Lo que escriba este proceso durante el escaneo se vuelve a aplicar sobre el índice nuevo
+            self.__reload_log = []
+
+        companies: Dict[str, str] = {}
+        watermark = None
+        try:
+            for row in self.__loader(None):
+                companies[row['biz_identifier']] = row['biz_name']
+                if watermark is None or row['scrapping_d'] > watermark:
+                    watermark = row['scrapping_d']
+        except Exception:
+            with self.__lock:
+                self.__reload_log = None
+            self.__needs_full_reload = True
+            raise
+
+        with self.__lock:
+            pending_rows, self.__reload_log = self.__reload_log, None
+            self.__companies = companies
+            self.__apply(pending_rows)
+            self.__watermark = watermark
+            self.__ready = True
+            self.__last_full_reload = time.monotonic()
+            self.__stats['full_reloads'] += 1
+        logger.info(f"✅ Índice de empresas scrapeadas cargado: {len(companies)} empresas en {time.time() - start:.2f}s")
+
+    def __incremental_refresh(self) -> None:
+        watermark = self.__watermark
+        rows = list(self.__loader(watermark))
+        with self.__lock:
+            for row in rows:
+                self.__companies[row['biz_identifier']] = row['biz_name']
+                if self.__watermark is None or row['scrapping_d'] > self.__watermark:
+                    self.__watermark = row['scrapping_d']
+            self.__stats['incremental_refreshes'] += 1
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            return {
+                **self.__stats,
+                'ready': self.__ready,
+                'size': len(self.__companies),
+                'watermark': self.__watermark.isoformat() if self.__watermark else None,
+            }
@@ -0,0 +1,91 @@
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+
+class SingleFlightCall:
+    """Resultado (o error) de una ejecución en curso que otros requests pueden esperar"""
+
+    def __init__(self) -> None:
+        self.__event = threading.Event()
+        self.__result = None
+        self.__error: Optional[BaseException] = None
+        self.waiters = 0
+
+    def _set_result(self, result: Any) -> None:
+        self.__result = result
+        self.__event.set()
+
+    def _set_error(self, error: BaseException) -> None:
+        self.__error = error
+        self.__event.set()
+
+    def wait(self, timeout: Optional[float] = None) -> Any:
+        """
+        Espera el resultado de la ejecución original
+
+        Raises:
+            TimeoutError: Si la ejecución no termina dentro de timeout
+            Exception: El mismo error con el que falló la ejecución original
+        """
+        if not self.__event.wait(timeout):
+            raise TimeoutError("Tiempo de espera agotado esperando un scraping en curso")
+        if self.__error is not None:
+            raise self.__error
+        return self.__result
+
+
+class SingleFlight:
+    """
+    Registro en memoria de trabajos en curso por llave (por ejemplo biz_identifier).
+
+    El primer request que pide una llave la ejecuta; los que llegan mientras tanto reciben
+    el SingleFlightCall de esa ejecución y esperan su resultado en lugar de repetir el trabajo.
+    """
+
+    def __init__(self) -> None:
+        self.__lock = threading.Lock()
+        self.__calls: Dict[str, SingleFlightCall] = {}
+        self.__stats = {'leaders': 0, 'coalesced': 0}
+
+    def begin(self, keys: Iterable[str]) -> Tuple[List[str], Dict[str, SingleFlightCall]]:
+        """
+        Registra las llaves a procesar.
+
+        Returns:
+            (llaves que este request debe ejecutar, {llave: llamada en curso a esperar})
+            Cada llave propia debe cerrarse luego con complete() o fail().
+        """
+        owned = []
+        waiting = {}
+        with self.__lock:
+            for key in keys:
+                if key in owned or key in waiting:
+                    continue
+                call = self.__calls.get(key)
+                if call is None:
+                    self.__calls[key] = SingleFlightCall()
+                    owned.append(key)
+                else:
+                    call.waiters += 1
+                    waiting[key] = call
+            self.__stats['leaders'] += len(owned)
+            self.__stats['coalesced'] += len(waiting)
+        return owned, waiting
+
+    def complete(self, key: str, result: Any) -> None:
+        """Publica el resultado de una llave propia y la libera"""
+        with self.__lock:
+            call = self.__calls.pop(key, None)
+        if call is not None:
+            call._set_result(result)
+
+    def fail(self, key: str, error: BaseException) -> None:
+        """Publica el error de una llave propia y la libera"""
+        with self.__lock:
+            call = self.__calls.pop(key, None)
+        if call is not None:
+            call._set_error(error)
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            return {**self.__stats, 'in_flight': len(self.__calls)}
@@ -0,0 +1,187 @@
+"""
+Trazas distribuidas de /scrape con OpenTelemetry.
+
+Cada request de /scrape genera una traza con un span por etapa: búsqueda de perfiles (con el
+contexto propagado al Google Search Service en el header traceparent), evaluación, run del actor
+de Apify, páginas del dataset, limpieza y combinación, escrituras y un span por job de BigQuery
+(job_id, bytes procesados, filas afectadas).
+
+Requiere opentelemetry-api para instrumentar y opentelemetry-sdk para exportar; sin ellos, o con
+TRACING_ENABLED=False, start_span() retorna un span vacío sin costo. Exportadores:
+    file     un span JSON por línea en TRACING_FILE (uso local, sin collector)
+    console  un span JSON por línea en stdout
+    otlp     collector OTLP/HTTP (requiere opentelemetry-exporter-otlp-proto-http;
+             endpoint en OTEL_EXPORTER_OTLP_ENDPOINT)
+    none     usa el provider global ya configurado (por ejemplo, con opentelemetry-instrument)
+"""
+
+import logging
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, Mapping, Optional
+
+try:
+    from opentelemetry import context as otel_context, propagate, trace
+except ImportError:  # pragma: no cover - dependencia opcional
+    trace = None
+
+try:
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter, SimpleSpanProcessor
+    from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+except ImportError:  # pragma: no cover - dependencia opcional
+    TracerProvider = None
+
+logger = logging.getLogger(__name__)
+
+TRACING_EXPORTERS = ('console', 'file', 'otlp', 'none')
+TRACER_NAME = 'linkedin_contacts'
+
+
+class _NoopSpan:
+    """Span vacío para cuando las trazas están apagadas"""
+
+    def set_attribute(self, key, value) -> None:
+        pass
+
+    def set_attributes(self, attributes) -> None:
+        pass
+
+    def record_exception(self, exception, attributes=None) -> None:
+        pass
+
+    def is_recording(self) -> bool:
+        return False
+
+
+_NOOP_SPAN = _NoopSpan()
+_tracer = None
+_provider = None
+_lock = threading.Lock()
+
+
+def configure_tracing(enabled: bool, exporter: str = 'file', file_path: Optional[str] = None,
+                      service_name: str = 'linkedin-contacts-scraper', sample_rate: float = 1.0) -> bool:
+    """
+    Configura el exportador de spans del proceso. Retorna True si las trazas quedaron activas.
+
+    Los procesadores no dejan hilos antes del fork (console/file exportan en el mismo hilo y el
+    BatchSpanProcessor de otlp se reinicia en cada worker), así que se puede llamar al importar
+    la app con preload_app.
+    """
+    global _tracer, _provider
+
+    if not enabled:
+        return False
+    if exporter not in TRACING_EXPORTERS:
+        raise ValueError(f"TRACING_EXPORTER debe ser uno de {TRACING_EXPORTERS}")
+    if trace is None:
+        logger.warning("⚠️ opentelemetry-api no está instalado, las trazas quedan apagadas")
+        return False
+
+    with _lock:
+        if _tracer is not None:
+            return True
+        if exporter == 'none':
+            _tracer = trace.get_tracer(TRACER_NAME)
+            logger.info("🧭 Trazas activas con el provider global de OpenTelemetry")
+            return True
+        if TracerProvider is None:
+            logger.warning("⚠️ opentelemetry-sdk no está instalado, las trazas quedan apagadas")
+            return False
+
+        span_processor = _span_processor(exporter, file_path)
+        if span_processor is None:
+            return False
+        provider = TracerProvider(
+            resource=Resource.create({'service.name': service_name}),
+            sampler=ParentBased(TraceIdRatioBased(max(0.0, min(1.0, sample_rate))))
+        )
+        provider.add_span_processor(span_processor)
+        trace.set_tracer_provider(provider)
+        _provider = provider
+        _tracer = provider.get_tracer(TRACER_NAME)
+    logger.info(f"🧭 Trazas activas (exportador {exporter}, muestreo {sample_rate:.0%})")
+    return True
+
+
+def _span_processor(exporter: str, file_path: Optional[str]):
+    if exporter == 'otlp':
+        try:
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        except ImportError:
+            logger.warning("⚠️ opentelemetry-exporter-otlp-proto-http no está instalado, las trazas quedan apagadas")
+            return None
+        return BatchSpanProcessor(OTLPSpanExporter())
+
+    if exporter == 'file':
+        directory = os.path.dirname(file_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Modo append: los workers escriben líneas completas en el mismo archivo
+        out = open(file_path, 'a', encoding='utf-8')
+    else:
+        out = sys.stdout
+    return SimpleSpanProcessor(ConsoleSpanExporter(
+        out=out, formatter=lambda span: span.to_json(indent=None) + os.linesep
+    ))
+
+
+def shutdown_tracing() -> None:
+    """Exporta los spans pendientes (al apagar un worker)"""
+    if _provider is not None:
+        _provider.shutdown()
+
+
+def tracing_enabled() -> bool:
+    return _tracer is not None
+
+
+@contextmanager
+def start_span(name: str, attributes: Optional[Dict] = None, parent=None) -> Iterator:
+    """
+    Abre un span hijo del span actual (o de parent, un contexto de extract_trace_context o
+    current_trace_context) y lo deja como actual mientras dura el bloque. Una excepción que
+    sale del bloque queda registrada en el span, que se marca con error.
+    """
+    if _tracer is None:
+        yield _NOOP_SPAN
+        return
+    with _tracer.start_as_current_span(name, context=parent, attributes=_clean(attributes)) as span:
+        yield span
+
+
+def set_span_attributes(span, **attributes) -> None:
+    """Agrega atributos omitiendo los None (OpenTelemetry no los acepta)"""
+    if span.is_recording():
+        span.set_attributes(_clean(attributes))
+
+
+def _clean(attributes: Optional[Dict]) -> Optional[Dict]:
+    if not attributes:
+        return None
+    return {key: value for key, value in attributes.items() if value is not None}
+
+
+def inject_trace_headers(headers: Dict[str, str]) -> Dict[str, str]:
+    """Agrega traceparent/tracestate del span actual a los headers de una request saliente"""
+    if _tracer is not None:
+        propagate.inject(headers)
+    return headers
+
+
+def extract_trace_context(headers: Mapping[str, str]):
+    """Contexto de la traza del cliente (header traceparent) para usarlo como parent del span raíz"""
+    if _tracer is None:
+        return None
+    return propagate.extract(headers)
+
+
+def current_trace_context():
+    """Contexto actual, para continuar la traza en otro hilo (start_span(..., parent=ctx))"""
+    if _tracer is None:
+        return None
+    return otel_context.get_current()
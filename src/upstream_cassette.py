@@ -0,0 +1,417 @@
+"""
+Grabación y reproducción (cassette) de las respuestas del Google Search Service y de Apify.
+
+En modo record se guardan, a medida que ocurren, las respuestas reales que ve el pipeline: el
+JSON de cada búsqueda de request_profiles, la metadata de cada run del actor y las páginas del
+dataset, con el tiempo que tardó cada una. Cada proceso graba su propio archivo JSONL
+comprimido con gzip (el pid antes de la extensión: cassette.1234.jsonl.gz; una interacción por
+línea, grabaciones sucesivas se agregan al final), así los workers de gunicorn no mezclan sus
+bytes comprimidos.
+
+En modo replay no se hace ninguna llamada: las búsquedas y los runs se sirven desde el cassette
+con su tiempo original multiplicado por UPSTREAM_CASSETTE_SPEED (0 = sin esperas). Una búsqueda
+se busca por sus biz_identifier; si no está grabada se usa la siguiente del cassette (en orden,
+en ciclo) con sus empresas reasignadas a las de la request, así un benchmark con otras empresas
+pendientes recorre igual datos con forma de producción. Los runs se buscan por sus URLs.
+Se leen UPSTREAM_CASSETTE_PATH y todos los archivos por proceso grabados con ese path; si uno
+quedó cortado (el proceso murió sin cerrarlo) se usan las líneas completas que alcanzó a escribir.
+"""
+
+import glob
+import gzip
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import types
+import zlib
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import requests
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+CASSETTE_MODES = ('off', 'record', 'replay')
+
+
+def _search_key(companies: List[Dict]) -> str:
+    return '|'.join(sorted(str(company.get('biz_identifier')) for company in companies))
+
+
+def _run_key(run_input: Dict) -> str:
+    urls = sorted(run_input.get('profileUrls') or [])
+    return hashlib.sha1('\n'.join(urls).encode('utf-8')).hexdigest()
+
+
+def process_cassette_path(path: str, pid: Optional[int] = None) -> str:
+    """Archivo de grabación de un proceso: el pid antes de la extensión (cassette.jsonl.gz -> cassette.1234.jsonl.gz)"""
+    directory, name = os.path.split(path)
+    stem, dot, extension = name.partition('.')
+    return os.path.join(directory, f"{stem}.{pid or os.getpid()}{dot}{extension}")
+
+
+def cassette_files(path: str) -> List[str]:
+    """path (si existe) y los archivos por proceso grabados con él"""
+    directory, name = os.path.split(path)
+    stem, dot, extension = name.partition('.')
+    pattern = os.path.join(glob.escape(directory), f"{glob.escape(stem)}.[0-9]*{dot}{glob.escape(extension)}")
+    return ([path] if os.path.exists(path) else []) + sorted(glob.glob(pattern))
+
+
+def _read_gzip_lines(path: str) -> Tuple[List[str], bool]:
+    """
+    Líneas completas de un gzip de varios miembros. Retorna (líneas, cortado): si el último miembro
+    no tiene marca de fin (proceso terminado sin cerrar el archivo) se conserva lo que alcanzó a
+    escribirse con flush y se descarta la última línea incompleta.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    chunks = []
+    truncated = False
+    while data:
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            chunks.append(decompressor.decompress(data))
+        except zlib.error:
+            truncated = True
+            break
+        if not decompressor.eof:
+            truncated = True
+            break
+        data = decompressor.unused_data
+    text = b''.join(chunks).decode('utf-8', errors='replace')
+    lines = text.split('\n')
+    # Lo que sigue al último salto de línea es una línea sin terminar (o vacío)
+    return lines[:-1], truncated or bool(lines[-1])
+
+
+class ReplayResponse:
+    """Respuesta HTTP grabada con la interfaz que usa request_profiles (status_code, text, json())"""
+
+    def __init__(self, status_code: int, text: str) -> None:
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class UpstreamCassette:
+    """Cassette de un proceso (ver el docstring del módulo)"""
+
+    def __init__(self, mode: str, path: str, speed: float = 1.0) -> None:
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"mode debe ser 'record' o 'replay', no {mode!r}")
+        self.mode = mode
+        self.path = path
+        self.__speed = max(0.0, speed)
+        self.__lock = threading.Lock()
+        self.__stats = {'recorded': 0, 'replayed': 0, 'replay_misses': 0}
+        self.__file = None
+        self.__file_pid = None
+        self.__searches: List[Dict] = []
+        self.__searches_by_key: Dict[str, Dict] = {}
+        self.__runs: List[Dict] = []
+        self.__runs_by_key: Dict[str, Dict] = {}
+        self.__datasets: Dict[str, Dict] = {}
+        self.__next_search = 0
+        self.__next_run = 0
+        if mode == 'record':
+            self.__open()
+        else:
+            self.__load()
+
+    def __open(self) -> None:
+        """Abre (o tras un fork, reabre) el archivo de grabación de este proceso"""
+        self.__file_pid = os.getpid()
+        self.__file = gzip.open(process_cassette_path(self.path, self.__file_pid), 'at', encoding='utf-8')
+
+    def __load(self) -> None:
+        files = cassette_files(self.path)
+        if not files:
+            raise FileNotFoundError(f"No hay cassettes grabados en {self.path}")
+        for path in files:
+            lines, truncated = _read_gzip_lines(path)
+            if truncated:
+                logger.warning(f"⚠️ Cassette {path} cortado (el proceso no lo cerró); se usan sus {len(lines)} líneas completas")
+            for line in lines:
+                if line.strip():
+                    self.__add(json.loads(line))
+        logger.info(f"📼 Cassette {self.path} ({len(files)} archivos): {len(self.__searches)} búsquedas, "
+                    f"{len(self.__runs)} runs, {len(self.__datasets)} datasets")
+
+    def __add(self, entry: Dict) -> None:
+        kind = entry['kind']
+        if kind == 'search':
+            self.__searches.append(entry)
+            self.__searches_by_key.setdefault(entry['key'], entry)
+        elif kind == 'apify_run':
+            self.__runs.append(entry)
+            self.__runs_by_key.setdefault(entry['key'], entry)
+        elif kind == 'apify_dataset_info':
+            self.__datasets.setdefault(entry['dataset_id'], {'pages': {}})['info'] = entry
+        elif kind == 'apify_dataset_page':
+            dataset = self.__datasets.setdefault(entry['dataset_id'], {'pages': {}})
+            dataset['pages'][entry['offset']] = entry
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+    def stats(self) -> Dict:
+        with self.__lock:
+            return {'mode': self.mode, 'path': self.path, **self.__stats}
+
+    def record(self, kind: str, elapsed: float, **fields) -> None:
+        line = json.dumps({'kind': kind, 'elapsed': round(elapsed, 4), **fields}, ensure_ascii=False, default=str)
+        with self.__lock:
+            if self.__file is None:
+                return
+            if self.__file_pid != os.getpid():
+                # Proceso hijo de un fork: graba en su propio archivo
+                self.__open()
+            self.__file.write(line + '\n')
+            # Cada interacción queda en disco aunque el proceso se corte
+            self.__file.flush()
+            self.__stats['recorded'] += 1
+
+    def __wait(self, elapsed: float, limit: Optional[float] = None) -> bool:
+        """Espera el tiempo grabado (escalado); retorna False si limit lo corta antes"""
+        delay = elapsed * self.__speed
+        if limit is not None and delay > limit:
+            time.sleep(max(0.0, limit))
+            return False
+        if delay > 0:
+            time.sleep(delay)
+        return True
+
+    def __count(self, hit: bool) -> None:
+        with self.__lock:
+            self.__stats['replayed'] += 1
+            if not hit:
+                self.__stats['replay_misses'] += 1
+
+    # Search service
+
+    def search(self, companies: List[Dict], send: Callable[[], requests.Response], timeout: Optional[float] = None):
+        """Hace (record) o reproduce (replay) el POST de request_profiles; send hace el request real"""
+        if self.mode == 'record':
+            start = time.time()
+            response = send()
+            self.record('search', time.time() - start, key=_search_key(companies),
+                        companies=[{'biz_identifier': company.get('biz_identifier'), 'biz_name': company.get('biz_name')}
+                                   for company in companies],
+                        status_code=response.status_code, text=response.text)
+            return response
+
+        entry = self.__searches_by_key.get(_search_key(companies))
+        hit = entry is not None
+        if not hit:
+            if not self.__searches:
+                raise RuntimeError(f"El cassette {self.path} no tiene búsquedas grabadas")
+            with self.__lock:
+                entry = self.__searches[self.__next_search % len(self.__searches)]
+                self.__next_search += 1
+        self.__count(hit)
+        if not self.__wait(entry['elapsed'], timeout):
+            raise requests.Timeout(f"Búsqueda grabada tarda {entry['elapsed']}s (timeout {timeout}s)")
+        text = entry['text'] if hit else self.__reassign_companies(entry, companies)
+        return ReplayResponse(entry['status_code'], text)
+
+    @staticmethod
+    def __reassign_companies(entry: Dict, companies: List[Dict]) -> str:
+        """Los perfiles de la i-ésima empresa grabada pasan a la i-ésima empresa de la request"""
+        try:
+            body = json.loads(entry['text'])
+        except ValueError:
+            return entry['text']
+        if not companies or not isinstance(body, dict):
+            return entry['text']
+        mapping = {recorded['biz_identifier']: companies[index % len(companies)]
+                   for index, recorded in enumerate(entry.get('companies') or [])}
+        for profile in body.get('profiles') or []:
+            company = mapping.get(profile.get('biz_identifier'))
+            if company is not None:
+                profile['biz_identifier'] = company.get('biz_identifier')
+                profile['biz_name'] = company.get('biz_name')
+        return json.dumps(body, ensure_ascii=False)
+
+    # Apify
+
+    def wrap_apify_client(self, apify_client):
+        """En record envuelve el cliente real; en replay lo reemplaza por uno que lee del cassette"""
+        if self.mode == 'record':
+            return _RecordingApifyClient(apify_client, self)
+        return _ReplayApifyClient(self)
+
+    def replay_run(self, run_input: Dict, wait_secs: Optional[float] = None) -> Dict:
+        entry = self.__runs_by_key.get(_run_key(run_input))
+        hit = entry is not None
+        if not hit:
+            if not self.__runs:
+                raise RuntimeError(f"El cassette {self.path} no tiene runs de Apify grabados")
+            with self.__lock:
+                entry = self.__runs[self.__next_run % len(self.__runs)]
+                self.__next_run += 1
+        self.__count(hit)
+        run = dict(entry['run'])
+        if not self.__wait(entry['elapsed'], wait_secs):
+            # El run grabado no alcanza a terminar en el tiempo pedido, como con el actor real
+            run['status'] = 'RUNNING'
+        return run
+
+    def replay_dataset_info(self, dataset_id: str) -> Dict:
+        dataset = self.__datasets.get(dataset_id, {'pages': {}})
+        info = dataset.get('info')
+        if info is not None:
+            self.__wait(info['elapsed'])
+            return dict(info['info'])
+        return {'itemCount': sum(len(page['items']) for page in dataset['pages'].values())}
+
+    def replay_dataset_page(self, dataset_id: str, offset: int, limit: int, fields: Optional[List[str]] = None) -> List[Dict]:
+        dataset = self.__datasets.get(dataset_id, {'pages': {}})
+        pages = dataset['pages']
+        page = pages.get(offset)
+        if page is not None and page['limit'] == limit:
+            self.__wait(page['elapsed'])
+            items = page['items']
+        else:
+            # Otro tamaño de página que el grabado: se arma desde los items con la latencia media
+            ordered = [pages[page_offset] for page_offset in sorted(pages)]
+            all_items = [item for recorded in ordered for item in recorded['items']]
+            if ordered:
+                self.__wait(sum(recorded['elapsed'] for recorded in ordered) / len(ordered))
+            items = all_items[offset:offset + limit]
+        if fields:
+            return [{field: item[field] for field in fields if field in item} for item in items]
+        return [dict(item) for item in items]
+
+
+class _RecordingApifyClient:
+    """Cliente de Apify que delega en el real y graba runs del actor y páginas del dataset"""
+
+    def __init__(self, apify_client, cassette: UpstreamCassette) -> None:
+        self.__client = apify_client
+        self.__cassette = cassette
+
+    def actor(self, actor_id: str):
+        return _RecordingActor(self.__client.actor(actor_id), actor_id, self.__cassette)
+
+    def run(self, run_id: str):
+        return self.__client.run(run_id)
+
+    def dataset(self, dataset_id: str):
+        return _RecordingDataset(self.__client.dataset(dataset_id), dataset_id, self.__cassette)
+
+
+class _RecordingActor:
+
+    def __init__(self, actor, actor_id: str, cassette: UpstreamCassette) -> None:
+        self.__actor = actor
+        self.__actor_id = actor_id
+        self.__cassette = cassette
+
+    def call(self, run_input: Dict, **kwargs):
+        start = time.time()
+        run = self.__actor.call(run_input=run_input, **kwargs)
+        if run is not None:
+            self.__cassette.record('apify_run', time.time() - start, actor=self.__actor_id, key=_run_key(run_input),
+                                   run={key: run.get(key) for key in ('id', 'status', 'defaultDatasetId')})
+        return run
+
+
+class _RecordingDataset:
+
+    def __init__(self, dataset, dataset_id: str, cassette: UpstreamCassette) -> None:
+        self.__dataset = dataset
+        self.__dataset_id = dataset_id
+        self.__cassette = cassette
+
+    def get(self):
+        start = time.time()
+        info = self.__dataset.get()
+        if info is not None:
+            self.__cassette.record('apify_dataset_info', time.time() - start, dataset_id=self.__dataset_id,
+                                   info={'itemCount': info.get('itemCount')})
+        return info
+
+    def list_items(self, offset: int = 0, limit: Optional[int] = None, fields: Optional[List[str]] = None, **kwargs):
+        start = time.time()
+        page = self.__dataset.list_items(offset=offset, limit=limit, fields=fields, **kwargs)
+        self.__cassette.record('apify_dataset_page', time.time() - start, dataset_id=self.__dataset_id,
+                               offset=offset, limit=limit, items=page.items)
+        return page
+
+    def iterate_items(self, fields: Optional[List[str]] = None, **kwargs) -> Iterator[Dict]:
+        start = time.time()
+        items = []
+        for item in self.__dataset.iterate_items(fields=fields, **kwargs):
+            items.append(item)
+            yield item
+        self.__cassette.record('apify_dataset_page', time.time() - start, dataset_id=self.__dataset_id,
+                               offset=0, limit=None, items=items)
+
+
+class _ReplayApifyClient:
+    """Cliente de Apify que responde desde el cassette, sin llamadas a la API"""
+
+    def __init__(self, cassette: UpstreamCassette) -> None:
+        self.__cassette = cassette
+
+    def actor(self, actor_id: str):
+        cassette = self.__cassette
+
+        def call(run_input: Dict, wait_secs: Optional[float] = None, **kwargs):
+            return cassette.replay_run(run_input, wait_secs=wait_secs)
+
+        return types.SimpleNamespace(call=call)
+
+    def run(self, run_id: str):
+        return types.SimpleNamespace(abort=lambda **kwargs: None)
+
+    def dataset(self, dataset_id: str):
+        cassette = self.__cassette
+
+        def list_items(offset: int = 0, limit: Optional[int] = None, fields: Optional[List[str]] = None, **kwargs):
+            items = cassette.replay_dataset_page(dataset_id, offset, limit, fields)
+            return types.SimpleNamespace(items=items, offset=offset, limit=limit, count=len(items))
+
+        def iterate_items(fields: Optional[List[str]] = None, **kwargs):
+            yield from cassette.replay_dataset_page(dataset_id, 0, None, fields)
+
+        return types.SimpleNamespace(get=lambda: cassette.replay_dataset_info(dataset_id),
+                                     list_items=list_items, iterate_items=iterate_items)
+
+
+_cassette: Optional[UpstreamCassette] = None
+_cassette_lock = threading.Lock()
+_cassette_configured = False
+
+
+def get_upstream_cassette() -> Optional[UpstreamCassette]:
+    """Cassette del proceso según Config.UPSTREAM_CASSETTE_*; None con UPSTREAM_CASSETTE_MODE=off"""
+    global _cassette, _cassette_configured
+
+    if not _cassette_configured:
+        with _cassette_lock:
+            if not _cassette_configured:
+                mode = Config.UPSTREAM_CASSETTE_MODE
+                if mode not in CASSETTE_MODES:
+                    raise ValueError(f"UPSTREAM_CASSETTE_MODE debe ser uno de {list(CASSETTE_MODES)}")
+                if mode != 'off':
+                    _cassette = UpstreamCassette(mode, Config.UPSTREAM_CASSETTE_PATH, Config.UPSTREAM_CASSETTE_SPEED)
+                    logger.info(f"📼 Cassette de upstreams en modo {mode}: {Config.UPSTREAM_CASSETTE_PATH}")
+                _cassette_configured = True
+    return _cassette
+
+
+def close_upstream_cassette() -> None:
+    """Cierra el archivo del cassette en grabación (al apagar el proceso)"""
+    if _cassette is not None:
+        _cassette.close()
@@ -0,0 +1,197 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindBuffer:
+    """
+    Buffer de escritura diferida que agrupa filas de muchas requests por tabla.
+
+    Cada tabla tiene una función de flush que recibe todas las filas acumuladas y las escribe
+    en un solo job (por ejemplo un MERGE). El flush ocurre cuando una tabla acumula max_rows
+    filas, cuando su fila más antigua cumple max_age_seconds o, si alguien espera sus filas
+    (enqueue con urgent), en cuanto termina el flush en curso de esa tabla: las filas que llegan
+    mientras tanto se agrupan en el siguiente. Quien encola filas recibe un Future que se
+    resuelve cuando esas filas quedaron escritas.
+
+    Si un flush falla, sus filas vuelven al inicio de la tabla y se reintentan tras
+    retry_backoff segundos (el doble en cada intento); solo después de max_retries reintentos
+    se descartan, se informa el error en sus Futures y se cuentan en rows_dropped.
+    """
+
+    def __init__(self,
+                 flushers: Dict[str, Callable[[List[Dict]], Dict]],
+                 max_rows: int = 500,
+                 max_age_seconds: float = 5,
+                 max_retries: int = 3,
+                 retry_backoff: float = 2) -> None:
+        """
+        Args:
+            flushers: {nombre de tabla: función que escribe una lista de filas}
+            max_rows: Filas acumuladas por tabla que disparan un flush inmediato
+            max_age_seconds: Antigüedad máxima de una fila antes de hacer flush
+            max_retries: Reintentos de un flush fallido antes de descartar sus filas
+            retry_backoff: Espera antes del primer reintento (se duplica en cada uno)
+        """
+        self.__flushers = flushers
+        self.__max_rows = max_rows
+        self.__max_age_seconds = max_age_seconds
+        self.__max_retries = max_retries
+        self.__retry_backoff = retry_backoff
+
+        # Por tabla: (filas, Future, intentos fallidos) de cada enqueue
+        self.__pending: Dict[str, List[Tuple[List[Dict], Future, int]]] = {table: [] for table in flushers}
+        self.__pending_rows: Dict[str, int] = {table: 0 for table in flushers}
+        self.__oldest: Dict[str, float] = {}
+        # Tablas con filas que alguien está esperando: no esperan max_age_seconds
+        self.__urgent = set()
+        # Tablas con un flush fallido: no se reintentan antes de este time.monotonic()
+        self.__retry_at: Dict[str, float] = {}
+        # Un solo flush a la vez por tabla para que los MERGE no compitan entre sí
+        self.__flush_locks = {table: threading.Lock() for table in flushers}
+
+        self.__condition = threading.Condition()
+        self.__closed = False
+        self.__stats = {'rows_buffered': 0, 'flushes': 0, 'rows_flushed': 0, 'flush_errors': 0,
+                        'flush_retries': 0, 'rows_dropped': 0}
+
+        self.__thread = threading.Thread(target=self.__run, name="bigquery-write-behind", daemon=True)
+        self.__thread.start()
+        atexit.register(self.close)
+
+    def enqueue(self, table: str, rows: List[Dict], urgent: bool = False) -> Future:
+        """
+        Encola filas para una tabla y retorna un Future con el resultado de su flush
+        (urgent: quien encola va a esperar el Future, así que la tabla hace flush sin esperar max_age_seconds)
+        """
+        future = Future()
+        if not rows:
+            future.set_result(None)
+            return future
+
+        with self.__condition:
+            if self.__closed:
+                raise RuntimeError("El buffer de escritura ya fue cerrado")
+            self.__pending[table].append((rows, future, 0))
+            self.__pending_rows[table] += len(rows)
+            self.__oldest.setdefault(table, time.monotonic())
+            if urgent:
+                self.__urgent.add(table)
+            self.__stats['rows_buffered'] += len(rows)
+            self.__condition.notify_all()
+        return future
+
+    def flush(self, table: str = None) -> None:
+        """Escribe de inmediato todo lo pendiente (de una tabla o de todas)"""
+        tables = [table] if table else list(self.__flushers)
+        for name in tables:
+            self.__flush_table(name)
+
+    def close(self) -> None:
+        """Detiene el hilo de flush y escribe todo lo pendiente (agotando los reintentos)"""
+        with self.__condition:
+            if self.__closed:
+                return
+            self.__closed = True
+            self.__condition.notify_all()
+        self.__thread.join(timeout=self.__max_age_seconds + 5)
+        self.flush()
+        while True:
+            with self.__condition:
+                retry_at = [self.__retry_at[table] for table in self.__retry_at if self.__pending[table]]
+            if not retry_at:
+                break
+            time.sleep(max(0.0, min(retry_at) - time.monotonic()))
+            self.flush()
+        logger.info("✅ Buffer de escritura a BigQuery vaciado")
+
+    def stats(self) -> Dict:
+        with self.__condition:
+            return {**self.__stats, 'rows_pending': dict(self.__pending_rows)}
+
+    def __due_tables(self) -> Tuple[List[str], float]:
+        """Retorna las tablas que deben hacer flush y los segundos hasta el próximo vencimiento"""
+        now = time.monotonic()
+        due = []
+        next_wait = self.__max_age_seconds
+        for table, oldest in self.__oldest.items():
+            retry_in = self.__retry_at.get(table, 0) - now
+            if retry_in > 0:
+                next_wait = min(next_wait, retry_in)
+                continue
+            age = now - oldest
+            if self.__pending_rows[table] >= self.__max_rows or age >= self.__max_age_seconds or table in self.__urgent:
+                due.append(table)
+            else:
+                next_wait = min(next_wait, self.__max_age_seconds - age)
+        return due, next_wait
+
+    def __run(self) -> None:
+        while True:
+            with self.__condition:
+                due, next_wait = self.__due_tables()
+                while not due and not self.__closed:
+                    self.__condition.wait(next_wait if self.__oldest else None)
+                    due, next_wait = self.__due_tables()
+                if self.__closed:
+                    return
+            for table in due:
+                self.__flush_table(table)
+
+    def __flush_table(self, table: str) -> None:
+        with self.__flush_locks[table]:
+            with self.__condition:
+                batch = self.__pending[table]
+                if not batch:
+                    return
+                self.__pending[table] = []
+                self.__pending_rows[table] = 0
+                self.__oldest.pop(table, None)
+                self.__urgent.discard(table)
+
+            rows = [row for batch_rows, _, _ in batch for row in batch_rows]
+            logger.info(f"💾 Flush de {len(rows)} filas ({len(batch)} requests) a la tabla {table}")
+            try:
+                result = self.__flushers[table](rows)
+            except Exception as e:
+                logger.error(f"❌ Error en flush de la tabla {table}: {e}")
+                self.__retry_or_drop(table, batch, e)
+                return
+
+            with self.__condition:
+                self.__stats['flushes'] += 1
+                self.__stats['rows_flushed'] += len(rows)
+                self.__retry_at.pop(table, None)
+            for _, future, _ in batch:
+                future.set_result(result)
+
+    def __retry_or_drop(self, table: str, batch: List[Tuple[List[Dict], Future, int]], error: Exception) -> None:
+        """Devuelve al buffer las filas de un flush fallido o, agotados los reintentos, las descarta"""
+        retry = [(rows, future, attempts + 1) for rows, future, attempts in batch if attempts < self.__max_retries]
+        dropped = [(rows, future) for rows, future, attempts in batch if attempts >= self.__max_retries]
+        with self.__condition:
+            self.__stats['flush_errors'] += 1
+            if retry:
+                # Antes que las filas encoladas después, para respetar el orden de escritura
+                self.__pending[table] = retry + self.__pending[table]
+                self.__pending_rows[table] += sum(len(rows) for rows, _, _ in retry)
+                self.__oldest[table] = min(self.__oldest.get(table, time.monotonic()), time.monotonic())
+                attempts = max(attempts for _, _, attempts in retry)
+                retry_in = self.__retry_backoff * 2 ** (attempts - 1)
+                self.__retry_at[table] = time.monotonic() + retry_in
+                self.__stats['flush_retries'] += 1
+                self.__condition.notify_all()
+            self.__stats['rows_dropped'] += sum(len(rows) for rows, _ in dropped)
+        if retry:
+            logger.warning(f"🔁 {sum(len(rows) for rows, _, _ in retry)} filas de {table} se reintentarán "
+                           f"en {retry_in:.1f}s")
+        if dropped:
+            logger.error(f"❌ {sum(len(rows) for rows, _ in dropped)} filas de {table} descartadas tras "
+                         f"{self.__max_retries} reintentos: {error}")
+        for _, future in dropped:
+            future.set_exception(error)